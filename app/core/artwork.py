@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import httpx
+
+from app.core.models import PlaybackSnapshot
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow the best-fitting source image is served unresized
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Requested sizes snap up to one of these so arbitrary ?size= values can't flood the cache
+THUMBNAIL_SIZES = (64, 128, 200, 300, 640)
+
+Images = Tuple[Tuple[int, str], ...]
+
+
+def snap_size(size: int) -> int:
+    for candidate in THUMBNAIL_SIZES:
+        if size <= candidate:
+            return candidate
+    return THUMBNAIL_SIZES[-1]
+
+
+def pick_image(images: Images, size: int) -> Optional[str]:
+    """Smallest image at least `size` wide, else the largest available."""
+    if not images:
+        return None
+    by_width = sorted(images)
+    for width, url in by_width:
+        if width >= size:
+            return url
+    return by_width[-1][1]
+
+
+def resize_image(data: bytes, size: int) -> bytes:
+    if Image is None:
+        return data
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width <= size:
+            return data
+        image = image.convert("RGB")
+        image.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=85, optimize=True)
+        return out.getvalue()
+
+
+def image_media_type(data: bytes) -> str:
+    """Content type from the image's magic bytes. Thumbnails are JPEG, but resize_image hands
+    back the source unchanged when it is already small enough or Pillow is missing."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+class DiskLRUCache:
+    """Size-bounded directory of files, evicting the least recently used first.
+
+    Methods do blocking file IO and are meant to be called via asyncio.to_thread.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+        self.total_bytes = sum(self._sizes.values())
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._put(key, data)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        if key not in self._sizes:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # persist recency across restarts
+        except FileNotFoundError:
+            self.total_bytes -= self._sizes.pop(key, 0)
+            return None
+        self._sizes.move_to_end(key)
+        return data
+
+    def _put(self, key: str, data: bytes):
+        path = os.path.join(self.directory, key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.total_bytes += len(data) - self._sizes.pop(key, 0)
+        self._sizes[key] = len(data)
+        while self.total_bytes > self.max_bytes and len(self._sizes) > 1:
+            old_key, old_size = self._sizes.popitem(last=False)
+            self.total_bytes -= old_size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, old_key))
+            except FileNotFoundError:
+                pass
+
+
+class ArtworkService:
+    """Serves resized album artwork from a disk LRU, fetching from Spotify's CDN on a miss."""
+
+    def __init__(self, client_getter: Callable[[], httpx.AsyncClient], cache: DiskLRUCache, max_albums: int = 4096):
+        self.client_getter = client_getter
+        self.cache = cache
+        self.max_albums = max_albums
+        self._images: "OrderedDict[str, Images]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, album_id: str, images: Images):
+        self._images[album_id] = images
+        self._images.move_to_end(album_id)
+        if len(self._images) > self.max_albums:
+            self._images.popitem(last=False)
+
+    def on_playback(self, user_id: str, previous: Optional[PlaybackSnapshot], current: Optional[PlaybackSnapshot]):
+        """PlaybackCache listener, remembers the image list of every album seen."""
+        if current is not None and current.album_id and current.images:
+            self.remember(current.album_id, current.images)
+
+    async def get(self, album_id: str, size: int,
+                  images_loader: Optional[Callable[[], Awaitable[Images]]] = None) -> Optional[Tuple[bytes, str]]:
+        """Returns (image bytes, etag) for a thumbnail, or None if the album has no artwork."""
+        size = snap_size(size)
+        key = f"{album_id}_{size}.jpg"
+        result = await asyncio.to_thread(self._read, key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._in_flight[key] = asyncio.ensure_future(self._fetch(key, album_id, size, images_loader))
+        return await asyncio.shield(task)
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, str]]:
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        return data, make_etag(data)
+
+    def _store(self, key: str, data: bytes, size: int) -> Tuple[bytes, str]:
+        data = resize_image(data, size)
+        self.cache.put(key, data)
+        return data, make_etag(data)
+
+    async def _fetch(self, key: str, album_id: str, size: int,
+                     images_loader: Optional[Callable[[], Awaitable[Images]]]) -> Optional[Tuple[bytes, str]]:
+        try:
+            images = self._images.get(album_id)
+            if images is None and images_loader is not None:
+                images = await images_loader()
+                self.remember(album_id, images)
+            url = pick_image(images or (), size)
+            if url is None:
+                return None
+
+            response = await self.client_getter().get(url)
+            response.raise_for_status()
+            # Decoding and resizing is CPU bound, keep it off the event loop
+            return await asyncio.to_thread(self._store, key, response.content, size)
+        finally:
+            self._in_flight.pop(key, None)
+
+
+def make_etag(data: bytes) -> str:
+    return '"' + hashlib.blake2b(data, digest_size=12).hexdigest() + '"'
+
+
+_artwork_service_instance: Optional[ArtworkService] = None
+
+def set_artwork_service_instance(service: ArtworkService):
+    global _artwork_service_instance
+    _artwork_service_instance = service
+
+def get_artwork_service() -> ArtworkService:
+    if _artwork_service_instance is None:
+        raise RuntimeError("ArtworkService has not been initialized. "
+                           "Ensure set_artwork_service_instance is called during app startup.")
+    return _artwork_service_instance
@@ -1,9 +1,10 @@
-from fastapi import Request, Depends
+from fastapi import Request, Depends, HTTPException
 from app.core.spotify import (
     get_spotify_client, SpotifyApi
 )
-from app.core.session import store_user_session, clear_user_session, update_token_in_session, get_user_from_session
-import time
+from app.core.rooms import get_room_registry
+from app.core.session import store_user_session, clear_user_session, get_user_from_session
+from app.core.tokens import get_token_store, NotAuthenticatedError
 
 
 def get_callback_url(spotify_client: SpotifyApi) -> str:
@@ -16,26 +17,26 @@ async def handle_callback(request: Request, code: str, spotify_client: SpotifyAp
 
     user_data = await spotify_client.get_user(access_token)
 
-    store_user_session(request, user_data, tokens)
+    await get_token_store().save(user_data["id"], tokens)
+    store_user_session(request, user_data)
 
 
-def logout_user(request: Request):
-    clear_user_session(request)
-
-async def refresh_access_token(request: Request) -> str:
+async def logout_user(request: Request):
     user = get_user_from_session(request)
-    refresh_token = user["refresh_token"]
-    tokens = await refresh_access_token(refresh_token)
-    update_token_in_session(request.session, tokens)
-
-    return tokens["access_token"]
+    clear_user_session(request)
+    if user:
+        # Otherwise the tokens would keep being renewed, and keep the user's rooms open
+        await get_token_store().remove(user["id"])
+        await get_room_registry().close_owner(user["id"])
 
 async def get_valid_access_token(request: Request) -> str:
     user = get_user_from_session(request)
-
-    token_expiry = user.get("token_expiry", 0)
-    if time.time() > token_expiry - 60:
-        await refresh_access_token(request.session)
-        user = request.session.get("user")
-
-    return user["access_token"]
\ No newline at end of file
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+
+    try:
+        return await get_token_store().get_access_token(user["id"])
+    except NotAuthenticatedError:
+        # Session outlived the server-side tokens (e.g. after a restart)
+        clear_user_session(request)
+        raise HTTPException(status_code=401, detail="Session expired, please log in again")
\ No newline at end of file
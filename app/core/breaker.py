@@ -0,0 +1,101 @@
+import logging
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class UpstreamUnavailableError(Exception):
+    """Spotify was not called because it is known to be failing or we are overloaded."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"Circuit for {endpoint} is open, retry after {retry_after:.1f}s", retry_after)
+        self.endpoint = endpoint
+
+
+class UpstreamOverloadedError(UpstreamUnavailableError):
+    def __init__(self, in_flight: int, retry_after: float = 1.0):
+        super().__init__(f"{in_flight} upstream requests already in flight, shedding load", retry_after)
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one upstream endpoint.
+
+    `failure_threshold` consecutive failures open the circuit and calls fail fast for
+    `reset_timeout` seconds. Then a single probe call is let through (half-open): its
+    success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.trips = 0
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError unless the call may go upstream. Returns whether it is the probe."""
+        if self.state == CLOSED:
+            return False
+        if self.state == OPEN:
+            retry_after = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_after > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.endpoint, retry_after)
+            self.state = HALF_OPEN
+        if self.probing:
+            self.rejected += 1
+            raise CircuitOpenError(self.endpoint, self.reset_timeout)
+        self.probing = True
+        return True
+
+    def after_call(self, success: Optional[bool], probe: bool = False):
+        """Record a call's outcome. None says nothing about upstream health, e.g. a cancelled call."""
+        if probe:
+            # The probe is over either way, without an outcome the next caller probes instead
+            self.probing = False
+        if success is None:
+            return
+        if success:
+            if self.state != CLOSED:
+                logger.info(f"Circuit for {self.endpoint} closed again")
+            self.state = CLOSED
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.trips += 1
+                logger.warning(f"Circuit for {self.endpoint} opened after {self.failures} consecutive failures")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class CircuitBreakers:
+    """One CircuitBreaker per upstream endpoint label, created on first use."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, endpoint: str) -> CircuitBreaker:
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def states(self) -> Dict[str, str]:
+        return {endpoint: breaker.state for endpoint, breaker in self.breakers.items()}
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Called with (user_id, previous_value, new_value) whenever a fresh value is stored
+CacheListener = Callable[[str, Any, Any], None]
+
+
+class PlaybackCache:
+    """Per-user snapshot cache with a short TTL, LRU eviction and single-flight fetches.
+
+    Concurrent misses for the same user share one in-flight upstream request.
+    Listeners see every stored value, e.g. to react to track changes.
+    """
+
+    def __init__(self, ttl: float = 1.0, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.stale = 0
+        self._listeners: List[CacheListener] = []
+
+    def add_listener(self, listener: CacheListener):
+        self._listeners.append(listener)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: str) -> Optional[Tuple[float, Any]]:
+        """Return the (stored_at, value) entry for a user regardless of age."""
+        return self._entries.get(user_id)
+
+    def set(self, user_id: str, value: Any):
+        previous = self._entries.get(user_id)
+        self._entries[user_id] = (time.monotonic(), value)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        for listener in self._listeners:
+            listener(user_id, previous[1] if previous else None, value)
+
+    def invalidate(self, user_id: str):
+        """Force the next read to refetch, but keep the value around as a fallback."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (float("-inf"), entry[1])
+
+    async def get_or_fetch(self, user_id: str, fetch: Callable[[], Awaitable[Any]],
+                           on_refresh: Optional[Callable[[float, Any], Any]] = None) -> Any:
+        """Cached value if fresh, else fetch it once for all concurrent callers.
+
+        With `on_refresh`, callers arriving while a refresh is in flight don't wait for it:
+        they get on_refresh(stored_at, previous value) right away (counted as `stale`).
+        Invalidated entries are out of date, so their callers wait for the refresh instead.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        task = self._in_flight.get(user_id)
+        if task is not None and entry is not None and on_refresh is not None and entry[0] != float("-inf"):
+            self.stale += 1
+            return on_refresh(*entry)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(user_id, fetch))
+            self._in_flight[user_id] = task
+        # Shield so a disconnecting caller doesn't cancel the fetch the others are waiting on
+        return await asyncio.shield(task)
+
+    async def _fetch(self, user_id: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await fetch()
+            self.set(user_id, value)
+            return value
+        finally:
+            self._in_flight.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "stale": self.stale,
+        }
@@ -0,0 +1,148 @@
+import asyncio
+import dataclasses
+import logging
+from typing import Dict, List, Optional
+
+from app.core.spotify import SpotifyApi
+from app.core.streams import StreamHub
+from app.core.tokens import TokenStore
+
+logger = logging.getLogger(__name__)
+
+PLAY, PAUSE, NEXT, PREVIOUS = "play", "pause", "next", "previous"
+COMMANDS = (PLAY, PAUSE, NEXT, PREVIOUS)
+
+OPTIMISTIC_STATUS = {
+    PLAY: "Playing",
+    PAUSE: "Paused",
+    NEXT: "Skipped to next track",
+    PREVIOUS: "Skipped to previous track",
+}
+FAILED_STATUS = {
+    PLAY: "Failed to start playback",
+    PAUSE: "Failed to pause playback",
+    NEXT: "Failed to skip to next track",
+    PREVIOUS: "Failed to skip to previous track",
+}
+
+
+class CommandQueue:
+    __slots__ = ("pending", "base_playing", "task", "last_error")
+
+    def __init__(self):
+        self.pending: List[str] = []
+        # Playing state before the trailing run of play/pause commands, used to cancel toggles
+        self.base_playing: Optional[bool] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_error: Optional[str] = None
+
+
+class CommandPipeline:
+    """Per-user player command queue with optimistic replies.
+
+    Commands are acknowledged immediately and the cached playback state is updated
+    right away. Bursts collected within `window` seconds are merged (play/pause
+    toggles cancel out, repeated skips stay an ordered batch) and then run upstream
+    in order. Failures are pushed to the user's live streams and reported on the
+    user's next command.
+    """
+
+    def __init__(self, spotify_client: SpotifyApi, token_store: TokenStore, hub: StreamHub, window: float = 0.15):
+        self.spotify_client = spotify_client
+        self.token_store = token_store
+        self.hub = hub
+        self.window = window
+        self.queues: Dict[str, CommandQueue] = {}
+        self.submitted = 0
+        self.executed = 0
+        self.failed = 0
+
+    def submit(self, user_id: str, command: str) -> str:
+        """Queue a command and return the status to show right away."""
+        if command not in COMMANDS:
+            raise ValueError(f"Unknown player command: {command}")
+        self.submitted += 1
+
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = CommandQueue()
+        self._merge(queue, command, self._known_playing(user_id))
+        self._apply_optimistic(user_id, command)
+
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.create_task(self._drain(user_id, queue))
+
+        status = OPTIMISTIC_STATUS[command]
+        if queue.last_error:
+            status = f"{status} (previous: {queue.last_error})"
+            queue.last_error = None
+        return status
+
+    def _merge(self, queue: CommandQueue, command: str, known_playing: Optional[bool]):
+        if command not in (PLAY, PAUSE):
+            queue.pending.append(command)
+            return
+        if queue.pending and queue.pending[-1] in (PLAY, PAUSE):
+            queue.pending.pop()
+        else:
+            queue.base_playing = known_playing
+        # A toggle back to where we started is a no-op
+        if queue.base_playing is None or queue.base_playing != (command == PLAY):
+            queue.pending.append(command)
+
+    def _known_playing(self, user_id: str) -> Optional[bool]:
+        entry = self.spotify_client.playback_cache.get(user_id)
+        if entry is None or entry[1] is None:
+            return None
+        return entry[1].is_playing
+
+    def _apply_optimistic(self, user_id: str, command: str):
+        if command not in (PLAY, PAUSE):
+            return
+        entry = self.spotify_client.playback_cache.get(user_id)
+        if entry is not None and entry[1] is not None:
+            self.spotify_client.playback_cache.set(user_id, dataclasses.replace(entry[1], is_playing=command == PLAY))
+
+    async def _drain(self, user_id: str, queue: CommandQueue):
+        try:
+            # Let a burst of clicks collect before going upstream
+            await asyncio.sleep(self.window)
+            while queue.pending:
+                batch, queue.pending = queue.pending, []
+                access_token = await self.token_store.get_access_token(user_id)
+                for command in batch:
+                    success = await getattr(self.spotify_client, command)(access_token)
+                    self.executed += 1
+                    if not success:
+                        self.failed += 1
+                        queue.last_error = FAILED_STATUS[command]
+                        self.hub.push_status(user_id, FAILED_STATUS[command])
+                await self.spotify_client.invalidate_playback(user_id)
+                self.hub.wake(user_id)
+        except Exception as e:
+            logger.warning(f"Player commands failed for user {user_id}: {e}")
+            queue.pending.clear()
+            queue.last_error = "Player commands failed"
+            self.hub.push_status(user_id, queue.last_error)
+        finally:
+            if not queue.pending and self.queues.get(user_id) is queue and queue.last_error is None:
+                del self.queues[user_id]
+
+    async def close(self):
+        tasks = [queue.task for queue in self.queues.values() if queue.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_command_pipeline_instance: Optional[CommandPipeline] = None
+
+def set_command_pipeline_instance(pipeline: CommandPipeline):
+    global _command_pipeline_instance
+    _command_pipeline_instance = pipeline
+
+def get_command_pipeline() -> CommandPipeline:
+    if _command_pipeline_instance is None:
+        raise RuntimeError("CommandPipeline has not been initialized. "
+                           "Ensure set_command_pipeline_instance is called during app startup.")
+    return _command_pipeline_instance
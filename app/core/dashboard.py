@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Iterable, Optional, Set, Tuple
+
+from app.core.models import PlaybackSnapshot
+from app.core.spotify import SpotifyApi
+from app.core.tokens import NotAuthenticatedError, TokenStore
+
+logger = logging.getLogger(__name__)
+
+FRESH, STALE, UNAVAILABLE = "fresh", "stale", "unavailable"
+
+
+@dataclass
+class BatchResult:
+    user_id: str
+    status: str
+    playback: Optional[PlaybackSnapshot]
+    age_ms: int = 0  # how old a stale snapshot is
+
+
+class Dashboard:
+    """Fetches the playback of a fixed set of users at once, for a shared display.
+
+    Fetches run concurrently, at most `concurrency` at a time, and every user has to
+    finish within `deadline` seconds of the batch starting. A user that misses the
+    deadline or fails is served from their last cached snapshot, marked stale. The
+    upstream request keeps going in the background (the playback cache shields it),
+    so a slow account is usually fresh again on the next batch.
+
+    Batches are budgeted against the app-wide rate limiter: only as many users as it
+    can let through in the first half of the deadline go upstream, the longest-cached
+    first, and the rest are served from cache straight away. With the default limits
+    (10/s, burst 20) a 50-user batch refreshes 30 users and the others rotate in on
+    the next batches, instead of 20 of them queueing for tokens past the deadline.
+    """
+
+    def __init__(self, spotify_client: SpotifyApi, token_store: TokenStore, members: Iterable[str] = (),
+                 concurrency: int = 50, deadline: float = 2.0):
+        self.spotify_client = spotify_client
+        self.token_store = token_store
+        self.members: Tuple[str, ...] = tuple(members)
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.results: Dict[str, int] = {FRESH: 0, STALE: 0, UNAVAILABLE: 0}
+
+    async def fetch(self, user_ids: Iterable[str]) -> AsyncIterator[BatchResult]:
+        """Yield one result per user, in the order they complete."""
+        user_ids = list(user_ids)
+        over_budget = self._over_budget(user_ids)
+        slots = asyncio.Semaphore(self.concurrency)
+        deadline = time.monotonic() + self.deadline
+        tasks = [asyncio.create_task(self._from_cache(user_id) if user_id in over_budget
+                                     else self._fetch_one(user_id, slots, deadline))
+                 for user_id in user_ids]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                self.results[result.status] += 1
+                yield result
+        finally:
+            # The client went away before the batch finished
+            for task in tasks:
+                task.cancel()
+
+    def _over_budget(self, user_ids: Iterable[str]) -> Set[str]:
+        """Users to serve from cache because the rate limiter can't let them through in time."""
+        cache = self.spotify_client.playback_cache
+        now = time.monotonic()
+        uncached = 0
+        expired = []
+        for user_id in user_ids:
+            entry = cache.get(user_id)
+            if entry is None:
+                # Nothing to fall back on, these go upstream whatever the budget
+                uncached += 1
+            elif now - entry[0] >= cache.ttl:
+                expired.append((entry[0], user_id))
+        budget = int(self.spotify_client.rate_limiter.budget(self.deadline / 2)) - uncached
+        expired.sort()
+        return {user_id for _, user_id in expired[max(0, budget):]}
+
+    async def _fetch_one(self, user_id: str, slots: asyncio.Semaphore, deadline: float) -> BatchResult:
+        try:
+            playback = await asyncio.wait_for(self._fetch_playback(user_id, slots),
+                                              timeout=max(0.0, deadline - time.monotonic()))
+            return BatchResult(user_id, STALE if playback and playback.stale else FRESH, playback)
+        except asyncio.TimeoutError:
+            logger.info(f"Dashboard fetch for user {user_id} missed the deadline")
+        except NotAuthenticatedError:
+            # A member who hasn't logged in (on any worker) yet, not worth a warning every refresh
+            pass
+        except Exception as e:
+            logger.warning(f"Dashboard fetch for user {user_id} failed: {e}")
+        return await self._from_cache(user_id)
+
+    async def _from_cache(self, user_id: str) -> BatchResult:
+        entry = self.spotify_client.playback_cache.get(user_id)
+        if entry is None:
+            return BatchResult(user_id, UNAVAILABLE, None)
+        stored_at, playback = entry
+        # invalidate() leaves -inf as the stored time, the age is unknown then
+        age_ms = int((time.monotonic() - stored_at) * 1000) if stored_at > float("-inf") else 0
+        return BatchResult(user_id, STALE, playback, age_ms)
+
+    async def _fetch_playback(self, user_id: str, slots: asyncio.Semaphore) -> Optional[PlaybackSnapshot]:
+        async with slots:
+            access_token = await self.token_store.get_access_token(user_id)
+            return await self.spotify_client.get_current_playback(access_token, user_id=user_id)
+
+
+_dashboard_instance: Optional[Dashboard] = None
+
+def set_dashboard_instance(dashboard: Dashboard):
+    global _dashboard_instance
+    _dashboard_instance = dashboard
+
+def get_dashboard() -> Dashboard:
+    if _dashboard_instance is None:
+        raise RuntimeError("Dashboard has not been initialized. "
+                           "Ensure set_dashboard_instance is called during app startup.")
+    return _dashboard_instance
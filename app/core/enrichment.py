@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+import httpx
+
+from app.core.models import PlaybackSnapshot
+
+logger = logging.getLogger(__name__)
+
+DISCOGS_BASE_URL = "https://api.discogs.com"
+
+
+class AlbumInfoProvider:
+    """Looks up extra release info for an album. Returns None when nothing is found."""
+    name = "none"
+
+    async def lookup(self, artist: str, album: str) -> Optional[Dict[str, Any]]:
+        return None
+
+
+class DiscogsProvider(AlbumInfoProvider):
+    name = "discogs"
+
+    def __init__(self, token: str, base_url: str = DISCOGS_BASE_URL, timeout: float = 10.0):
+        self.token = token
+        self.base_url = base_url
+        self._client = httpx.AsyncClient(timeout=timeout, headers={"User-Agent": "now-playing/1.0"})
+
+    async def lookup(self, artist: str, album: str) -> Optional[Dict[str, Any]]:
+        response = await self._client.get(
+            f"{self.base_url}/database/search",
+            params={"q": f"{artist} {album}", "type": "release", "token": self.token},
+        )
+        response.raise_for_status()
+        results = response.json().get("results") or []
+        if not results:
+            return None
+        release = results[0]
+        return {
+            "source": self.name,
+            "id": release.get("id"),
+            "title": release.get("title"),
+            "year": release.get("year"),
+            "country": release.get("country"),
+            "label": release.get("label", []),
+            "genre": release.get("genre", []),
+            "style": release.get("style", []),
+            "url": release.get("uri"),
+        }
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class AlbumInfoCache:
+    """Persistent SQLite cache keyed by Spotify album id, with TTL and negative caching."""
+
+    def __init__(self, path: str, ttl: float = 30 * 86400, negative_ttl: float = 86400):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS album_info ("
+                "album_id TEXT PRIMARY KEY, info TEXT, expires_at REAL NOT NULL)"
+            )
+
+    def _get(self, album_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT info, expires_at FROM album_info WHERE album_id = ?", (album_id,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def _put(self, album_id: str, info: Optional[Dict[str, Any]]):
+        ttl = self.ttl if info is not None else self.negative_ttl
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO album_info (album_id, info, expires_at) VALUES (?, ?, ?)",
+                (album_id, json.dumps(info) if info is not None else None, time.time() + ttl),
+            )
+
+    async def get(self, album_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Returns (hit, info). A hit with info None is a cached negative result."""
+        return await asyncio.to_thread(self._get, album_id)
+
+    async def put(self, album_id: str, info: Optional[Dict[str, Any]]):
+        await asyncio.to_thread(self._put, album_id, info)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class AlbumEnricher:
+    """Looks up album info in the background whenever a user's track changes."""
+
+    def __init__(self, provider: AlbumInfoProvider, cache: AlbumInfoCache):
+        self.provider = provider
+        self.cache = cache
+        self.enabled = provider.name != "none"
+        self._in_flight: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.lookups = 0
+        self.lookup_failures = 0
+
+    def on_playback(self, user_id: str, previous: Optional[PlaybackSnapshot], current: Optional[PlaybackSnapshot]):
+        """PlaybackCache listener, schedules a lookup when the album changes."""
+        if not self.enabled or current is None or not current.album_id:
+            return
+        if previous is not None and previous.album_id == current.album_id:
+            return
+        self.schedule(current)
+
+    def schedule(self, snapshot: PlaybackSnapshot):
+        if not self.enabled or snapshot.album_id in self._in_flight:
+            return
+        self._in_flight.add(snapshot.album_id)
+        task = asyncio.get_running_loop().create_task(self._enrich(snapshot))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _enrich(self, snapshot: PlaybackSnapshot):
+        album_id = snapshot.album_id
+        try:
+            hit, _ = await self.cache.get(album_id)
+            if hit:
+                return
+            artist = snapshot.artists[0] if snapshot.artists else ""
+            self.lookups += 1
+            info = await self.provider.lookup(artist, snapshot.album_name)
+            await self.cache.put(album_id, info)
+        except Exception as e:
+            # Not cached, so the next track change retries
+            self.lookup_failures += 1
+            logger.warning(f"Album info lookup failed for {album_id}: {e}")
+        finally:
+            self._in_flight.discard(album_id)
+
+    async def get(self, album_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        return await self.cache.get(album_id)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if hasattr(self.provider, "aclose"):
+            await self.provider.aclose()
+        self.cache.close()
+
+
+def build_album_info_provider(name: str) -> AlbumInfoProvider:
+    if name == "discogs":
+        return DiscogsProvider(
+            token=os.getenv("DISCOGS_TOKEN", ""),
+            base_url=os.getenv("DISCOGS_BASE_URL", DISCOGS_BASE_URL),
+        )
+    return AlbumInfoProvider()
+
+
+_album_enricher_instance: Optional[AlbumEnricher] = None
+
+def set_album_enricher_instance(enricher: AlbumEnricher):
+    global _album_enricher_instance
+    _album_enricher_instance = enricher
+
+def get_album_enricher() -> AlbumEnricher:
+    if _album_enricher_instance is None:
+        raise RuntimeError("AlbumEnricher has not been initialized. "
+                           "Ensure set_album_enricher_instance is called during app startup.")
+    return _album_enricher_instance
@@ -0,0 +1,55 @@
+import hashlib
+from collections import defaultdict
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# Per-route counts of conditional requests and of the 304s they produced
+conditional_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"conditional": 0, "not_modified": 0})
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.blake2b("|".join(str(part) for part in parts).encode(), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (candidate.strip() for candidate in if_none_match.split(","))
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+class Conditional:
+    """Route dependency for ETag validation.
+
+    Call not_modified() with the response's ETag before doing any rendering work;
+    it returns a ready 304 when the client already has that representation.
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        # Route template rather than the raw path, so /artwork/{album_id} is one counter
+        route = request.scope.get("route")
+        self.route = getattr(route, "path", request.url.path)
+
+    def not_modified(self, etag: str, cache_control: str = "no-cache") -> Optional[Response]:
+        if_none_match = self.request.headers.get("if-none-match")
+        if if_none_match is None:
+            return None
+        stats = conditional_stats[self.route]
+        stats["conditional"] += 1
+        if not etag_matches(if_none_match, etag):
+            return None
+        stats["not_modified"] += 1
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+    @staticmethod
+    def tag(response: Response, etag: str, cache_control: str = "no-cache") -> Response:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = cache_control
+        return response
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from app.core.models import PlaybackSnapshot
+from app.core.templates import templates
+
+
+class FragmentCache:
+    """Size-bounded LRU of rendered partials, stored as UTF-8 bytes ready to send.
+
+    track_info and dashboard_card output depend only on the track, so they are keyed by track id;
+    playback_status output is keyed by its status string, of which there are few.
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def track_info(self, track: Optional[PlaybackSnapshot]) -> bytes:
+        return self._get(("track_info", track.track_id if track else None),
+                         "partials/track_info.html", {"track": track})
+
+    def dashboard_card(self, track: Optional[PlaybackSnapshot]) -> bytes:
+        return self._get(("dashboard_card", track.track_id if track else None),
+                         "partials/dashboard_card.html", {"track": track})
+
+    def playback_status(self, status: str) -> bytes:
+        return self._get(("playback_status", status), "partials/playback_status.html", {"status": status})
+
+    def _get(self, key: Hashable, template: str, context: Dict[str, Any]) -> bytes:
+        fragment = self._entries.get(key)
+        if fragment is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+        self.misses += 1
+        fragment = templates.get_template(template).render(context).encode()
+        self._entries[key] = fragment
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return fragment
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_fragment_cache_instance: Optional[FragmentCache] = None
+
+def set_fragment_cache_instance(cache: FragmentCache):
+    global _fragment_cache_instance
+    _fragment_cache_instance = cache
+
+def get_fragment_cache() -> FragmentCache:
+    if _fragment_cache_instance is None:
+        raise RuntimeError("FragmentCache has not been initialized. "
+                           "Ensure set_fragment_cache_instance is called during app startup.")
+    return _fragment_cache_instance
@@ -0,0 +1,364 @@
+import asyncio
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from app.core.models import PlaybackSnapshot
+
+logger = logging.getLogger(__name__)
+
+# started_at ms, listened ms, duration ms, track id, album id, primary artist id, padding.
+# Spotify ids are 22 base62 characters, shorter ones are NUL padded.
+RECORD = struct.Struct("<QII22s22s22s2x")
+RECORD_SIZE = RECORD.size
+ID_SIZE = 22
+
+# Unpack just one id column and the listened time, skipping everything else
+_AGGREGATE_FIELDS = {
+    "track": struct.Struct("<8xI4x22s44x2x"),
+    "album": struct.Struct("<8xI4x22x22s22x2x"),
+    "artist": struct.Struct("<8xI4x44x22s2x"),
+}
+AGGREGATE_KINDS = tuple(_AGGREGATE_FIELDS)
+
+
+@dataclass(slots=True)
+class Play:
+    started_at: int
+    listened_ms: int
+    duration_ms: int
+    track_id: str
+    album_id: str
+    artist_id: str
+
+    def pack(self) -> bytes:
+        return RECORD.pack(self.started_at, self.listened_ms, self.duration_ms,
+                           self.track_id.encode(), self.album_id.encode(), self.artist_id.encode())
+
+    @classmethod
+    def unpack(cls, data) -> "Play":
+        started_at, listened_ms, duration_ms, track_id, album_id, artist_id = RECORD.unpack(data)
+        return cls(started_at, listened_ms, duration_ms,
+                   _decode_id(track_id), _decode_id(album_id), _decode_id(artist_id))
+
+
+def _decode_id(raw: bytes) -> str:
+    return raw.rstrip(b"\0").decode()
+
+
+class _OpenPlay:
+    """The track a user is on right now, closed into a Play when the track changes."""
+    __slots__ = ("snapshot", "started_at", "listened_ms")
+
+    def __init__(self, snapshot: PlaybackSnapshot, now_ms: int):
+        self.snapshot = snapshot
+        self.started_at = now_ms - snapshot.progress_ms
+        self.listened_ms = snapshot.progress_ms
+
+
+class HistoryStore:
+    """Append-only per-user files of fixed-width records, read through mmap.
+
+    Records are appended in start order, so record i sits at i * RECORD_SIZE and
+    time ranges are a binary search. Several workers may append to the same file,
+    so appends hold an flock and drop plays that start before the file's last
+    record. Track, album and artist names live in a shared append-only catalog
+    next to the history files.
+
+    Methods do blocking file IO and are meant to be called via asyncio.to_thread.
+    """
+
+    def __init__(self, directory: str, max_open_maps: int = 64):
+        self.directory = directory
+        self.max_open_maps = max_open_maps
+        os.makedirs(directory, exist_ok=True)
+        self._maps: "OrderedDict[str, Tuple[int, Optional[mmap.mmap]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # (user, by) -> (records covered, plays, listened): all-time totals, topped up as files grow
+        self._totals: "OrderedDict[Tuple[str, str], Tuple[int, Counter, Counter]]" = OrderedDict()
+        self.out_of_order = 0
+        self.catalog_path = os.path.join(directory, "catalog.jsonl")
+        self.names: Dict[Tuple[str, str], str] = {}
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        kind, item_id, name = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    self.names[(kind, item_id)] = name
+
+    def path(self, user_id: str) -> str:
+        return os.path.join(self.directory, quote(user_id, safe="") + ".hist")
+
+    def append(self, user_id: str, plays: List[Play]) -> int:
+        """Append plays in start order, returns how many were written."""
+        fd = os.open(self.path(user_id), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            if size % RECORD_SIZE:
+                # A torn last record would shift every record after it
+                size -= size % RECORD_SIZE
+                os.ftruncate(fd, size)
+            last = struct.unpack("<Q", os.pread(fd, 8, size - RECORD_SIZE))[0] if size else 0
+            # Another worker may have written later plays for this user, an earlier start would break the bisect
+            ordered = [play for play in sorted(plays, key=lambda play: play.started_at) if play.started_at >= last]
+            if len(ordered) < len(plays):
+                self.out_of_order += len(plays) - len(ordered)
+                logger.warning(f"Dropped {len(plays) - len(ordered)} history plays for {user_id} "
+                               f"starting before the last recorded one")
+            if ordered:
+                os.write(fd, b"".join(play.pack() for play in ordered))
+            return len(ordered)
+        finally:
+            os.close(fd)  # releases the flock
+
+    def append_names(self, names: Dict[Tuple[str, str], str]):
+        new = {key: name for key, name in names.items() if self.names.get(key) != name}
+        if not new:
+            return
+        with open(self.catalog_path, "a", encoding="utf-8") as f:
+            for (kind, item_id), name in new.items():
+                f.write(json.dumps([kind, item_id, name]) + "\n")
+        self.names.update(new)
+
+    def _map(self, user_id: str) -> Optional[mmap.mmap]:
+        """Read-only map of the user's file, remapped when it has grown."""
+        path = self.path(user_id)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        size -= size % RECORD_SIZE  # ignore a partially written last record
+        with self._lock:
+            cached = self._maps.get(user_id)
+            if cached is not None and cached[0] == size:
+                self._maps.move_to_end(user_id)
+                return cached[1]
+            mapped = None
+            if size:
+                with open(path, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            # Replaced and evicted maps may still be read by another thread, they unmap when released
+            self._maps[user_id] = (size, mapped)
+            self._maps.move_to_end(user_id)
+            while len(self._maps) > self.max_open_maps:
+                self._maps.popitem(last=False)
+            return mapped
+
+    def _bisect(self, mapped: mmap.mmap, count: int, started_at: int) -> int:
+        """Index of the first record starting at or after `started_at`."""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from("<Q", mapped, mid * RECORD_SIZE)[0] < started_at:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range(self, mapped: Optional[mmap.mmap], since: Optional[int], until: Optional[int]) -> Tuple[int, int]:
+        if mapped is None:
+            return 0, 0
+        count = len(mapped) // RECORD_SIZE
+        start = self._bisect(mapped, count, since) if since is not None else 0
+        end = self._bisect(mapped, count, until) if until is not None else count
+        return start, max(start, end)
+
+    def page(self, user_id: str, limit: int, before: Optional[int] = None,
+             since: Optional[int] = None, until: Optional[int] = None) -> Tuple[List[Play], Optional[int]]:
+        """Newest first. `before` is a record index cursor; returns (plays, next cursor)."""
+        mapped = self._map(user_id)
+        start, end = self._range(mapped, since, until)
+        if before is not None:
+            end = min(end, before)
+        first = max(start, end - limit)
+        plays = [Play.unpack(mapped[i * RECORD_SIZE:(i + 1) * RECORD_SIZE]) for i in range(end - 1, first - 1, -1)]
+        return plays, first if first > start else None
+
+    def aggregate(self, user_id: str, by: str, since: Optional[int] = None, until: Optional[int] = None,
+                  limit: int = 10) -> List[Tuple[str, int, int]]:
+        """Top (id, plays, listened ms) by track, album or artist within a time range.
+
+        All-time totals are kept and only the records appended since are scanned, so
+        they stay cheap on long histories; bounded ranges are scanned as asked.
+        """
+        mapped = self._map(user_id)
+        start, end = self._range(mapped, since, until)
+        if since is None and until is None:
+            with self._lock:
+                covered, plays, listened = self._totals.pop((user_id, by), (0, Counter(), Counter()))
+            if covered > end:  # file was replaced
+                covered, plays, listened = 0, Counter(), Counter()
+            self._scan(mapped, by, covered, end, plays, listened)
+            with self._lock:
+                self._totals[(user_id, by)] = (end, plays, listened)
+                while len(self._totals) > self.max_open_maps:
+                    self._totals.popitem(last=False)
+        else:
+            plays, listened = Counter(), Counter()
+            self._scan(mapped, by, start, end, plays, listened)
+        return [(_decode_id(raw_id), count, listened[raw_id]) for raw_id, count in plays.most_common(limit)]
+
+    def _scan(self, mapped: Optional[mmap.mmap], by: str, start: int, end: int, plays: Counter, listened: Counter):
+        if end <= start:
+            return
+        view = memoryview(mapped)[start * RECORD_SIZE:end * RECORD_SIZE]
+        try:
+            for listened_ms, raw_id in _AGGREGATE_FIELDS[by].iter_unpack(view):
+                plays[raw_id] += 1
+                listened[raw_id] += listened_ms
+        finally:
+            view.release()
+
+    def close(self):
+        with self._lock:
+            self._maps.clear()
+            self._totals.clear()
+
+
+class HistoryRecorder:
+    """Turns playback snapshots into track plays and writes them in batches.
+
+    Hooked up as a PlaybackCache listener, so it costs the request path a dict
+    update; records are flushed to the HistoryStore every `flush_interval` seconds
+    from a background task. `should_record` lets only the worker polling a user
+    write that user's plays when several workers share state.
+    """
+
+    def __init__(self, store: HistoryStore, flush_interval: float = 5.0, min_listened_ms: int = 5000,
+                 should_record: Optional[Callable[[str], bool]] = None):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.min_listened_ms = min_listened_ms
+        self.should_record = should_record
+        self._open: Dict[str, _OpenPlay] = {}
+        self._pending: Dict[str, List[Play]] = {}
+        self._pending_names: Dict[Tuple[str, str], str] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.flushes = 0
+        self.flush_failures = 0
+
+    def on_playback(self, user_id: str, previous: Optional[PlaybackSnapshot], current: Optional[PlaybackSnapshot]):
+        """PlaybackCache listener."""
+        now_ms = int(time.time() * 1000)
+        open_play = self._open.get(user_id)
+        if open_play is not None and current is not None and open_play.snapshot.track_id == current.track_id:
+            open_play.snapshot = current
+            open_play.listened_ms = max(open_play.listened_ms, current.progress_ms)
+            return
+        if open_play is not None:
+            self._close(user_id, open_play)
+        if current is not None:
+            self._open[user_id] = _OpenPlay(current, now_ms)
+        else:
+            self._open.pop(user_id, None)
+
+    def _close(self, user_id: str, open_play: _OpenPlay):
+        if open_play.listened_ms < self.min_listened_ms:
+            return
+        if self.should_record is not None and not self.should_record(user_id):
+            return
+        snapshot = open_play.snapshot
+        artist_id = snapshot.artist_ids[0] if snapshot.artist_ids else ""
+        play = Play(
+            started_at=open_play.started_at,
+            listened_ms=min(open_play.listened_ms, snapshot.duration_ms or open_play.listened_ms),
+            duration_ms=snapshot.duration_ms,
+            track_id=snapshot.track_id[:ID_SIZE],
+            album_id=(snapshot.album_id or "")[:ID_SIZE],
+            artist_id=artist_id[:ID_SIZE],
+        )
+        self._pending.setdefault(user_id, []).append(play)
+        self._pending_names[("track", play.track_id)] = snapshot.name
+        if play.album_id:
+            self._pending_names[("album", play.album_id)] = snapshot.album_name
+        if play.artist_id:
+            self._pending_names[("artist", play.artist_id)] = snapshot.artists[0]
+        self.recorded += 1
+
+    def name(self, kind: str, item_id: str) -> Optional[str]:
+        return self._pending_names.get((kind, item_id)) or self.store.names.get((kind, item_id))
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending and not self._pending_names:
+            return
+        pending, self._pending = self._pending, {}
+        names, self._pending_names = self._pending_names, {}
+        try:
+            await asyncio.to_thread(self._write, pending, names)
+            self.flushes += 1
+        except Exception as e:
+            self.flush_failures += 1
+            logger.warning(f"Writing listening history failed, will retry: {e}")
+            for user_id, plays in pending.items():
+                self._pending[user_id] = plays + self._pending.get(user_id, [])
+            self._pending_names = {**names, **self._pending_names}
+
+    def _write(self, pending: Dict[str, List[Play]], names: Dict[Tuple[str, str], str]):
+        self.store.append_names(names)
+        for user_id, plays in pending.items():
+            self.store.append(user_id, plays)
+
+    async def page(self, user_id: str, limit: int, before: Optional[int] = None,
+                   since: Optional[int] = None, until: Optional[int] = None) -> Tuple[List[Play], Optional[int]]:
+        return await asyncio.to_thread(self.store.page, user_id, limit, before, since, until)
+
+    async def aggregate(self, user_id: str, by: str, since: Optional[int] = None, until: Optional[int] = None,
+                        limit: int = 10) -> List[Tuple[str, int, int]]:
+        return await asyncio.to_thread(self.store.aggregate, user_id, by, since, until, limit)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        # Plays still open are unfinished, only what's complete is written
+        await self.flush()
+        self.store.close()
+
+    def describe(self, play: Play) -> Dict[str, Any]:
+        return {
+            "track_id": play.track_id,
+            "track": self.name("track", play.track_id),
+            "album_id": play.album_id or None,
+            "album": self.name("album", play.album_id) if play.album_id else None,
+            "artist_id": play.artist_id or None,
+            "artist": self.name("artist", play.artist_id) if play.artist_id else None,
+            "started_at": play.started_at,
+            "listened_ms": play.listened_ms,
+            "duration_ms": play.duration_ms,
+        }
+
+
+_history_recorder_instance: Optional[HistoryRecorder] = None
+
+def set_history_recorder_instance(recorder: HistoryRecorder):
+    global _history_recorder_instance
+    _history_recorder_instance = recorder
+
+def get_history_recorder() -> HistoryRecorder:
+    if _history_recorder_instance is None:
+        raise RuntimeError("HistoryRecorder has not been initialized. "
+                           "Ensure set_history_recorder_instance is called during app startup.")
+    return _history_recorder_instance
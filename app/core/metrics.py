@@ -0,0 +1,211 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+from urllib.parse import urlsplit
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Seconds. Upstream calls and page renders both sit well inside 10s
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RENDER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+Labels = Tuple[str, ...]
+Samples = Union[float, Dict[Labels, float]]
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ("name", "help", "labelnames", "_values")
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram. observe() is a bisect plus two list/float updates, no locking."""
+    __slots__ = ("name", "help", "labelnames", "buckets", "_series")
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter read from live state at scrape time, so the hot path pays nothing.
+
+    The callback returns a single value, or a dict of label values -> value.
+    """
+    __slots__ = ("name", "help", "kind", "labelnames", "callback")
+
+    def __init__(self, name: str, help: str, callback: Callable[[], Samples], kind: str = "gauge",
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        samples = self.callback()
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        for labels, value in samples.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics rendered in the Prometheus text exposition format.
+
+    Everything is updated from the event loop thread only, so plain dict and list
+    updates are safe without locks.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Histogram, CallbackMetric]] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, callback: Callable[[], Samples], kind: str = "gauge",
+                 labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self._register(CallbackMetric(name, help, callback, kind, labelnames))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+route_latency = registry.histogram(
+    "now_playing_http_request_duration_seconds",
+    "Time until response headers are sent, by route template.",
+    ("method", "route", "status"),
+)
+upstream_latency = registry.histogram(
+    "now_playing_upstream_request_duration_seconds",
+    "Spotify request latency by endpoint and status code, excluding rate limiter waits.",
+    ("method", "endpoint", "status"),
+)
+template_render = registry.histogram(
+    "now_playing_template_render_seconds",
+    "Jinja template render time.",
+    ("template",),
+    buckets=RENDER_BUCKETS,
+)
+
+_http_in_flight = 0
+registry.callback("now_playing_http_requests_in_flight", "HTTP requests being handled.", lambda: _http_in_flight)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording route latency. Streaming responses (SSE) are timed
+    to their first byte of headers, not for the lifetime of the connection."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        global _http_in_flight
+        started = time.perf_counter()
+        recorded = False
+
+        async def send_wrapper(message: Message):
+            nonlocal recorded
+            if message["type"] == "http.response.start" and not recorded:
+                recorded = True
+                _observe(scope, started, str(message["status"]))
+            await send(message)
+
+        _http_in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if not recorded:
+                recorded = True
+                _observe(scope, started, "500")
+            raise
+        finally:
+            _http_in_flight -= 1
+
+
+def _observe(scope: Scope, started: float, status: str):
+    # Route template rather than the raw path, so ids in URLs don't explode the label set
+    route = scope.get("route")
+    # Mounts (static files) don't set a route, but do extend root_path
+    route_path = getattr(route, "path", None) or scope.get("root_path") or "unmatched"
+    route_latency.observe(time.perf_counter() - started, scope["method"], route_path, status)
+
+
+def upstream_endpoint(url: str) -> str:
+    """Metric label for an upstream URL: just its path."""
+    return urlsplit(url).path or "/"
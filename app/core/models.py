@@ -0,0 +1,81 @@
+from dataclasses import astuple, dataclass
+from typing import List, Optional, Tuple
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # orjson is optional, the stdlib parser is just slower
+    import json
+    _loads = json.loads
+
+
+@dataclass(slots=True)
+class PlaybackSnapshot:
+    """The handful of currently-playing fields the routes and templates actually use."""
+    track_id: str
+    name: str
+    artists: Tuple[str, ...]
+    album_id: Optional[str]
+    album_name: str
+    image_url: Optional[str]
+    images: Tuple[Tuple[int, str], ...]  # (width, url) as listed by Spotify
+    progress_ms: int
+    duration_ms: int
+    is_playing: bool
+    artist_ids: Tuple[str, ...] = ()
+    stale: bool = False  # served from cache because Spotify couldn't be asked
+
+
+def parse_playback(content: bytes) -> Optional[PlaybackSnapshot]:
+    """Parse a /me/player/currently-playing body. Returns None when no track is playing."""
+    if not content:
+        return None
+    payload = _loads(content)
+    item = payload.get("item")
+    if not item or not item.get("id"):  # nothing playing, or an ad/episode without a track
+        return None
+
+    return parse_track(item, payload.get("progress_ms") or 0, bool(payload.get("is_playing")))
+
+
+def parse_queue(content: bytes) -> Tuple[PlaybackSnapshot, ...]:
+    """Parse a /me/player/queue body into the upcoming tracks, skipping episodes."""
+    payload = _loads(content) if content else {}
+    return tuple(parse_track(item, 0, True) for item in payload.get("queue") or ()
+                 if item and item.get("type", "track") == "track" and item.get("id"))
+
+
+def parse_track(item: dict, progress_ms: int, is_playing: bool) -> PlaybackSnapshot:
+    album = item.get("album") or {}
+    images = album.get("images") or ()
+    return PlaybackSnapshot(
+        track_id=item["id"],
+        name=item.get("name", ""),
+        artists=tuple(artist["name"] for artist in item.get("artists", ())),
+        album_id=album.get("id"),
+        album_name=album.get("name", ""),
+        image_url=images[0]["url"] if images else None,
+        images=parse_images(images),
+        progress_ms=progress_ms,
+        duration_ms=item.get("duration_ms") or 0,
+        is_playing=is_playing,
+        artist_ids=tuple(artist.get("id") or "" for artist in item.get("artists", ())),
+    )
+
+
+def parse_images(images) -> Tuple[Tuple[int, str], ...]:
+    return tuple((image.get("width") or 0, image["url"]) for image in images)
+
+
+def dump_snapshot(snapshot: PlaybackSnapshot) -> List:
+    """Field values in declaration order, for JSON encoding."""
+    return list(astuple(snapshot))
+
+
+def load_snapshot(fields: List) -> PlaybackSnapshot:
+    snapshot = PlaybackSnapshot(*fields)
+    # JSON turns tuples into lists
+    snapshot.artists = tuple(snapshot.artists)
+    snapshot.artist_ids = tuple(snapshot.artist_ids)
+    snapshot.images = tuple((width, url) for width, url in snapshot.images)
+    return snapshot
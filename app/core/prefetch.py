@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Optional, Set
+
+from app.core.artwork import ArtworkService
+from app.core.fragments import FragmentCache
+from app.core.models import PlaybackSnapshot
+from app.core.spotify import SpotifyApi
+from app.core.tokens import TokenStore
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Warms the next queued track shortly before the current one ends.
+
+    A PlaybackCache listener: every playing snapshot (re)arms a per-user timer for
+    `lead_time` seconds before the end of the track. When it fires, the user's queue
+    is fetched once, and the first upcoming track gets its track_info fragment
+    rendered and its artwork cached, so the swap on the track change is served warm.
+    A track change counts as a hit when it lands on the track that was prefetched.
+    """
+
+    def __init__(self, spotify_client: SpotifyApi, token_store: TokenStore, fragments: FragmentCache,
+                 artwork: ArtworkService, lead_time: float = 15.0, artwork_size: int = 200,
+                 should_prefetch: Optional[Callable[[str], bool]] = None):
+        self.spotify_client = spotify_client
+        self.token_store = token_store
+        self.fragments = fragments
+        self.artwork = artwork
+        self.lead_time = lead_time
+        self.artwork_size = artwork_size
+        # With several workers only the one polling the user prefetches
+        self.should_prefetch = should_prefetch
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._prefetched: Dict[str, str] = {}  # user -> track whose successor was prefetched
+        self._expected: Dict[str, str] = {}    # user -> prefetched next track
+        self._tasks: Set[asyncio.Task] = set()
+        self.prefetches = 0
+        self.failures = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.lead_time > 0
+
+    def on_playback(self, user_id: str, previous: Optional[PlaybackSnapshot], current: Optional[PlaybackSnapshot]):
+        """PlaybackCache listener, scores track changes and arms the prefetch timer."""
+        if not self.enabled:
+            return
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        if self.should_prefetch is not None and not self.should_prefetch(user_id):
+            return
+
+        if previous is not None and current is not None and previous.track_id != current.track_id:
+            expected = self._expected.pop(user_id, None)
+            if current.track_id == expected:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if current is None or not current.is_playing or self._prefetched.get(user_id) == current.track_id:
+            return
+        delay = max(0.0, (current.duration_ms - current.progress_ms) / 1000 - self.lead_time)
+        self._timers[user_id] = asyncio.get_running_loop().call_later(
+            delay, self._start, user_id, current.track_id)
+
+    def _start(self, user_id: str, track_id: str):
+        self._timers.pop(user_id, None)
+        self._prefetched[user_id] = track_id
+        task = asyncio.create_task(self._prefetch(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _prefetch(self, user_id: str):
+        self.prefetches += 1
+        try:
+            access_token = await self.token_store.get_access_token(user_id)
+            upcoming = await self.spotify_client.get_queue(access_token)
+            if not upcoming:
+                return
+            next_track = upcoming[0]
+            self._expected[user_id] = next_track.track_id
+            # Keyed by track id, so this is the entry the track change will hit
+            self.fragments.track_info(next_track)
+            if next_track.album_id and next_track.images:
+                self.artwork.remember(next_track.album_id, next_track.images)
+                await self.artwork.get(next_track.album_id, self.artwork_size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Prefetching the next track failed for user {user_id}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"prefetches": self.prefetches, "failures": self.failures, "hits": self.hits, "misses": self.misses}
+
+    async def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_prefetcher_instance: Optional[Prefetcher] = None
+
+def set_prefetcher_instance(prefetcher: Prefetcher):
+    global _prefetcher_instance
+    _prefetcher_instance = prefetcher
+
+def get_prefetcher() -> Prefetcher:
+    if _prefetcher_instance is None:
+        raise RuntimeError("Prefetcher has not been initialized. "
+                           "Ensure set_prefetcher_instance is called during app startup.")
+    return _prefetcher_instance
@@ -0,0 +1,104 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Lower value is served first when the request budget is exhausted."""
+    COMMAND = 0     # user-initiated /player/* commands
+    PAGE = 1        # page loads and direct route calls
+    BACKGROUND = 2  # pollers and progress ticks
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Spotify rate limit active, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """App-wide token bucket with prioritized waiters.
+
+    A 429 with Retry-After pauses every request for the whole app; while paused,
+    acquire() fails fast with RateLimitedError so callers can fall back to cached data.
+    """
+
+    def __init__(self, rate: float = 10.0, burst: int = 20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    @property
+    def retry_after(self) -> float:
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def budget(self, within: float) -> float:
+        """How many more requests could be let through within `within` seconds, after the queued ones."""
+        if self.retry_after > 0:
+            return 0.0
+        self._refill()
+        return max(0.0, self.tokens + within * self.rate - len(self._waiters))
+
+    def pause(self, retry_after: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        self.throttled += 1
+        logger.warning(f"Spotify returned 429, pausing upstream requests for {retry_after:.1f}s")
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: Priority = Priority.PAGE):
+        if self.retry_after > 0:
+            raise RateLimitedError(self.retry_after)
+
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            if self.retry_after > 0:
+                retry_after = self.retry_after
+                while self._waiters:
+                    _, _, future = heapq.heappop(self._waiters)
+                    if not future.done():
+                        future.set_exception(RateLimitedError(retry_after))
+                return
+
+            self._refill()
+            if self.tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():  # waiter was cancelled
+                    continue
+                self.tokens -= 1
+                future.set_result(None)
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,165 @@
+import json
+import logging
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
+
+from app.core.shared import SharedState, SharedStateError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Room:
+    token: str
+    owner_id: str
+    expires_at: float
+
+
+class RoomRegistry:
+    """Read-only share links that show an owner's playback to viewers without a Spotify login.
+
+    Viewers of a room subscribe to the owner's stream poller, so upstream cost is
+    that of one user however many screens watch. Rooms are published to the
+    SharedState when one is configured, so any worker can serve a link; viewer
+    counts (and so `max_viewers`) are per worker. Open streams re-check their room
+    with is_open(), which consults the SharedState at most every `check_interval`
+    seconds per room, so a room closed on another worker ends within that time.
+    """
+
+    def __init__(self, shared: Optional[SharedState] = None, max_viewers: int = 1000, ttl: float = 86400.0,
+                 check_interval: float = 5.0):
+        self.shared = shared
+        self.max_viewers = max_viewers
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._rooms: Dict[str, Room] = {}
+        self._by_owner: Dict[str, str] = {}
+        self._viewers: Dict[str, int] = {}
+        self._checked_at: Dict[str, float] = {}
+
+    async def open(self, owner_id: str) -> Room:
+        """The owner's room, created if it doesn't exist yet. The expiry is extended either way."""
+        token = self._by_owner.get(owner_id)
+        if token is None and self.shared is not None:
+            token = await self._shared_get(f"room_of:{owner_id}")
+        room = await self.get(token.decode() if isinstance(token, bytes) else token) if token else None
+        if room is None:
+            room = Room(token=secrets.token_urlsafe(16), owner_id=owner_id, expires_at=0.0)
+        room.expires_at = time.time() + self.ttl
+        self._rooms[room.token] = room
+        self._by_owner[owner_id] = room.token
+        if self.shared is not None:
+            try:
+                await self.shared.set(f"room:{room.token}", json.dumps(asdict(room)).encode(), self.ttl)
+                await self.shared.set(f"room_of:{owner_id}", room.token.encode(), self.ttl)
+            except SharedStateError as e:
+                logger.warning(f"Could not publish room for user {owner_id}: {e}")
+        return room
+
+    async def _shared_get(self, key: str) -> Optional[bytes]:
+        try:
+            return await self.shared.get(key)
+        except SharedStateError as e:
+            logger.warning(f"Could not load shared room state: {e}")
+            return None
+
+    async def get(self, token: str) -> Optional[Room]:
+        room = self._rooms.get(token)
+        if room is None and self.shared is not None:
+            data = await self._shared_get(f"room:{token}")
+            if data is not None:
+                room = self._rooms[token] = Room(**json.loads(data))
+        if room is None:
+            return None
+        if room.expires_at <= time.time():
+            self._forget(room)
+            return None
+        return room
+
+    async def is_open(self, room: Room) -> bool:
+        """Whether a viewer's stream may go on: the room is neither closed nor expired."""
+        if self._rooms.get(room.token) is not room:
+            return False
+        if self.shared is not None:
+            now = time.monotonic()
+            if now - self._checked_at.get(room.token, 0.0) >= self.check_interval:
+                # Set before the read so the room's other viewers don't all check at once
+                self._checked_at[room.token] = now
+                try:
+                    data = await self.shared.get(f"room:{room.token}")
+                except SharedStateError as e:
+                    # Keep the room through a shared state outage
+                    logger.warning(f"Could not check shared room state: {e}")
+                else:
+                    if data is None:
+                        # Closed through another worker
+                        self._forget(room)
+                        return False
+                    # The owner may have extended it through another worker
+                    room.expires_at = max(room.expires_at, Room(**json.loads(data)).expires_at)
+        if room.expires_at <= time.time():
+            self._forget(room)
+            return False
+        return True
+
+    async def close_owner(self, owner_id: str):
+        """Close the owner's room, if they have one, e.g. when they log out."""
+        token = self._by_owner.get(owner_id)
+        if token is None and self.shared is not None:
+            token = await self._shared_get(f"room_of:{owner_id}")
+        room = await self.get(token.decode() if isinstance(token, bytes) else token) if token else None
+        if room is not None:
+            await self.close(room)
+
+    async def close(self, room: Room):
+        self._forget(room)
+        if self.shared is not None:
+            try:
+                await self.shared.delete(f"room:{room.token}")
+                await self.shared.delete(f"room_of:{room.owner_id}")
+            except SharedStateError as e:
+                logger.warning(f"Could not remove shared room: {e}")
+
+    def _forget(self, room: Room):
+        self._rooms.pop(room.token, None)
+        self._checked_at.pop(room.token, None)
+        if self._by_owner.get(room.owner_id) == room.token:
+            del self._by_owner[room.owner_id]
+
+    def is_full(self, token: str) -> bool:
+        return self._viewers.get(token, 0) >= self.max_viewers
+
+    def join(self, token: str) -> bool:
+        """Count a viewer in, unless the room is full. Check and count happen together."""
+        viewers = self._viewers.get(token, 0)
+        if viewers >= self.max_viewers:
+            return False
+        self._viewers[token] = viewers + 1
+        return True
+
+    def leave(self, token: str):
+        remaining = self._viewers.get(token, 0) - 1
+        if remaining > 0:
+            self._viewers[token] = remaining
+        else:
+            self._viewers.pop(token, None)
+
+    def viewers(self, token: Optional[str] = None) -> int:
+        if token is not None:
+            return self._viewers.get(token, 0)
+        return sum(self._viewers.values())
+
+
+_room_registry_instance: Optional[RoomRegistry] = None
+
+def set_room_registry_instance(registry: RoomRegistry):
+    global _room_registry_instance
+    _room_registry_instance = registry
+
+def get_room_registry() -> RoomRegistry:
+    if _room_registry_instance is None:
+        raise RuntimeError("RoomRegistry has not been initialized. "
+                           "Ensure set_room_registry_instance is called during app startup.")
+    return _room_registry_instance
@@ -0,0 +1,60 @@
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from app.core.models import PlaybackSnapshot
+
+
+class PollScheduler:
+    """Picks each user's next upstream poll from the predicted end of the current track.
+
+    Mid-track we poll rarely, around a track boundary we poll right after the predicted
+    end, and paused or idle (204) playback backs off further.
+    """
+
+    def __init__(self,
+                 min_interval: float = 1.0,
+                 max_interval: float = 20.0,
+                 boundary_margin: float = 0.5,
+                 paused_interval: float = 15.0,
+                 idle_interval: float = 30.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.boundary_margin = boundary_margin
+        self.paused_interval = paused_interval
+        self.idle_interval = idle_interval
+        self._schedule: Dict[str, Tuple[float, float, str]] = {}
+
+    def next_delay(self, playback: Optional[PlaybackSnapshot]) -> Tuple[float, str]:
+        if playback is None:
+            return self.idle_interval, "idle"
+        if not playback.is_playing:
+            return self.paused_interval, "paused"
+
+        remaining = (playback.duration_ms - playback.progress_ms) / 1000
+        if remaining + self.boundary_margin <= self.max_interval:
+            # Land the poll just after the predicted track end
+            return max(self.min_interval, remaining + self.boundary_margin), "boundary"
+        return self.max_interval, "mid-track"
+
+    def schedule(self, user_id: str, playback: Optional[PlaybackSnapshot]) -> float:
+        delay, reason = self.next_delay(playback)
+        self._schedule[user_id] = (time.time() + delay, delay, reason)
+        return delay
+
+    def forget(self, user_id: str):
+        self._schedule.pop(user_id, None)
+
+    def next_poll(self, user_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._schedule.get(user_id)
+        if entry is None:
+            return None
+        next_poll_at, delay, reason = entry
+        return {
+            "next_poll_at": next_poll_at,
+            "next_poll_in": max(0.0, next_poll_at - time.time()),
+            "delay": delay,
+            "reason": reason,
+        }
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {user_id: self.next_poll(user_id) for user_id in self._schedule}
@@ -0,0 +1,332 @@
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from app.core.models import PlaybackSnapshot, dump_snapshot, load_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class SharedStateError(Exception):
+    pass
+
+
+class SharedState:
+    """Key/value store with expiry and leases, shared by every worker that points at it.
+
+    This in-process version only shares state within one worker; it is what runs
+    when no SHARED_STATE_URL is configured.
+    """
+    name = "memory"
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    def _live(self, key: str) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._values[key]
+            return None
+        return value
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._live(key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+
+    async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        """Take the lease if it is free, or extend it if `owner` already holds it."""
+        holder = self._live(key)
+        if holder is not None and holder != owner.encode():
+            return False
+        await self.set(key, owner.encode(), ttl)
+        return True
+
+    async def release_lease(self, key: str, owner: str):
+        if self._live(key) == owner.encode():
+            await self.delete(key)
+
+    async def close(self):
+        pass
+
+
+class RedisSharedState(SharedState):
+    """SharedState over the Redis protocol (RESP), spoken directly on asyncio streams.
+
+    Lease renewal and release are a GET followed by PEXPIRE/DEL rather than a Lua
+    script, so servers without scripting work too. The worst case of that race is a
+    lease briefly held by two workers, i.e. one duplicate upstream poll.
+    """
+    name = "redis"
+
+    def __init__(self, url: str, pool_size: int = 8, timeout: float = 2.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.username = unquote(parts.username) if parts.username else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        connection = (reader, writer)
+        try:
+            if self.password:
+                auth = (self.username, self.password) if self.username else (self.password,)
+                await self._roundtrip(connection, "AUTH", *auth)
+            if self.db:
+                await self._roundtrip(connection, "SELECT", self.db)
+        except BaseException:
+            writer.close()
+            raise
+        return connection
+
+    async def execute(self, *args: Any) -> Any:
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            try:
+                if connection is None:
+                    connection = await asyncio.wait_for(self._connect(), timeout=self.timeout)
+                reply = await asyncio.wait_for(self._roundtrip(connection, *args), timeout=self.timeout)
+            except SharedStateError:
+                # An error reply was read completely, the connection is still in sync
+                if connection is not None:
+                    self._idle.append(connection)
+                raise
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                # The connection may be half-way through a reply, never reuse it
+                if connection is not None:
+                    connection[1].close()
+                raise SharedStateError(f"Shared state {args[0]} failed: {e!r}") from e
+            except BaseException:
+                if connection is not None:
+                    connection[1].close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    async def _roundtrip(self, connection, *args: Any) -> Any:
+        reader, writer = connection
+        writer.write(encode_command(args))
+        await writer.drain()
+        reply = await read_reply(reader)
+        if isinstance(reply, SharedStateError):
+            raise reply
+        return reply
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute("GET", key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        if ttl:
+            await self.execute("SET", key, value, "PX", max(1, int(ttl * 1000)))
+        else:
+            await self.execute("SET", key, value)
+
+    async def delete(self, key: str):
+        await self.execute("DEL", key)
+
+    async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        ttl_ms = max(1, int(ttl * 1000))
+        if await self.execute("SET", key, owner, "NX", "PX", ttl_ms) == b"OK":
+            return True
+        if await self.execute("GET", key) == owner.encode():
+            await self.execute("PEXPIRE", key, ttl_ms)
+            return True
+        return False
+
+    async def release_lease(self, key: str, owner: str):
+        if await self.execute("GET", key) == owner.encode():
+            await self.execute("DEL", key)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+
+def encode_command(args) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        else:
+            data = str(arg).encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    """Read one RESP2 reply. Error replies are returned (not raised) so arrays stay in sync."""
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        return SharedStateError(rest.decode(errors="replace"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(rest)
+        if count == -1:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise ConnectionError(f"Unexpected reply from shared state: {line!r}")
+
+
+def build_shared_state(url: Optional[str]) -> SharedState:
+    if url and url.startswith("redis://"):
+        return RedisSharedState(url)
+    if url:
+        raise ValueError(f"Unsupported SHARED_STATE_URL scheme: {url}")
+    return SharedState()
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class SharedPlayback:
+    """Playback snapshots shared between workers, with one polling worker per user.
+
+    A fresh shared snapshot is used as is. Otherwise only the worker holding the
+    user's lease goes upstream and publishes the result; the others serve the last
+    shared snapshot, with progress advanced by its age, until the leader's next write.
+    Leases lapse after `lease_ttl` without a poll, so leadership follows demand.
+    An invalidated snapshot (after a player command) is never served by followers:
+    the first worker to read it fetches upstream once and publishes the result, since
+    the leader won't poll again until its own schedule says so.
+    Shared state outages fall back to polling upstream directly.
+    """
+
+    def __init__(self, state: SharedState, ttl: float = 1.0, lease_ttl: float = 5.0,
+                 snapshot_ttl: float = 3600.0, owner: Optional[str] = None):
+        self.state = state
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self.snapshot_ttl = snapshot_ttl
+        self.owner = owner or worker_id()
+        self._polled_at: Dict[str, float] = {}
+        self.shared_hits = 0
+        self.follower_reads = 0
+        self.invalidated_fetches = 0
+        self.upstream_fetches = 0
+        self.errors = 0
+
+    async def fetch(self, user_id: str,
+                    fetch_upstream: Callable[[], Awaitable[Optional[PlaybackSnapshot]]]) -> Optional[PlaybackSnapshot]:
+        try:
+            entry = await self._read(user_id)
+            invalidated = entry is not None and entry[2]
+            if entry is not None and not invalidated and time.time() - entry[0] < self.ttl:
+                self.shared_hits += 1
+                return advance(entry[0], entry[1])
+            leader = await self.state.acquire_lease(f"lease:playback:{user_id}", self.owner, self.lease_ttl)
+            if not leader and not invalidated:
+                if entry is None:
+                    # Nothing published yet and another worker is polling: give it a moment
+                    entry = await self._wait_for_leader(user_id)
+                if entry is not None:
+                    self.follower_reads += 1
+                    return advance(entry[0], entry[1])
+        except SharedStateError as e:
+            self.errors += 1
+            logger.warning(f"Shared playback state unavailable, polling upstream directly: {e}")
+            return await fetch_upstream()
+
+        snapshot = await fetch_upstream()
+        self.upstream_fetches += 1
+        if leader:
+            self._polled_at[user_id] = time.monotonic()
+        else:
+            # Refetched after an invalidation without taking over the lease, so listeners
+            # gated on is_leader (history, prefetch) still run on the leader only
+            self.invalidated_fetches += 1
+        try:
+            await self._write(user_id, time.time(), snapshot)
+        except SharedStateError as e:
+            self.errors += 1
+            logger.warning(f"Could not publish playback for user {user_id}: {e}")
+        return snapshot
+
+    def is_leader(self, user_id: str) -> bool:
+        """Whether this worker polled the user within the lease, i.e. still holds it."""
+        polled_at = self._polled_at.get(user_id)
+        if polled_at is None:
+            return False
+        if time.monotonic() - polled_at >= self.lease_ttl:
+            del self._polled_at[user_id]
+            return False
+        return True
+
+    async def invalidate(self, user_id: str):
+        """Make every worker refetch, e.g. after a player command. Keeps the snapshot as a fallback."""
+        try:
+            entry = await self._read(user_id)
+            if entry is not None:
+                await self._write(user_id, entry[0], entry[1], invalidated=True)
+        except SharedStateError as e:
+            self.errors += 1
+            logger.warning(f"Could not invalidate shared playback for user {user_id}: {e}")
+
+    async def _wait_for_leader(self, user_id: str, attempts: int = 10, interval: float = 0.05):
+        for _ in range(attempts):
+            await asyncio.sleep(interval)
+            entry = await self._read(user_id)
+            if entry is not None and not entry[2]:
+                return entry
+        return None
+
+    async def _read(self, user_id: str) -> Optional[Tuple[float, Optional[PlaybackSnapshot], bool]]:
+        """(stored_at, snapshot, invalidated) as last published for the user."""
+        data = await self.state.get(f"playback:{user_id}")
+        if data is None:
+            return None
+        stored_at, fields, invalidated = json.loads(data)
+        return stored_at, load_snapshot(fields) if fields is not None else None, invalidated
+
+    async def _write(self, user_id: str, stored_at: float, snapshot: Optional[PlaybackSnapshot],
+                     invalidated: bool = False):
+        fields = dump_snapshot(snapshot) if snapshot is not None else None
+        await self.state.set(f"playback:{user_id}", json.dumps([stored_at, fields, invalidated]).encode(),
+                             self.snapshot_ttl)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "shared_hits": self.shared_hits,
+            "follower_reads": self.follower_reads,
+            "invalidated_fetches": self.invalidated_fetches,
+            "upstream_fetches": self.upstream_fetches,
+            "errors": self.errors,
+        }
+
+
+def advance(stored_at: float, snapshot: Optional[PlaybackSnapshot]) -> Optional[PlaybackSnapshot]:
+    """A shared snapshot with progress moved on by its age, as if it had just been fetched."""
+    if snapshot is None or not snapshot.is_playing:
+        return snapshot
+    elapsed_ms = int((time.time() - stored_at) * 1000)
+    return dataclasses.replace(snapshot, progress_ms=min(snapshot.progress_ms + elapsed_ms, snapshot.duration_ms))
@@ -1,36 +1,120 @@
-import os, httpx
+import dataclasses
+import httpx
+import importlib.util
+import time
 from urllib.parse import urlencode
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+from app.core.breaker import CircuitBreakers, UpstreamOverloadedError, UpstreamUnavailableError
+from app.core.cache import PlaybackCache
+from app.core.metrics import upstream_endpoint, upstream_latency
+from app.core.models import PlaybackSnapshot, parse_playback, parse_images, parse_queue
+from app.core.ratelimit import Priority, RateLimiter, RateLimitedError, parse_retry_after
+from app.core.shared import SharedPlayback
 
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
+SPOTIFY_ACCOUNTS_URL = "https://accounts.spotify.com"
+SPOTIFY_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+SPOTIFY_AUTH_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
 SPOTIFY_SCOPES = "user-read-currently-playing user-read-playback-state user-modify-playback-state"
 SPOTIFY_BASE_URL = "https://api.spotify.com/v1"
 SPOTIFY_ME_URL = f"{SPOTIFY_BASE_URL}/me"
 SPOTIFY_PLAYER_URL = f"{SPOTIFY_ME_URL}/player"
 
 
-SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
-SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
-SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
-
-
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:%(message)s')
 logger = logging.getLogger(__name__)
 
+def advance_cached(stored_at: float, snapshot: Optional[PlaybackSnapshot],
+                   stale: bool = False) -> Optional[PlaybackSnapshot]:
+    """A cached snapshot with progress moved on by its age (stored_at is monotonic)."""
+    if snapshot is None:
+        return None
+    progress_ms = snapshot.progress_ms
+    # Invalidated entries are stored at -inf, their age is unknown. Only mark_stale sees them:
+    # refreshes wait for the fetch instead of reading an invalidated entry
+    if snapshot.is_playing and stored_at > float("-inf"):
+        progress_ms = min(progress_ms + int((time.monotonic() - stored_at) * 1000), snapshot.duration_ms)
+    return dataclasses.replace(snapshot, progress_ms=progress_ms, stale=stale)
+
+
+def mark_stale(stored_at: float, snapshot: Optional[PlaybackSnapshot]) -> Optional[PlaybackSnapshot]:
+    """A cached snapshot flagged as stale: Spotify is rate limiting, failing or not being called."""
+    return advance_cached(stored_at, snapshot, stale=True)
+
+
 class SpotifyApi:
-        def __init__(self, client_id: str, client_secret: str, redicrect_uri: str):
+        def __init__(self,
+                     client_id: str,
+                     client_secret: str,
+                     redicrect_uri: str,
+                     http2: bool = True,
+                     max_connections: int = 100,
+                     max_keepalive_connections: int = 20,
+                     keepalive_expiry: float = 30.0,
+                     timeout: float = 10.0,
+                     connect_timeout: float = 5.0,
+                     playback_cache_ttl: float = 1.0,
+                     playback_cache_size: int = 1024,
+                     rate_limit: float = 10.0,
+                     rate_limit_burst: int = 20,
+                     accounts_url: str = SPOTIFY_ACCOUNTS_URL,
+                     base_api_url: str = SPOTIFY_BASE_URL,
+                     shared_playback: Optional[SharedPlayback] = None,
+                     api_timeout: float = 3.0,
+                     max_in_flight: int = 64,
+                     breaker_threshold: int = 5,
+                     breaker_reset: float = 10.0):
             self.client_id = client_id
             self.client_secret = client_secret
             self.redirect_uri = redicrect_uri
             self.scopes = SPOTIFY_SCOPES
-            self.auth_url = SPOTIFY_AUTH_URL
-            self.token_url = SPOTIFY_TOKEN_URL
-            self.base_api_url = SPOTIFY_BASE_URL
+            self.auth_url = f"{accounts_url}/authorize"
+            self.token_url = f"{accounts_url}/api/token"
+            self.base_api_url = base_api_url
             self.me_url = f"{self.base_api_url}/me"
             self.player_url = f"{self.me_url}/player"
 
+            # HTTP/2 needs the optional `h2` package (installed via httpx[http2])
+            if http2 and importlib.util.find_spec("h2") is None:
+                logger.warning("h2 is not installed, falling back to HTTP/1.1 keep-alive for Spotify requests")
+                http2 = False
+            self.http2 = http2
+            self.limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            )
+            self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+            # Web API calls get a tighter budget than token exchanges, a slow Spotify shouldn't hold routes
+            self.api_timeout = httpx.Timeout(api_timeout, connect=min(connect_timeout, api_timeout))
+            self._client: Optional[httpx.AsyncClient] = None
+            self.playback_cache = PlaybackCache(ttl=playback_cache_ttl, max_entries=playback_cache_size)
+            self.rate_limiter = RateLimiter(rate=rate_limit, burst=rate_limit_burst)
+            self.in_flight = 0
+            self.max_in_flight = max_in_flight
+            self.shed = 0
+            self.stale_served = 0
+            self.breakers = CircuitBreakers(failure_threshold=breaker_threshold, reset_timeout=breaker_reset)
+            # Set when several workers share snapshots, so only one of them polls each user
+            self.shared_playback = shared_playback
+
+        async def start(self):
+            """Open the shared upstream client. Called once from the app lifespan."""
+            if self._client is None:
+                self._client = httpx.AsyncClient(http2=self.http2, limits=self.limits, timeout=self.timeout)
+
+        async def aclose(self):
+            if self._client is not None:
+                await self._client.aclose()
+                self._client = None
+
+        @property
+        def client(self) -> httpx.AsyncClient:
+            if self._client is None:
+                raise RuntimeError("SpotifyApi has not been started. "
+                                   "Ensure start() is awaited in the app lifespan.")
+            return self._client
+
         def get_auth_url(self):
             params = {
                 "client_id": self.client_id,
@@ -48,37 +132,86 @@ class SpotifyApi:
                                 access_token: Optional[str] = None,
                                 data: Optional[Dict[str, Any]] = None,
                                 headers: Optional[Dict[str, str]] = None,
-                                content_type: str = "application/json") -> httpx.Response:
-            
+                                content_type: str = "application/json",
+                                priority: Optional[Priority] = Priority.PAGE,
+                                endpoint: Optional[str] = None) -> httpx.Response:
+            """Send a request upstream. Web API calls go through the app-wide rate limiter;
+            pass priority=None for accounts calls, which Spotify limits separately.
+            `endpoint` is the metrics and circuit breaker label, defaulting to the URL path.
+
+            Fails fast with UpstreamUnavailableError while the endpoint's circuit is open, or
+            when max_in_flight requests are already waiting on Spotify (player commands excepted)."""
+            endpoint = endpoint or upstream_endpoint(url)
+            breaker = self.breakers.get(endpoint)
+            if priority is not Priority.COMMAND and self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                raise UpstreamOverloadedError(self.in_flight)
+            probe = breaker.before_call()
+            healthy = None
+            try:
+                if priority is not None:
+                    await self.rate_limiter.acquire(priority)
+                response = await self._send(method, url, access_token, data, headers, content_type,
+                                            self.timeout if priority is None else self.api_timeout, endpoint)
+                # Spotify answered; only server errors count against it
+                healthy = response.status_code < 500
+                return response
+            except httpx.HTTPStatusError as e:
+                healthy = e.response.status_code < 500
+                raise
+            except httpx.TransportError:
+                healthy = False
+                raise
+            finally:
+                breaker.after_call(healthy, probe)
+
+        async def _send(self, method: str, url: str, access_token: Optional[str], data: Optional[Dict[str, Any]],
+                        headers: Optional[Dict[str, str]], content_type: str, timeout: httpx.Timeout,
+                        endpoint: str) -> httpx.Response:
             req_headers = {"Content-Type": content_type}
             if access_token:
                 req_headers["Authorization"] = f"Bearer {access_token}"
             if headers:
                 req_headers.update(headers)
 
-            async with httpx.AsyncClient() as client:
-                try:
-                    if method == "GET":
-                        response = await client.get(url, headers=req_headers)
-                    elif method == "POST":
-                        response = await client.post(url, headers=req_headers, data=data)
-                    elif method == "PUT":
-                        # For PUT requests, Spotify often expects a JSON body, not form-urlencoded
-                        response = await client.put(url, headers=req_headers, json=data)
-                    else:
-                        raise ValueError(f"Unsupported HTTP method: {method}")
-
-                    response.raise_for_status() # Raise for 4xx/5xx status codes
-                    return response
-                except httpx.HTTPStatusError as e:
-                    logger.error(f"HTTP error for {url}: {e.response.status_code} - {e.response.text}")
-                    raise
-                except httpx.RequestError as e:
-                    logger.error(f"Network error for {url}: {e}")
-                    raise
-                except Exception as e:
-                    logger.error(f"An unexpected error occurred during API request to {url}: {e}")
-                    raise
+            client = self.client
+            status = "error"
+            started = time.perf_counter()
+            self.in_flight += 1
+            try:
+                if method == "GET":
+                    response = await client.get(url, headers=req_headers, timeout=timeout)
+                elif method == "POST":
+                    response = await client.post(url, headers=req_headers, data=data, timeout=timeout)
+                elif method == "PUT":
+                    # For PUT requests, Spotify often expects a JSON body, not form-urlencoded
+                    response = await client.put(url, headers=req_headers, json=data, timeout=timeout)
+                else:
+                    raise ValueError(f"Unsupported HTTP method: {method}")
+                status = str(response.status_code)
+
+                if response.status_code == 429:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    self.rate_limiter.pause(retry_after)
+                    raise RateLimitedError(retry_after)
+
+                response.raise_for_status() # Raise for 4xx/5xx status codes
+                return response
+            except RateLimitedError:
+                raise
+            except httpx.HTTPStatusError as e:
+                logger.error(f"HTTP error for {url}: {e.response.status_code} - {e.response.text}")
+                raise
+            except httpx.RequestError as e:
+                logger.error(f"Network error for {url}: {e}")
+                raise
+            except Exception as e:
+                logger.error(f"An unexpected error occurred during API request to {url}: {e}")
+                raise
+            finally:
+                self.in_flight -= 1
+                upstream_latency.observe(time.perf_counter() - started, method, endpoint, status)
+
         async def exchange_code_for_token(self, code: str) -> Dict[str, Any]:
             data = {
                 "grant_type": "authorization_code",
@@ -91,7 +224,8 @@ class SpotifyApi:
                 "POST",
                 self.token_url,
                 data=data,
-                content_type="application/x-www-form-urlencoded"
+                content_type="application/x-www-form-urlencoded",
+                priority=None
             )
             return response.json()
 
@@ -106,7 +240,8 @@ class SpotifyApi:
                 "POST",
                 self.token_url,
                 data=data,
-                content_type="application/x-www-form-urlencoded"
+                content_type="application/x-www-form-urlencoded",
+                priority=None
             )
             return response.json()
 
@@ -114,21 +249,65 @@ class SpotifyApi:
             response = await self._make_api_request("GET", self.me_url, access_token=access_token)
             return response.json()
 
-        async def get_current_playback(self, access_token: str) -> Optional[Dict[str, Any]]:
-            url = f"{self.player_url}/currently-playing"
+        async def get_current_playback(self,
+                                       access_token: str,
+                                       user_id: Optional[str] = None,
+                                       priority: Priority = Priority.PAGE) -> Optional[PlaybackSnapshot]:
+            """Currently-playing payload. With a user_id the result is served from the per-user
+            snapshot cache. While a refresh is already in flight the last cached snapshot is returned
+            as is; when Spotify is rate limiting, failing or its circuit is open it is marked stale."""
+            if user_id is None:
+                return await self._fetch_current_playback(access_token, priority)
+
+            def fetch():
+                upstream = lambda: self._fetch_current_playback(access_token, priority)
+                if self.shared_playback is None:
+                    return upstream()
+                return self.shared_playback.fetch(user_id, upstream)
+
             try:
-                response = await self._make_api_request("GET", url, access_token=access_token)
-                return response.json()
-            except httpx.HTTPStatusError as e:
-                if e.response.status_code == 204: # No content, nothing is playing
-                    return None
-                raise # Re-raise other HTTP errors
+                return await self.playback_cache.get_or_fetch(user_id, fetch, on_refresh=advance_cached)
+            except (RateLimitedError, UpstreamUnavailableError, httpx.TransportError, httpx.HTTPStatusError) as e:
+                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                    raise
+                entry = self.playback_cache.get(user_id)
+                if entry is None:
+                    raise
+                self.stale_served += 1
+                return mark_stale(*entry)
+
+        async def _fetch_current_playback(self, access_token: str, priority: Priority = Priority.PAGE) -> Optional[PlaybackSnapshot]:
+            url = f"{self.player_url}/currently-playing"
+            response = await self._make_api_request("GET", url, access_token=access_token, priority=priority)
+            if response.status_code == 204: # No content, nothing is playing
+                return None
+            return parse_playback(response.content)
+
+        async def get_queue(self, access_token: str,
+                            priority: Priority = Priority.BACKGROUND) -> Tuple[PlaybackSnapshot, ...]:
+            """Upcoming tracks in the user's queue, next first. Needs user-read-playback-state."""
+            response = await self._make_api_request("GET", f"{self.player_url}/queue",
+                                                    access_token=access_token, priority=priority)
+            if response.status_code == 204:
+                return ()
+            return parse_queue(response.content)
+
+        async def invalidate_playback(self, user_id: str):
+            """Force the next read for this user to refetch, in every worker."""
+            self.playback_cache.invalidate(user_id)
+            if self.shared_playback is not None:
+                await self.shared_playback.invalidate(user_id)
+
+        async def get_album_images(self, access_token: str, album_id: str) -> Tuple[Tuple[int, str], ...]:
+            response = await self._make_api_request("GET", f"{self.base_api_url}/albums/{album_id}",
+                                                    access_token=access_token, endpoint="/v1/albums/{id}")
+            return parse_images(response.json().get("images") or ())
 
         async def play(self, access_token: str, device_id: Optional[str] = None) -> bool:
             url = f"{self.player_url}/play"
             data = {"device_ids": [device_id]} if device_id else None # Spotify expects device_ids as a list
             try:
-                response = await self._make_api_request("PUT", url, access_token=access_token, data=data)
+                response = await self._make_api_request("PUT", url, access_token=access_token, data=data, priority=Priority.COMMAND)
                 # Spotify returns 204 No Content for successful playback control
                 return response.status_code in (204, 202, 200)
             except httpx.HTTPStatusError as e:
@@ -141,7 +320,7 @@ class SpotifyApi:
         async def pause(self, access_token: str) -> bool:
             url = f"{self.player_url}/pause"
             try:
-                response = await self._make_api_request("PUT", url, access_token=access_token)
+                response = await self._make_api_request("PUT", url, access_token=access_token, priority=Priority.COMMAND)
                 return response.status_code in (204, 202, 200)
             except httpx.HTTPStatusError as e:
                 logger.error(f"Failed to pause Spotify: {e.response.status_code} - {e.response.text}")
@@ -154,7 +333,7 @@ class SpotifyApi:
             url = f"{self.player_url}/next"
             try:
                 # Spotify API for next/previous uses POST, but without a body
-                response = await self._make_api_request("POST", url, access_token=access_token)
+                response = await self._make_api_request("POST", url, access_token=access_token, priority=Priority.COMMAND)
                 return response.status_code in (204, 202, 200)
             except httpx.HTTPStatusError as e:
                 logger.error(f"Failed to skip to next track: {e.response.status_code} - {e.response.text}")
@@ -167,7 +346,7 @@ class SpotifyApi:
             url = f"{self.player_url}/previous"
             try:
                 # Spotify API for next/previous uses POST, but without a body
-                response = await self._make_api_request("POST", url, access_token=access_token)
+                response = await self._make_api_request("POST", url, access_token=access_token, priority=Priority.COMMAND)
                 return response.status_code in (204, 202, 200)
             except httpx.HTTPStatusError as e:
                 logger.error(f"Failed to skip to previous track: {e.response.status_code} - {e.response.text}")
@@ -175,119 +354,8 @@ class SpotifyApi:
             except Exception as e:
                 logger.error(f"An unexpected error occurred during Spotify previous track: {e}")
                 return False
-        
-
-
-            
 
-def get_spotify_auth_url():
-    params = {
-        "client_id": SPOTIFY_CLIENT_ID,
-        "response_type": "code",
-        "redirect_uri": SPOTIFY_REDIRECT_URI,
-        "scope": SPOTIFY_SCOPES,
-        "show_dialog": "true"
-    }
-    return f"{SPOTIFY_AUTH_URL}?{urlencode(params)}"
 
-async def exchange_code_for_token(code: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            SPOTIFY_TOKEN_URL,
-            data={
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": SPOTIFY_REDIRECT_URI,
-                "client_id": SPOTIFY_CLIENT_ID,
-                "client_secret": SPOTIFY_CLIENT_SECRET,
-            },
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-        response.raise_for_status()
-        return response.json()
-
-async def get_spotify_user(access_token: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            SPOTIFY_ME_URL,
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
-        response.raise_for_status()
-        return response.json()
-    
-async def refresh_access_token(refresh_token: str) -> dict:
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            SPOTIFY_TOKEN_URL,
-            data={
-                "grant_type": "refresh_token",
-                "refresh_token": refresh_token,
-                "client_id": SPOTIFY_CLIENT_ID,
-                "client_secret": SPOTIFY_CLIENT_SECRET,
-            },
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-        response.raise_for_status()
-        return response.json()
-    
-async def get_current_playback(access_token: str) -> dict | None:
-    url = f"{SPOTIFY_PLAYER_URL}/currently-playing"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        if response.status_code == 204:  # No content, nothing is playing
-            return None
-        
-        response.raise_for_status()
-        return response.json()
-    
-async def spotify_play(access_token: str) -> bool:
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{SPOTIFY_PLAYER_URL}/play", headers=headers)
-        if response.status_code in (204, 202, 200):
-            return True
-        logging.error(f"spotify_play failed: {response.status_code} {response.text}")
-        return False
-
-async def spotify_pause(access_token: str) -> bool:
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
-    async with httpx.AsyncClient() as client:
-        print('pause!!')
-        print(f"{SPOTIFY_PLAYER_URL}/pause")
-        response = await client.put(f"{SPOTIFY_PLAYER_URL}/pause", headers=headers)
-        if response.status_code in (204, 202, 200):
-            return True
-        logging.error(f"spotify_pause failed: {response.status_code} {response.text}")
-        return False
-
-async def spotify_next(access_token: str) -> bool:
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{SPOTIFY_PLAYER_URL}/next", headers=headers)
-        if response.status_code in (204, 202, 200):
-            return True
-        logging.error(f"spotify_next failed: {response.status_code} {response.text}")
-        return False
-
-async def spotify_previous(access_token: str) -> bool:
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{SPOTIFY_PLAYER_URL}/previous", headers=headers)
-        if response.status_code in (204, 202, 200):
-            return True
-        logging.error(f"spotify_previous failed: {response.status_code} {response.text}")
-        return False
-    
 _spotify_client_instance: Optional[SpotifyApi] = None
 
 def set_spotify_client_instance(client: SpotifyApi):
@@ -0,0 +1,337 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+from app.core.models import PlaybackSnapshot
+from app.core.breaker import UpstreamUnavailableError
+from app.core.ratelimit import Priority, RateLimitedError
+from app.core.scheduler import PollScheduler
+from app.core.spotify import SpotifyApi
+from app.core.fragments import get_fragment_cache
+from app.core.tokens import NotAuthenticatedError, TokenStore
+
+logger = logging.getLogger(__name__)
+
+class Subscriber:
+    """A single stream connection. Holds only the latest undelivered progress, track and status events.
+
+    Events arrive already formatted, so broadcasting to many subscribers encodes each one once.
+    `ended` is set when the poller stops for good, e.g. the user's tokens were removed.
+    """
+    __slots__ = ("progress_event", "track_event", "status_event", "event", "ended")
+
+    def __init__(self):
+        self.progress_event: Optional[str] = None
+        self.track_event: Optional[str] = None
+        self.status_event: Optional[str] = None
+        self.event = asyncio.Event()
+        self.ended = False
+
+    def end(self):
+        self.ended = True
+        self.event.set()
+
+    def push(self, progress_event: str, track_event: Optional[str] = None):
+        self.progress_event = progress_event
+        if track_event is not None:
+            self.track_event = track_event
+        self.event.set()
+
+    def push_status(self, status_event: str):
+        self.status_event = status_event
+        self.event.set()
+
+
+class StateSubscriber(Subscriber):
+    """A /ws/player connection. It is sent diffs of the poller's state rather than events,
+    so it only needs to know that something changed.
+
+    `status` is a status line for this connection alone, e.g. a command's optimistic reply.
+    """
+    __slots__ = ("status",)
+
+    def __init__(self):
+        super().__init__()
+        self.status: Optional[str] = None
+
+    def push(self, progress_event: str, track_event: Optional[str] = None):
+        self.event.set()
+
+    def push_status(self, status_event: str):
+        self.event.set()
+
+    def reply(self, status: str):
+        self.status = status
+        self.event.set()
+
+
+class UserPoller:
+    """One upstream poller per user that feeds all of that user's stream connections.
+
+    Upstream polls are timed by the PollScheduler; in between, progress ticks are
+    interpolated locally from the last snapshot. When the user's tokens are gone (logout,
+    revoked refresh token) the poller stops and ends its subscribers' streams.
+    """
+
+    def __init__(self, spotify_client: SpotifyApi, token_store: TokenStore, scheduler: PollScheduler,
+                 user_id: str, tick_interval: float):
+        self.spotify_client = spotify_client
+        self.token_store = token_store
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.tick_interval = tick_interval
+        self.subscribers: Set[Subscriber] = set()
+        self.playback: Optional[PlaybackSnapshot] = None
+        self.fetched_at = 0.0
+        self.track_id: Optional[str] = None
+        self.track_event: Optional[str] = None
+        self.track_html: Optional[str] = None
+        self.progress: Optional[Dict[str, Any]] = None
+        self.progress_event: Optional[str] = None
+        # Latest status pushed to every connection, numbered so state diffs can tell it's new
+        self.status_html: Optional[str] = None
+        self.status_seq = 0
+        self.wake_event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.ended = False
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def wake(self):
+        """Poll upstream right away, e.g. after a player command changed the state."""
+        self.wake_event.set()
+
+    async def _run(self):
+        next_poll = 0.0
+        while True:
+            # Tokens removed on this worker (logout, revoked refresh token) between polls
+            if self.fetched_at and not self.token_store.has_tokens(self.user_id):
+                self.end(f"no tokens stored for user {self.user_id}")
+                return
+            if time.monotonic() >= next_poll or self.wake_event.is_set():
+                self.wake_event.clear()
+                try:
+                    access_token = await self.token_store.get_access_token(self.user_id)
+                    self.playback = await self.spotify_client.get_current_playback(
+                        access_token, user_id=self.user_id, priority=Priority.BACKGROUND)
+                    self.fetched_at = time.monotonic()
+                    self.publish()
+                    delay = self.scheduler.schedule(self.user_id, self.playback)
+                except asyncio.CancelledError:
+                    raise
+                except NotAuthenticatedError as e:
+                    self.end(str(e))
+                    return
+                except (RateLimitedError, UpstreamUnavailableError) as e:
+                    delay = max(e.retry_after, self.tick_interval)
+                except Exception as e:
+                    logger.warning(f"Now-playing poll failed for user {self.user_id}: {e}")
+                    delay = self.tick_interval
+                next_poll = time.monotonic() + delay
+            elif self.playback and self.playback.is_playing:
+                self.publish()
+
+            timeout = min(self.tick_interval, max(0.0, next_poll - time.monotonic()))
+            try:
+                await asyncio.wait_for(self.wake_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def end(self, reason: str):
+        logger.info(f"Stopping now-playing poller for user {self.user_id}: {reason}")
+        self.ended = True
+        for subscriber in self.subscribers:
+            subscriber.end()
+
+    def current_progress_ms(self) -> int:
+        playback = self.playback
+        progress = playback.progress_ms
+        if playback.is_playing:
+            progress += int((time.monotonic() - self.fetched_at) * 1000)
+        return min(progress, playback.duration_ms)
+
+    def publish(self):
+        playback = self.playback
+        track_id = playback.track_id if playback else None
+        self.progress = {
+            "track_id": track_id,
+            "progress_ms": self.current_progress_ms() if playback else 0,
+            "duration_ms": playback.duration_ms if playback else 0,
+            "is_playing": playback.is_playing if playback else False,
+            "stale": playback.stale if playback else False,
+        }
+        self.progress_event = format_event("progress", json.dumps(self.progress))
+        track_event = None
+        if track_id != self.track_id or self.track_event is None:
+            self.track_id = track_id
+            self.track_html = render_track_info(playback)
+            track_event = self.track_event = format_event("track", self.track_html)
+        for subscriber in self.subscribers:
+            subscriber.push(self.progress_event, track_event)
+
+
+class StreamHub:
+    """Registry of per-user pollers. Pollers start with the first connection and stop with the last."""
+
+    def __init__(self, spotify_client: SpotifyApi, token_store: TokenStore, scheduler: PollScheduler,
+                 tick_interval: float = 3.0):
+        self.spotify_client = spotify_client
+        self.token_store = token_store
+        self.scheduler = scheduler
+        self.tick_interval = tick_interval
+        self.pollers: Dict[str, UserPoller] = {}
+
+    def subscribe(self, user_id: str, subscriber: Optional[Subscriber] = None) -> Subscriber:
+        poller = self.pollers.get(user_id)
+        if poller is None or poller.ended:
+            # An ended poller's user may have logged in again since
+            poller = self.pollers[user_id] = UserPoller(
+                self.spotify_client, self.token_store, self.scheduler, user_id, self.tick_interval)
+            poller.start()
+
+        if subscriber is None:
+            subscriber = Subscriber()
+        if poller.progress_event is not None:
+            subscriber.push(poller.progress_event, poller.track_event)
+        poller.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id: str, subscriber: Subscriber):
+        poller = self.pollers.get(user_id)
+        if poller is None or subscriber not in poller.subscribers:
+            return
+        poller.subscribers.discard(subscriber)
+        if not poller.subscribers:
+            del self.pollers[user_id]
+            self.scheduler.forget(user_id)
+            poller.task.cancel()
+
+    def wake(self, user_id: str):
+        poller = self.pollers.get(user_id)
+        if poller is not None:
+            poller.wake()
+
+    def push_status(self, user_id: str, status: str):
+        """Send a playback status line (e.g. a failed player command) to the user's streams."""
+        poller = self.pollers.get(user_id)
+        if poller is None:
+            return
+        poller.status_html = render_playback_status(status)
+        poller.status_seq += 1
+        status_event = format_event("status", poller.status_html)
+        for subscriber in poller.subscribers:
+            subscriber.push_status(status_event)
+
+    async def close(self):
+        pollers = list(self.pollers.values())
+        self.pollers.clear()
+        for poller in pollers:
+            poller.task.cancel()
+        await asyncio.gather(*(p.task for p in pollers), return_exceptions=True)
+
+
+def render_track_info(track: Optional[PlaybackSnapshot]) -> str:
+    return get_fragment_cache().track_info(track).decode()
+
+
+def render_playback_status(status: str) -> str:
+    return get_fragment_cache().playback_status(status).decode()
+
+
+def format_event(event: str, data: str) -> str:
+    lines = "\n".join(f"data: {line}" for line in data.splitlines() or [""])
+    return f"event: {event}\n{lines}\n\n"
+
+
+async def event_stream(hub: StreamHub, user_id: str, keepalive: float = 15.0) -> AsyncIterator[str]:
+    # Subscribe lazily so a response that never starts streaming can't leak a subscriber
+    subscriber = hub.subscribe(user_id)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.event.wait(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            subscriber.event.clear()
+            if subscriber.track_event is not None:
+                track_event, subscriber.track_event = subscriber.track_event, None
+                yield track_event
+            if subscriber.progress_event is not None:
+                progress_event, subscriber.progress_event = subscriber.progress_event, None
+                yield progress_event
+            if subscriber.status_event is not None:
+                status_event, subscriber.status_event = subscriber.status_event, None
+                yield status_event
+            if subscriber.ended:
+                return
+    finally:
+        hub.unsubscribe(user_id, subscriber)
+
+
+# Poller state fields sent to /ws/player clients, under one-letter keys
+STATE_KEYS = (("track_id", "t"), ("duration_ms", "d"), ("is_playing", "i"), ("stale", "x"))
+_UNSENT = object()
+
+
+async def state_stream(hub: StreamHub, user_id: str, subscriber: StateSubscriber,
+                       drift_ms: int = 1000) -> AsyncIterator[str]:
+    """Compact JSON diffs of the user's playback state, for a subscribed /ws/player connection.
+
+    Only changed fields are sent: "t" track id, with "h" its track info HTML, "d" duration,
+    "i" playing, "x" stale, "p" progress and "s" a status line. The client advances progress
+    itself while playing, so "p" is only sent when its estimate would be off by more than
+    `drift_ms`; a track playing through costs no messages until the next one starts.
+    Ends when the poller does.
+    """
+    poller = hub.pollers[user_id]
+    sent: Dict[str, Any] = {}
+    sent_at = 0.0
+    status_seq = poller.status_seq
+    while True:
+        await subscriber.event.wait()
+        subscriber.event.clear()
+        diff: Dict[str, Any] = {}
+
+        progress = poller.progress
+        if progress is not None:
+            now = time.monotonic()
+            expected = sent.get("p")
+            if expected is not None and sent.get("i"):
+                expected += int((now - sent_at) * 1000)
+            for key, short in STATE_KEYS:
+                if sent.get(short, _UNSENT) != progress[key]:
+                    diff[short] = sent[short] = progress[key]
+            if "t" in diff:
+                diff["h"] = poller.track_html
+            if diff or expected is None or abs(progress["progress_ms"] - expected) > drift_ms:
+                diff["p"] = sent["p"] = progress["progress_ms"]
+                sent_at = now
+
+        if subscriber.status is not None:
+            diff["s"], subscriber.status = subscriber.status, None
+            status_seq = poller.status_seq
+        elif poller.status_seq != status_seq:
+            diff["s"] = poller.status_html
+            status_seq = poller.status_seq
+
+        if diff:
+            yield json.dumps(diff, separators=(",", ":"))
+        if subscriber.ended:
+            return
+
+
+_stream_hub_instance: Optional[StreamHub] = None
+
+def set_stream_hub_instance(hub: StreamHub):
+    global _stream_hub_instance
+    _stream_hub_instance = hub
+
+def get_stream_hub() -> StreamHub:
+    if _stream_hub_instance is None:
+        raise RuntimeError("StreamHub has not been initialized. "
+                           "Ensure set_stream_hub_instance is called during app startup.")
+    return _stream_hub_instance
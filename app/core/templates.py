@@ -1,5 +1,40 @@
 import os
+import time
+from typing import Optional
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, Template
+
+from app.core.metrics import template_render
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
\ No newline at end of file
+
+
+class TimedTemplate(Template):
+    """Records render time per template; covers TemplateResponse and direct render() calls alike."""
+
+    def render(self, *args, **kwargs) -> str:
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            template_render.observe(time.perf_counter() - started, self.name or "<string>")
+
+
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+templates.env.template_class = TimedTemplate
+
+
+def configure_templates(bytecode_cache_dir: Optional[str] = None, auto_reload: bool = True):
+    """Persist compiled templates across restarts, and optionally skip the per-render mtime check."""
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        templates.env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+    templates.env.auto_reload = auto_reload
+
+
+def precompile_templates() -> int:
+    """Compile every template up front so the first requests don't pay for it."""
+    names = templates.env.list_templates(extensions=["html"])
+    for name in names:
+        templates.get_template(name)
+    return len(names)
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.core.shared import SharedState, SharedStateError
+from app.core.spotify import SpotifyApi
+
+logger = logging.getLogger(__name__)
+
+
+class NotAuthenticatedError(Exception):
+    pass
+
+
+@dataclass
+class TokenRecord:
+    access_token: str
+    refresh_token: Optional[str]
+    expires_at: float
+
+
+class TokenStore:
+    """Server-side OAuth tokens keyed by Spotify user id.
+
+    Refreshes are single-flight per user, and a background task renews tokens
+    before they expire so refresh latency stays off the request path. Users who
+    haven't used their token for `idle_timeout` seconds are left to refresh on
+    their next request instead. With a SharedState, tokens are also published
+    there so any worker can serve the user.
+    """
+
+    def __init__(self,
+                 spotify_client: SpotifyApi,
+                 refresh_margin: float = 60.0,
+                 renew_ahead: float = 300.0,
+                 renew_interval: float = 30.0,
+                 idle_timeout: float = 3600.0,
+                 shared: Optional[SharedState] = None,
+                 shared_ttl: float = 30 * 86400):
+        self.spotify_client = spotify_client
+        self.refresh_margin = refresh_margin
+        self.renew_ahead = renew_ahead
+        self.renew_interval = renew_interval
+        self.idle_timeout = idle_timeout
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self._tokens: Dict[str, TokenRecord] = {}
+        self._last_used: Dict[str, float] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._renewer: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._tokens
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def user_ids(self):
+        return list(self._tokens)
+
+    def set(self, user_id: str, tokens: Dict[str, Any]):
+        previous = self._tokens.get(user_id)
+        self._tokens[user_id] = TokenRecord(
+            access_token=tokens["access_token"],
+            # Spotify only sometimes rotates the refresh token
+            refresh_token=tokens.get("refresh_token") or (previous.refresh_token if previous else None),
+            expires_at=time.time() + tokens.get("expires_in", 3600),
+        )
+
+    async def save(self, user_id: str, tokens: Dict[str, Any]):
+        """set(), then publish the record to the other workers."""
+        self.set(user_id, tokens)
+        if self.shared is None:
+            return
+        try:
+            await self.shared.set(f"tokens:{user_id}", json.dumps(asdict(self._tokens[user_id])).encode(),
+                                  self.shared_ttl)
+        except SharedStateError as e:
+            logger.warning(f"Could not publish tokens for user {user_id}: {e}")
+
+    async def _load_shared(self, user_id: str) -> Optional[TokenRecord]:
+        if self.shared is None:
+            return None
+        try:
+            data = await self.shared.get(f"tokens:{user_id}")
+        except SharedStateError as e:
+            logger.warning(f"Could not load shared tokens for user {user_id}: {e}")
+            return None
+        return TokenRecord(**json.loads(data)) if data is not None else None
+
+    def has_tokens(self, user_id: str) -> bool:
+        """Whether this worker holds tokens for the user, without loading or refreshing them."""
+        return user_id in self._tokens
+
+    async def remove(self, user_id: str):
+        """Forget the user's tokens on this worker and, with a SharedState, on all of them."""
+        self._tokens.pop(user_id, None)
+        self._last_used.pop(user_id, None)
+        if self.shared is None:
+            return
+        try:
+            await self.shared.delete(f"tokens:{user_id}")
+        except SharedStateError as e:
+            logger.warning(f"Could not delete shared tokens for user {user_id}: {e}")
+
+    async def get_access_token(self, user_id: str) -> str:
+        self._last_used[user_id] = time.monotonic()
+        record = self._tokens.get(user_id)
+        if record is None:
+            # Logged in through another worker
+            record = await self._load_shared(user_id)
+            if record is None:
+                raise NotAuthenticatedError(f"No tokens stored for user {user_id}")
+            self._tokens[user_id] = record
+        if time.time() > record.expires_at - self.refresh_margin:
+            record = await self.refresh(user_id)
+        return record.access_token
+
+    async def refresh(self, user_id: str) -> TokenRecord:
+        task = self._refreshing.get(user_id)
+        if task is None:
+            task = self._refreshing[user_id] = asyncio.ensure_future(self._refresh(user_id))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, user_id: str) -> TokenRecord:
+        try:
+            record = self._tokens.get(user_id)
+            if record is None or not record.refresh_token:
+                raise NotAuthenticatedError(f"No refresh token stored for user {user_id}")
+            if self.shared is not None:
+                try:
+                    data = await self.shared.get(f"tokens:{user_id}")
+                except SharedStateError as e:
+                    logger.warning(f"Could not load shared tokens for user {user_id}: {e}")
+                else:
+                    if data is None:
+                        # Logged out through another worker
+                        self._tokens.pop(user_id, None)
+                        raise NotAuthenticatedError(f"Tokens for user {user_id} were removed")
+                    # Another worker may have renewed already
+                    shared = TokenRecord(**json.loads(data))
+                    if shared.expires_at > max(record.expires_at, time.time() + self.refresh_margin):
+                        self._tokens[user_id] = shared
+                        return shared
+            try:
+                tokens = await self.spotify_client.refresh_access_token(record.refresh_token)
+            except httpx.HTTPStatusError as e:
+                self.refresh_failures += 1
+                if e.response.status_code == 400 and "invalid_grant" in e.response.text:
+                    # Revoked or expired refresh token, retrying can't help
+                    await self.remove(user_id)
+                    raise NotAuthenticatedError(f"Refresh token for user {user_id} is no longer valid") from e
+                raise
+            except Exception:
+                self.refresh_failures += 1
+                raise
+            self.refreshes += 1
+            await self.save(user_id, tokens)
+            return self._tokens[user_id]
+        finally:
+            self._refreshing.pop(user_id, None)
+
+    def start(self):
+        if self._renewer is None:
+            self._renewer = asyncio.create_task(self._renew_loop())
+
+    async def close(self):
+        if self._renewer is not None:
+            self._renewer.cancel()
+            await asyncio.gather(self._renewer, return_exceptions=True)
+            self._renewer = None
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            deadline = time.time() + self.renew_ahead
+            active_since = time.monotonic() - self.idle_timeout
+            due = [user_id for user_id, record in self._tokens.items()
+                   if record.expires_at < deadline and self._last_used.get(user_id, 0.0) > active_since]
+            results = await asyncio.gather(*(self.refresh(user_id) for user_id in due), return_exceptions=True)
+            for user_id, result in zip(due, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Background token renewal failed for user {user_id}: {result}")
+
+
+_token_store_instance: Optional[TokenStore] = None
+
+def set_token_store_instance(store: TokenStore):
+    global _token_store_instance
+    _token_store_instance = store
+
+def get_token_store() -> TokenStore:
+    if _token_store_instance is None:
+        raise RuntimeError("TokenStore has not been initialized. "
+                           "Ensure set_token_store_instance is called during app startup.")
+    return _token_store_instance
@@ -2,26 +2,274 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 from app.routers.pages import router as pages_router
 from app.routers.auth import router as auth_router
 from app.routers.now_playing import router as now_playing_router
 from app.routers.player import router as player_router
+from app.routers.albums import router as albums_router
+from app.routers.artwork import router as artwork_router
+from app.routers.metrics import router as metrics_router
+from app.routers.history import router as history_router
+from app.routers.rooms import router as rooms_router
+from app.routers.dashboard import router as dashboard_router
 from fastapi.staticfiles import StaticFiles
-from app.core.spotify import SpotifyApi, set_spotify_client_instance
+from app.core.spotify import (
+    SpotifyApi, set_spotify_client_instance, get_spotify_client, SPOTIFY_ACCOUNTS_URL, SPOTIFY_BASE_URL
+)
+from app.core.ratelimit import RateLimitedError
+from app.core.breaker import UpstreamUnavailableError
+from app.core.scheduler import PollScheduler
+from app.core.shared import SharedPlayback, build_shared_state
+from app.core.tokens import TokenStore, set_token_store_instance, get_token_store
+from app.core.streams import StreamHub, StateSubscriber, set_stream_hub_instance, get_stream_hub
+from app.core.enrichment import (
+    AlbumEnricher, AlbumInfoCache, build_album_info_provider, set_album_enricher_instance, get_album_enricher
+)
+from app.core.artwork import ArtworkService, DiskLRUCache, set_artwork_service_instance, get_artwork_service
+from app.core.commands import CommandPipeline, set_command_pipeline_instance, get_command_pipeline
+from app.core.dashboard import Dashboard, set_dashboard_instance, get_dashboard
+from app.core.prefetch import Prefetcher, set_prefetcher_instance, get_prefetcher
+from app.core.rooms import RoomRegistry, set_room_registry_instance, get_room_registry
+from app.core.history import HistoryRecorder, HistoryStore, set_history_recorder_instance, get_history_recorder
+from app.core.etag import conditional_stats
+from app.core.fragments import FragmentCache, set_fragment_cache_instance, get_fragment_cache
+from app.core.templates import configure_templates, precompile_templates
+from app.core.metrics import MetricsMiddleware, registry
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    precompile_templates()
+    spotify_client = get_spotify_client()
+    await spotify_client.start()
+    get_token_store().start()
+    get_history_recorder().start()
+    yield
+    await get_command_pipeline().close()
+    await get_stream_hub().close()
+    await get_token_store().close()
+    await get_album_enricher().close()
+    await get_prefetcher().close()
+    await get_history_recorder().close()
+    await spotify_client.aclose()
+    await shared_state.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(RateLimitedError)
+async def rate_limited_handler(request: Request, exc: RateLimitedError):
+    # Only reached when there is no cached snapshot to serve instead
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+@app.exception_handler(UpstreamUnavailableError)
+async def upstream_unavailable_handler(request: Request, exc: UpstreamUnavailableError):
+    # Circuit open or load shed, and no cached snapshot to serve instead
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
 
-app = FastAPI()
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SESSION_SECRET", "some-secret"))
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
+configure_templates(
+    bytecode_cache_dir=os.getenv("TEMPLATE_CACHE_DIR", "data/templates"),
+    auto_reload=os.getenv("TEMPLATE_AUTO_RELOAD", "false").lower() == "true",
+)
+set_fragment_cache_instance(FragmentCache(max_entries=int(os.getenv("FRAGMENT_CACHE_SIZE", "512"))))
+
+# Snapshots, poll leases and tokens shared between workers; in-process unless SHARED_STATE_URL is set
+shared_state = build_shared_state(os.getenv("SHARED_STATE_URL"))
+# A single worker has nothing to share with, so the in-process backend skips the extra layer
+share_state = shared_state.name != "memory"
+
 set_spotify_client_instance(SpotifyApi(
     client_id=os.getenv("SPOTIFY_CLIENT_ID"),
     client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
-    redicrect_uri=os.getenv("SPOTIFY_REDIRECT_URI")
+    redicrect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
+    http2=os.getenv("SPOTIFY_HTTP2", "true").lower() == "true",
+    max_connections=int(os.getenv("SPOTIFY_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("SPOTIFY_MAX_KEEPALIVE_CONNECTIONS", "20")),
+    keepalive_expiry=float(os.getenv("SPOTIFY_KEEPALIVE_EXPIRY", "30")),
+    timeout=float(os.getenv("SPOTIFY_TIMEOUT", "10")),
+    connect_timeout=float(os.getenv("SPOTIFY_CONNECT_TIMEOUT", "5")),
+    api_timeout=float(os.getenv("SPOTIFY_API_TIMEOUT", "3")),
+    max_in_flight=int(os.getenv("SPOTIFY_MAX_IN_FLIGHT", "64")),
+    breaker_threshold=int(os.getenv("SPOTIFY_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("SPOTIFY_BREAKER_RESET", "10")),
+    playback_cache_ttl=float(os.getenv("PLAYBACK_CACHE_TTL", "1")),
+    playback_cache_size=int(os.getenv("PLAYBACK_CACHE_SIZE", "1024")),
+    rate_limit=float(os.getenv("SPOTIFY_RATE_LIMIT", "10")),
+    rate_limit_burst=int(os.getenv("SPOTIFY_RATE_LIMIT_BURST", "20")),
+    accounts_url=os.getenv("SPOTIFY_ACCOUNTS_URL", SPOTIFY_ACCOUNTS_URL),
+    base_api_url=os.getenv("SPOTIFY_API_URL", SPOTIFY_BASE_URL),
+    shared_playback=SharedPlayback(
+        shared_state,
+        ttl=float(os.getenv("PLAYBACK_CACHE_TTL", "1")),
+        lease_ttl=float(os.getenv("SHARED_LEASE_TTL", "5")),
+    ) if share_state else None,
+))
+
+set_token_store_instance(TokenStore(
+    get_spotify_client(),
+    renew_ahead=float(os.getenv("TOKEN_RENEW_AHEAD", "300")),
+    renew_interval=float(os.getenv("TOKEN_RENEW_INTERVAL", "30")),
+    idle_timeout=float(os.getenv("TOKEN_IDLE_TIMEOUT", "3600")),
+    shared=shared_state if share_state else None,
+))
+
+set_stream_hub_instance(StreamHub(
+    get_spotify_client(),
+    get_token_store(),
+    PollScheduler(
+        min_interval=float(os.getenv("POLL_MIN_INTERVAL", "1")),
+        max_interval=float(os.getenv("POLL_MAX_INTERVAL", "20")),
+        paused_interval=float(os.getenv("POLL_PAUSED_INTERVAL", "15")),
+        idle_interval=float(os.getenv("POLL_IDLE_INTERVAL", "30")),
+    ),
+    tick_interval=float(os.getenv("STREAM_TICK_INTERVAL", "3")),
+))
+
+set_command_pipeline_instance(CommandPipeline(
+    get_spotify_client(),
+    get_token_store(),
+    get_stream_hub(),
+    window=float(os.getenv("PLAYER_COMMAND_WINDOW", "0.15")),
+))
+
+set_album_enricher_instance(AlbumEnricher(
+    build_album_info_provider(os.getenv("ALBUM_INFO_PROVIDER", "none")),
+    AlbumInfoCache(
+        os.getenv("ALBUM_INFO_CACHE_PATH", "data/album_info.sqlite3"),
+        ttl=float(os.getenv("ALBUM_INFO_TTL", str(30 * 86400))),
+        negative_ttl=float(os.getenv("ALBUM_INFO_NEGATIVE_TTL", "86400")),
+    ),
+))
+get_spotify_client().playback_cache.add_listener(get_album_enricher().on_playback)
+
+set_artwork_service_instance(ArtworkService(
+    lambda: get_spotify_client().client,
+    DiskLRUCache(
+        os.getenv("ARTWORK_CACHE_DIR", "data/artwork"),
+        max_bytes=int(os.getenv("ARTWORK_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    ),
+))
+get_spotify_client().playback_cache.add_listener(get_artwork_service().on_playback)
+
+set_prefetcher_instance(Prefetcher(
+    get_spotify_client(),
+    get_token_store(),
+    get_fragment_cache(),
+    get_artwork_service(),
+    lead_time=float(os.getenv("PREFETCH_LEAD_TIME", "15")),
+    should_prefetch=get_spotify_client().shared_playback.is_leader if share_state else None,
+))
+get_spotify_client().playback_cache.add_listener(get_prefetcher().on_playback)
+
+set_history_recorder_instance(HistoryRecorder(
+    HistoryStore(os.getenv("HISTORY_DIR", "data/history")),
+    flush_interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", "5")),
+    min_listened_ms=int(os.getenv("HISTORY_MIN_LISTENED_MS", "5000")),
+    should_record=get_spotify_client().shared_playback.is_leader if share_state else None,
+))
+get_spotify_client().playback_cache.add_listener(get_history_recorder().on_playback)
+
+set_room_registry_instance(RoomRegistry(
+    shared_state if share_state else None,
+    max_viewers=int(os.getenv("ROOM_MAX_VIEWERS", "1000")),
+    ttl=float(os.getenv("ROOM_TTL", "86400")),
+))
+
+set_dashboard_instance(Dashboard(
+    get_spotify_client(),
+    get_token_store(),
+    members=[user_id.strip() for user_id in os.getenv("DASHBOARD_USERS", "").split(",") if user_id.strip()],
+    concurrency=int(os.getenv("DASHBOARD_CONCURRENCY", "50")),
+    deadline=float(os.getenv("DASHBOARD_DEADLINE", "2")),
 ))
 
 app.include_router(pages_router)
 app.include_router(auth_router)
 app.include_router(now_playing_router)
-app.include_router(player_router)
\ No newline at end of file
+app.include_router(player_router)
+app.include_router(albums_router)
+app.include_router(artwork_router)
+app.include_router(history_router)
+app.include_router(rooms_router)
+app.include_router(dashboard_router)
+
+if os.getenv("METRICS_ENABLED", "false").lower() == "true":
+    # Added last so it wraps the session middleware too
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router)
+
+    registry.callback("now_playing_upstream_requests_in_flight", "Spotify requests awaiting a response.",
+                      lambda: get_spotify_client().in_flight)
+    registry.callback("now_playing_rate_limited_total", "429s received from Spotify.",
+                      lambda: get_spotify_client().rate_limiter.throttled, kind="counter")
+    registry.callback("now_playing_playback_cache_total", "Playback snapshot cache lookups by outcome.",
+                      lambda: {(key,): value for key, value in get_spotify_client().playback_cache.stats().items()
+                               if key in ("hits", "misses", "coalesced", "evictions", "stale")},
+                      kind="counter", labelnames=("outcome",))
+    registry.callback("now_playing_upstream_circuit_open", "1 while an upstream endpoint's circuit is open or probing.",
+                      lambda: {(endpoint,): int(state != "closed")
+                               for endpoint, state in get_spotify_client().breakers.states().items()},
+                      labelnames=("endpoint",))
+    registry.callback("now_playing_upstream_rejected_total", "Upstream calls not made, by reason.",
+                      lambda: {("circuit_open",): sum(b.rejected for b in get_spotify_client().breakers.breakers.values()),
+                               ("shed",): get_spotify_client().shed},
+                      kind="counter", labelnames=("reason",))
+    registry.callback("now_playing_stale_snapshots_total", "Cached snapshots served because Spotify failed.",
+                      lambda: get_spotify_client().stale_served, kind="counter")
+    registry.callback("now_playing_token_refreshes_total", "OAuth token refreshes by outcome.",
+                      lambda: {("ok",): get_token_store().refreshes,
+                               ("failed",): get_token_store().refresh_failures},
+                      kind="counter", labelnames=("outcome",))
+    registry.callback("now_playing_token_users", "Users with server-side tokens.", lambda: len(get_token_store()))
+    registry.callback("now_playing_pollers", "Active per-user upstream pollers.", lambda: len(get_stream_hub().pollers))
+    registry.callback("now_playing_room_viewers", "Open listening room streams.", lambda: get_room_registry().viewers())
+    registry.callback("now_playing_streams", "Open stream connections, including room viewers.",
+                      lambda: sum(len(poller.subscribers) for poller in get_stream_hub().pollers.values()))
+    registry.callback("now_playing_player_sockets", "Open /ws/player connections.",
+                      lambda: sum(isinstance(subscriber, StateSubscriber)
+                                  for poller in get_stream_hub().pollers.values() for subscriber in poller.subscribers))
+    registry.callback("now_playing_player_commands_total", "Player commands by stage.",
+                      lambda: {("submitted",): get_command_pipeline().submitted,
+                               ("executed",): get_command_pipeline().executed,
+                               ("failed",): get_command_pipeline().failed},
+                      kind="counter", labelnames=("stage",))
+    registry.callback("now_playing_artwork_cache_total", "Artwork lookups by outcome.",
+                      lambda: {("hit",): get_artwork_service().hits, ("miss",): get_artwork_service().misses},
+                      kind="counter", labelnames=("outcome",))
+    registry.callback("now_playing_conditional_requests_total", "Conditional requests and the 304s they produced.",
+                      lambda: {(route, outcome): count for route, stats in conditional_stats.items()
+                               for outcome, count in stats.items()},
+                      kind="counter", labelnames=("route", "outcome"))
+    registry.callback("now_playing_fragment_cache_total", "Rendered fragment lookups by outcome.",
+                      lambda: {("hit",): get_fragment_cache().hits, ("miss",): get_fragment_cache().misses},
+                      kind="counter", labelnames=("outcome",))
+    registry.callback("now_playing_dashboard_results_total", "Dashboard batch results by freshness.",
+                      lambda: {(key,): value for key, value in get_dashboard().results.items()},
+                      kind="counter", labelnames=("status",))
+    registry.callback("now_playing_prefetch_total", "Next-track prefetches, and track changes that did or didn't land on one.",
+                      lambda: {(key,): value for key, value in get_prefetcher().stats().items()},
+                      kind="counter", labelnames=("outcome",))
+    registry.callback("now_playing_history_plays_total", "Track plays recorded to listening history.",
+                      lambda: get_history_recorder().recorded, kind="counter")
+    registry.callback("now_playing_history_out_of_order_total",
+                      "Track plays dropped from history for starting before the last recorded play.",
+                      lambda: get_history_recorder().store.out_of_order, kind="counter")
+    if share_state:
+        registry.callback("now_playing_shared_playback_total", "Shared snapshot reads by outcome.",
+                          lambda: {(key,): value for key, value in get_spotify_client().shared_playback.stats().items()},
+                          kind="counter", labelnames=("outcome",))
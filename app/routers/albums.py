@@ -0,0 +1,38 @@
+from fastapi import APIRouter, Request, Depends
+from fastapi.responses import JSONResponse
+from app.core.auth import get_valid_access_token
+from app.core.enrichment import AlbumEnricher, get_album_enricher
+from app.core.session import get_user_from_session
+from app.core.spotify import SpotifyApi, get_spotify_client
+
+router = APIRouter()
+
+@router.get("/current-album-info")
+async def current_album_info(request: Request,
+                             spotify_client: SpotifyApi = Depends(get_spotify_client),
+                             enricher: AlbumEnricher = Depends(get_album_enricher)):
+    access_token = await get_valid_access_token(request)
+    user = get_user_from_session(request)
+    playback = await spotify_client.get_current_playback(access_token, user_id=user["id"])
+
+    if not playback or not playback.album_id:
+        return JSONResponse(content={"album_id": None, "status": "nothing_playing", "info": None})
+
+    hit, info = await enricher.get(playback.album_id)
+    if not hit:
+        # Never wait on the provider, the lookup lands in the cache for the next call
+        enricher.schedule(playback)
+        status = "pending"
+    else:
+        status = "found" if info is not None else "not_found"
+
+    return JSONResponse(
+        status_code=202 if status == "pending" else 200,
+        content={
+            "album_id": playback.album_id,
+            "artist": playback.artists[0] if playback.artists else None,
+            "album": playback.album_name,
+            "status": status,
+            "info": info,
+        }
+    )
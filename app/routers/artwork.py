@@ -0,0 +1,42 @@
+import re
+import httpx
+from fastapi import APIRouter, Request, Depends, HTTPException
+from fastapi.responses import Response
+from app.core.artwork import ArtworkService, get_artwork_service, image_media_type
+from app.core.auth import get_valid_access_token
+from app.core.etag import Conditional
+from app.core.spotify import SpotifyApi, get_spotify_client
+
+router = APIRouter()
+
+ALBUM_ID_PATTERN = re.compile(r"^[A-Za-z0-9]{1,64}$")
+# Album artwork doesn't change for an album id, so browsers may keep it for a year
+ARTWORK_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@router.get("/artwork/{album_id}")
+async def artwork(album_id: str,
+                  request: Request,
+                  size: int = 300,
+                  service: ArtworkService = Depends(get_artwork_service),
+                  spotify_client: SpotifyApi = Depends(get_spotify_client),
+                  conditional: Conditional = Depends(Conditional)):
+    if not ALBUM_ID_PATTERN.match(album_id):
+        raise HTTPException(status_code=404, detail="Unknown album")
+
+    async def load_images():
+        # Only needed for albums we haven't seen in anyone's playback yet
+        access_token = await get_valid_access_token(request)
+        try:
+            return await spotify_client.get_album_images(access_token, album_id)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (400, 404):
+                return ()
+            raise
+
+    result = await service.get(album_id, size, load_images)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No artwork for album")
+
+    data, etag = result
+    return conditional.not_modified(etag, ARTWORK_CACHE_CONTROL) or conditional.tag(
+        Response(content=data, media_type=image_media_type(data)), etag, ARTWORK_CACHE_CONTROL)
@@ -13,7 +13,7 @@ async def login(spotify_client: SpotifyApi = Depends(get_spotify_client)):
 
 @router.get("/logout")
 async def logout(request: Request):
-    logout_user(request)
+    await logout_user(request)
     return RedirectResponse("/")
 
 @router.get("/callback")
@@ -0,0 +1,73 @@
+import json
+from typing import AsyncIterator, List, Optional
+from fastapi import APIRouter, Request, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, StreamingResponse
+from app.core.auth import get_valid_access_token
+from app.core.dashboard import BatchResult, Dashboard, get_dashboard
+from app.core.fragments import FragmentCache, get_fragment_cache
+from app.core.session import get_user_from_session
+from app.core.templates import templates
+
+router = APIRouter()
+
+
+async def _require_member(request: Request, dashboard: Dashboard) -> dict:
+    if not dashboard.members:
+        raise HTTPException(status_code=404, detail="No dashboard is configured")
+    await get_valid_access_token(request)
+    user = get_user_from_session(request)
+    if user["id"] not in dashboard.members:
+        raise HTTPException(status_code=403, detail="Not a member of this dashboard")
+    return user
+
+
+def _select_users(dashboard: Dashboard, users: Optional[str]) -> List[str]:
+    if not users:
+        return list(dashboard.members)
+    selected = [user_id for user_id in dict.fromkeys(users.split(",")) if user_id]
+    if any(user_id not in dashboard.members for user_id in selected):
+        raise HTTPException(status_code=403, detail="Not a member of this dashboard")
+    return selected
+
+
+def format_result(result: BatchResult, fragments: FragmentCache) -> str:
+    playback = result.playback
+    return json.dumps({
+        "user_id": result.user_id,
+        "status": result.status,
+        "age_ms": result.age_ms,
+        "track_id": playback.track_id if playback else None,
+        "progress_ms": playback.progress_ms if playback else 0,
+        "duration_ms": playback.duration_ms if playback else 0,
+        "is_playing": playback.is_playing if playback else False,
+        "html": fragments.dashboard_card(playback).decode(),
+    }) + "\n"
+
+
+async def batch_stream(dashboard: Dashboard, fragments: FragmentCache, user_ids: List[str]) -> AsyncIterator[str]:
+    async for result in dashboard.fetch(user_ids):
+        yield format_result(result, fragments)
+
+
+@router.get("/now-playing/batch")
+async def now_playing_batch(request: Request,
+                            users: Optional[str] = Query(None, description="comma-separated user ids, default all members"),
+                            dashboard: Dashboard = Depends(get_dashboard),
+                            fragments: FragmentCache = Depends(get_fragment_cache)):
+    """Playback of many users as newline-delimited JSON, one line per user as each fetch completes."""
+    await _require_member(request, dashboard)
+    user_ids = _select_users(dashboard, users)
+    return StreamingResponse(
+        batch_stream(dashboard, fragments, user_ids),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/dashboard", response_class=HTMLResponse)
+async def dashboard_page(request: Request, dashboard: Dashboard = Depends(get_dashboard)):
+    user = await _require_member(request, dashboard)
+    return templates.TemplateResponse(
+        "dashboard.html",
+        {"request": request, "user": user, "members": dashboard.members}
+    )
@@ -0,0 +1,48 @@
+from typing import Optional
+from fastapi import APIRouter, Request, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+from app.core.history import AGGREGATE_KINDS, HistoryRecorder, get_history_recorder
+from app.core.session import get_user_from_session
+
+router = APIRouter()
+
+MAX_PAGE_SIZE = 500
+
+def _require_user(request: Request) -> dict:
+    user = get_user_from_session(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    return user
+
+@router.get("/history")
+async def history(request: Request,
+                  limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                  cursor: Optional[int] = Query(None, ge=0, description="next_cursor from the previous page"),
+                  since: Optional[int] = Query(None, ge=0, description="epoch ms, inclusive"),
+                  until: Optional[int] = Query(None, ge=0, description="epoch ms, exclusive"),
+                  recorder: HistoryRecorder = Depends(get_history_recorder)):
+    """Listened tracks, newest first."""
+    user = _require_user(request)
+    plays, next_cursor = await recorder.page(user["id"], limit, before=cursor, since=since, until=until)
+    return JSONResponse(content={
+        "items": [recorder.describe(play) for play in plays],
+        "next_cursor": next_cursor,
+    })
+
+@router.get("/history/top")
+async def history_top(request: Request,
+                      by: str = Query("artist", pattern=f"^({'|'.join(AGGREGATE_KINDS)})$"),
+                      limit: int = Query(10, ge=1, le=100),
+                      since: Optional[int] = Query(None, ge=0),
+                      until: Optional[int] = Query(None, ge=0),
+                      recorder: HistoryRecorder = Depends(get_history_recorder)):
+    """Play counts and listened time per track, album or artist."""
+    user = _require_user(request)
+    rows = await recorder.aggregate(user["id"], by, since=since, until=until, limit=limit)
+    return JSONResponse(content={
+        "by": by,
+        "items": [
+            {"id": item_id, "name": recorder.name(by, item_id), "plays": plays, "listened_ms": listened_ms}
+            for item_id, plays, listened_ms in rows
+        ],
+    })
@@ -1,68 +1,118 @@
 from http.client import HTTPException
 import os
 import time
+from typing import Optional
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse
 from app.core.auth import get_valid_access_token
 import httpx
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from app.core.auth import get_valid_access_token
-from app.core.spotify import get_current_playback
 from app.core.session import get_user_from_session
 from app.core.templates import templates
 from app.core.spotify import SpotifyApi, get_spotify_client
+from app.core.streams import StreamHub, get_stream_hub, event_stream
+from app.core.etag import Conditional, make_etag
+from app.core.fragments import FragmentCache, get_fragment_cache
+from app.core.models import PlaybackSnapshot
+from app.core.ratelimit import Priority
 
 router = APIRouter()
 
+PROGRESS_ETAG_BUCKET_MS = 5000
+
 @router.get("/now-playing")
 async def now_playing(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
     user = get_user_from_session(request)
     access_token = await get_valid_access_token(request)
-    playback = await spotify_client.get_current_playback(access_token)
-    track = playback["item"]
+    playback = await spotify_client.get_current_playback(access_token, user_id=user["id"])
     return templates.TemplateResponse(
         "now_playing.html",
         {
             "request": request,
             "user": user,
-            "track": track,
+            "track": playback,
             "playback": playback
         }
     )
 
 @router.get("/now-playing/progress")
-async def now_playing_progress(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
+async def now_playing_progress(request: Request,
+                               spotify_client: SpotifyApi = Depends(get_spotify_client),
+                               conditional: Conditional = Depends(Conditional)):
+    user = get_user_from_session(request)
     access_token = await get_valid_access_token(request)
-    playback = await spotify_client.get_current_playback(access_token)
+    # Polled by open tabs, so it queues behind page loads and player commands
+    playback = await spotify_client.get_current_playback(access_token, user_id=user["id"],
+                                                         priority=Priority.BACKGROUND)
+    return progress_response(playback, conditional)
+
 
-    if not playback or not playback.get("item"):
-        return JSONResponse(content={"track_id": None, "progress_ms": 0, "duration_ms": 0})
+@router.get("/now-playing/track-info", response_class=HTMLResponse)
+async def now_playing_track_info(request: Request,
+                                 spotify_client: SpotifyApi = Depends(get_spotify_client),
+                                 conditional: Conditional = Depends(Conditional),
+                                 fragments: FragmentCache = Depends(get_fragment_cache)):
+    user = get_user_from_session(request)
+    access_token = await get_valid_access_token(request)
+    playback = await spotify_client.get_current_playback(access_token, user_id=user["id"],
+                                                         priority=Priority.BACKGROUND)
+    return track_info_response(playback, conditional, fragments)
 
-    track = playback["item"]
-    return JSONResponse(
+
+def progress_response(playback: Optional[PlaybackSnapshot], conditional: Conditional):
+    if not playback:
+        etag = make_etag(None)
+        return conditional.not_modified(etag) or conditional.tag(
+            JSONResponse(content={"track_id": None, "progress_ms": 0, "duration_ms": 0, "is_playing": False,
+                                  "stale": False}), etag)
+
+    # Clients interpolate progress themselves, so only a new bucket counts as a change
+    etag = make_etag(playback.track_id, playback.progress_ms // PROGRESS_ETAG_BUCKET_MS, playback.is_playing,
+                     playback.stale)
+    return conditional.not_modified(etag) or conditional.tag(JSONResponse(
         content={
-            "track_id": track["id"],
-            "progress_ms": playback.get("progress_ms", 0),
-            "duration_ms": track.get("duration_ms", 0)
+            "track_id": playback.track_id,
+            "progress_ms": playback.progress_ms,
+            "duration_ms": playback.duration_ms,
+            "is_playing": playback.is_playing,
+            # Served from cache because Spotify is slow or failing
+            "stale": playback.stale
         }
-    )
+    ), etag)
 
 
-@router.get("/now-playing/track-info", response_class=HTMLResponse)
-async def now_playing_track_info(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
-    access_token = await get_valid_access_token(request)
-    playback = await spotify_client.get_current_playback(access_token)
+def track_info_response(playback: Optional[PlaybackSnapshot], conditional: Conditional, fragments: FragmentCache):
+    etag = make_etag(playback.track_id if playback else None)
+    not_modified = conditional.not_modified(etag)
+    if not_modified:
+        return not_modified
 
-    if not playback or not playback.get("item"):
-        return HTMLResponse(content="<p>No track playing</p>")
+    if not playback:
+        return conditional.tag(HTMLResponse(content="<p>No track playing</p>"), etag)
 
-    track = playback["item"]
-    from fastapi.templating import Jinja2Templates
-    return templates.TemplateResponse(
-        "partials/track_info.html",
-        {
-            "request": request, 
-            "track": track
-        }
+    # Rendered once per track, then served from the fragment cache
+    return conditional.tag(HTMLResponse(content=fragments.track_info(playback)), etag)
+
+
+@router.get("/now-playing/stream")
+async def now_playing_stream(request: Request, hub: StreamHub = Depends(get_stream_hub)):
+    user = get_user_from_session(request)
+    # Fails early with 401 when there are no server-side tokens for this session
+    await get_valid_access_token(request)
+
+    return StreamingResponse(
+        event_stream(hub, user["id"]),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+
+
+@router.get("/now-playing/schedule")
+async def now_playing_schedule(request: Request, hub: StreamHub = Depends(get_stream_hub)):
+    """Debug view of when this user's next upstream poll is due."""
+    user = get_user_from_session(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    return JSONResponse(content={"user_id": user["id"], "schedule": hub.scheduler.next_poll(user["id"])})
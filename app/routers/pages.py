@@ -3,10 +3,12 @@ from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse
 from app.core.session import get_user_from_session
 from app.core.templates import templates
+from app.core.dashboard import get_dashboard
 
 router = APIRouter()
 
 @router.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     user = get_user_from_session(request)
-    return templates.TemplateResponse("home.html", {"request": request, "user": user})
\ No newline at end of file
+    show_dashboard = bool(user) and user["id"] in get_dashboard().members
+    return templates.TemplateResponse("home.html", {"request": request, "user": user, "show_dashboard": show_dashboard})
\ No newline at end of file
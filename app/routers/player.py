@@ -1,46 +1,91 @@
-from fastapi import APIRouter, Request, Depends
+import asyncio
+from fastapi import APIRouter, Request, Depends, WebSocket, WebSocketDisconnect, status
 from fastapi.responses import HTMLResponse
-from app.core.spotify import (
-    get_spotify_client,
-    SpotifyApi
-)
-from app.core.templates import templates
+from app.core.commands import CommandPipeline, get_command_pipeline, COMMANDS, PLAY, PAUSE, NEXT, PREVIOUS
 from app.core.auth import get_valid_access_token
+from app.core.fragments import FragmentCache, get_fragment_cache
+from app.core.session import get_user_from_session
+from app.core.streams import StateSubscriber, StreamHub, get_stream_hub, state_stream
+from app.core.tokens import NotAuthenticatedError, get_token_store
 
 router = APIRouter()
 
+async def submit_command(request: Request, pipeline: CommandPipeline, fragments: FragmentCache, command: str):
+    # Commands run upstream in the background, reply straight away with the optimistic status.
+    # Checking the token also loads it when the user logged in through another worker.
+    await get_valid_access_token(request)
+    user = get_user_from_session(request)
+    status = pipeline.submit(user["id"], command)
+    return HTMLResponse(content=fragments.playback_status(status))
+
 @router.post("/player/play", response_class=HTMLResponse)
-async def player_play(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
-    access_token = await get_valid_access_token(request)
-    success = await spotify_client.play(access_token)
-    if success:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "Playing"})
-    else:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "Paused"})
+async def player_play(request: Request,
+                      pipeline: CommandPipeline = Depends(get_command_pipeline),
+                      fragments: FragmentCache = Depends(get_fragment_cache)):
+    return await submit_command(request, pipeline, fragments, PLAY)
 
 @router.post("/player/pause", response_class=HTMLResponse)
-async def player_pause(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
-    access_token = await get_valid_access_token(request)
-    success = await spotify_client.pause(access_token)
-    if success:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "Paused"})
-    else:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "Playing"})
+async def player_pause(request: Request,
+                       pipeline: CommandPipeline = Depends(get_command_pipeline),
+                       fragments: FragmentCache = Depends(get_fragment_cache)):
+    return await submit_command(request, pipeline, fragments, PAUSE)
 
 @router.post("/player/next", response_class=HTMLResponse)
-async def player_next(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
-    access_token = await get_valid_access_token(request)
-    success = await spotify_client.next(access_token)
-    if success:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "Skipped to next track"})
-    else:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "FAiled to skip to next track"})
+async def player_next(request: Request,
+                      pipeline: CommandPipeline = Depends(get_command_pipeline),
+                      fragments: FragmentCache = Depends(get_fragment_cache)):
+    return await submit_command(request, pipeline, fragments, NEXT)
 
 @router.post("/player/previous", response_class=HTMLResponse)
-async def player_previous(request: Request, spotify_client: SpotifyApi = Depends(get_spotify_client)):
-    access_token = await get_valid_access_token(request)
-    success = await spotify_client.previous(access_token)
-    if success:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "Skipped to previous track"})
-    else:
-        return templates.TemplateResponse("partials/playback_status.html", {"request": request, "status": "FAiled to skip to previous track"})
\ No newline at end of file
+async def player_previous(request: Request,
+                          pipeline: CommandPipeline = Depends(get_command_pipeline),
+                          fragments: FragmentCache = Depends(get_fragment_cache)):
+    return await submit_command(request, pipeline, fragments, PREVIOUS)
+
+
+async def send_state(websocket: WebSocket, hub: StreamHub, user_id: str, subscriber: StateSubscriber):
+    async for message in state_stream(hub, user_id, subscriber):
+        await websocket.send_text(message)
+    # The user's tokens are gone, the client falls back to SSE, which answers 401
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+
+@router.websocket("/ws/player")
+async def player_socket(websocket: WebSocket,
+                        hub: StreamHub = Depends(get_stream_hub),
+                        pipeline: CommandPipeline = Depends(get_command_pipeline),
+                        fragments: FragmentCache = Depends(get_fragment_cache)):
+    """Player commands in, state diffs out, over one connection.
+
+    The session is checked once, at connect. A command is its bare name ("play", "pause",
+    "next", "previous"), and its optimistic status comes back as a state diff.
+    """
+    user = get_user_from_session(websocket)
+    try:
+        if not user:
+            raise NotAuthenticatedError()
+        await get_token_store().get_access_token(user["id"])
+    except NotAuthenticatedError:
+        # Before accept() this is answered with a plain 403, the client falls back to SSE
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    user_id = user["id"]
+    subscriber = hub.subscribe(user_id, StateSubscriber())
+    # All sends happen in this one task, command replies go through the subscriber
+    sender = asyncio.create_task(send_state(websocket, hub, user_id, subscriber))
+    try:
+        while True:
+            command = await websocket.receive_text()
+            if command in COMMANDS:
+                status_html = fragments.playback_status(pipeline.submit(user_id, command))
+            else:
+                status_html = fragments.playback_status("Unknown command")
+            subscriber.reply(status_html.decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        # A send to a client that just went away fails, that's expected here
+        await asyncio.gather(sender, return_exceptions=True)
+        hub.unsubscribe(user_id, subscriber)
@@ -0,0 +1,122 @@
+from typing import AsyncIterator
+from fastapi import APIRouter, Request, Depends, HTTPException
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
+from app.core.auth import get_valid_access_token
+from app.core.etag import Conditional
+from app.core.fragments import FragmentCache, get_fragment_cache
+from app.core.ratelimit import Priority
+from app.core.rooms import Room, RoomRegistry, get_room_registry
+from app.core.session import get_user_from_session
+from app.core.spotify import SpotifyApi, get_spotify_client
+from app.core.streams import StreamHub, get_stream_hub, event_stream, format_event
+from app.core.templates import templates
+from app.core.tokens import NotAuthenticatedError, get_token_store
+from app.routers.now_playing import progress_response, track_info_response
+
+router = APIRouter()
+
+
+async def get_room(token: str, rooms: RoomRegistry = Depends(get_room_registry)) -> Room:
+    room = await rooms.get(token)
+    if room is None:
+        raise HTTPException(status_code=404, detail="No such room")
+    return room
+
+
+async def get_room_playback(room: Room, spotify_client: SpotifyApi, priority: Priority = Priority.PAGE):
+    # Viewers have no Spotify login, the room reads with the owner's tokens
+    try:
+        access_token = await get_token_store().get_access_token(room.owner_id)
+    except NotAuthenticatedError:
+        raise HTTPException(status_code=404, detail="This room is no longer available")
+    return await spotify_client.get_current_playback(access_token, user_id=room.owner_id, priority=priority)
+
+
+@router.post("/room")
+async def open_room(request: Request, rooms: RoomRegistry = Depends(get_room_registry)):
+    await get_valid_access_token(request)
+    user = get_user_from_session(request)
+    room = await rooms.open(user["id"])
+    return RedirectResponse(url=f"/room/{room.token}", status_code=303)
+
+
+@router.delete("/room/{token}")
+async def close_room(request: Request, room: Room = Depends(get_room),
+                     rooms: RoomRegistry = Depends(get_room_registry)):
+    user = get_user_from_session(request)
+    if not user or user["id"] != room.owner_id:
+        raise HTTPException(status_code=403, detail="Only the owner can close a room")
+    await rooms.close(room)
+    return Response(status_code=204)
+
+
+@router.get("/room/{token}", response_class=HTMLResponse)
+async def room_page(request: Request, room: Room = Depends(get_room),
+                    spotify_client: SpotifyApi = Depends(get_spotify_client)):
+    playback = await get_room_playback(room, spotify_client)
+    user = get_user_from_session(request)
+    return templates.TemplateResponse(
+        "now_playing.html",
+        {
+            "request": request,
+            "user": user,
+            "track": playback,
+            "playback": playback,
+            "room": room,
+            "is_owner": bool(user) and user["id"] == room.owner_id,
+        }
+    )
+
+
+@router.get("/room/{token}/progress")
+async def room_progress(room: Room = Depends(get_room),
+                        spotify_client: SpotifyApi = Depends(get_spotify_client),
+                        conditional: Conditional = Depends(Conditional)):
+    # The polling fallback for viewers whose stream was refused
+    playback = await get_room_playback(room, spotify_client, Priority.BACKGROUND)
+    return progress_response(playback, conditional)
+
+
+@router.get("/room/{token}/track-info", response_class=HTMLResponse)
+async def room_track_info(room: Room = Depends(get_room),
+                          spotify_client: SpotifyApi = Depends(get_spotify_client),
+                          conditional: Conditional = Depends(Conditional),
+                          fragments: FragmentCache = Depends(get_fragment_cache)):
+    playback = await get_room_playback(room, spotify_client, Priority.BACKGROUND)
+    return track_info_response(playback, conditional, fragments)
+
+
+async def room_event_stream(hub: StreamHub, rooms: RoomRegistry, room: Room) -> AsyncIterator[str]:
+    # Counted from the first chunk, like the subscription itself, so unstarted responses don't leak a slot.
+    # Streams that got past the is_full() check together can still find the room full here.
+    if not rooms.join(room.token):
+        yield format_event("full", "")
+        return
+    try:
+        async for chunk in event_stream(hub, room.owner_id):
+            # Every progress tick or keep-alive, so closing or expiry ends the stream within seconds
+            if not await rooms.is_open(room):
+                yield format_event("closed", "")
+                return
+            yield chunk
+        # The owner's poller ended: they logged out or their tokens were revoked
+        await rooms.close(room)
+        yield format_event("closed", "")
+    finally:
+        rooms.leave(room.token)
+
+
+@router.get("/room/{token}/stream")
+async def room_stream(room: Room = Depends(get_room),
+                      rooms: RoomRegistry = Depends(get_room_registry),
+                      hub: StreamHub = Depends(get_stream_hub)):
+    if rooms.is_full(room.token):
+        # EventSource gives up on a 503, the page falls back to polling progress
+        raise HTTPException(status_code=503, detail="This room is full",
+                            headers={"Retry-After": "30"})
+
+    return StreamingResponse(
+        room_event_stream(hub, rooms, room),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
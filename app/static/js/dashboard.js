@@ -0,0 +1,54 @@
+// Each line of /now-playing/batch is one user's result, shown as soon as it arrives
+const REFRESH_MS = 5000;
+
+function cardFor(userId) {
+  return document.querySelector(`.dashboard-card[data-user-id="${CSS.escape(userId)}"]`);
+}
+
+function showResult(result) {
+  const card = cardFor(result.user_id);
+  if (!card) {
+    return;
+  }
+  // Fragments are per track, only replace them when the track changed
+  if (card.dataset.trackId !== String(result.track_id)) {
+    card.dataset.trackId = String(result.track_id);
+    card.querySelector(".dashboard-track").innerHTML = result.html;
+  }
+
+  const progress = card.querySelector(".dashboard-progress");
+  if (result.status === "unavailable") {
+    progress.textContent = "Unavailable";
+  } else if (result.track_id) {
+    const state = result.is_playing ? "" : " (paused)";
+    const stale = result.status === "stale" ? ` (as of ${Math.round(result.age_ms / 1000)}s ago)` : "";
+    progress.textContent = `${Math.floor(result.progress_ms / 1000)} seconds of ${Math.floor(result.duration_ms / 1000)}${state}${stale}`;
+  } else {
+    progress.textContent = "";
+  }
+}
+
+async function refreshDashboard() {
+  try {
+    const res = await fetch("/now-playing/batch", { cache: "no-store" });
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = "";
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) {
+        break;
+      }
+      buffered += decoder.decode(value, { stream: true });
+      const lines = buffered.split("\n");
+      buffered = lines.pop();
+      lines.filter((line) => line).forEach((line) => showResult(JSON.parse(line)));
+    }
+  } catch (err) {
+    console.error("Error refreshing dashboard:", err);
+  } finally {
+    setTimeout(refreshDashboard, REFRESH_MS);
+  }
+}
+
+refreshDashboard();
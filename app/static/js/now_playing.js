@@ -1,12 +1,38 @@
 let currentTrackId = null;
 
+// Shared listening rooms serve the same endpoints under their own path
+const base = window.nowPlayingBase || "/now-playing";
+
+// Last 200 response and validator per endpoint, so 304s can reuse them
+const validators = {};
+
+async function conditionalFetch(url) {
+  const headers = {};
+  const cached = validators[url];
+  if (cached) {
+    headers["If-None-Match"] = cached.etag;
+  }
+
+  const res = await fetch(url, { headers, cache: "no-store" });
+  if (res.status === 304 && cached) {
+    return { notModified: true, body: cached.body, receivedAt: cached.receivedAt };
+  }
+
+  const body = res.headers.get("Content-Type")?.includes("json") ? await res.json() : await res.text();
+  const etag = res.headers.get("ETag");
+  if (etag) {
+    validators[url] = { etag, body, receivedAt: Date.now() };
+  }
+  return { notModified: false, body, receivedAt: Date.now() };
+}
+
 async function updateNowPlaying() {
   try {
-    const res = await fetch("/now-playing/progress");
-    const data = await res.json();
+    const { body: data, receivedAt } = await conditionalFetch(`${base}/progress`);
 
-    // Update progress bar
-    updateProgressBar(data.progress_ms, data.duration_ms);
+    // On a 304 the server's progress is still in the same bucket, advance it locally
+    const elapsed = data.is_playing ? Date.now() - receivedAt : 0;
+    updateProgressBar(Math.min(data.progress_ms + elapsed, data.duration_ms), data.duration_ms, data.stale);
 
     // If track changed, reload track info fragment
     if (data.track_id && data.track_id !== currentTrackId) {
@@ -18,24 +44,148 @@ async function updateNowPlaying() {
   }
 }
 
-function updateProgressBar(progress, duration) {
+function updateProgressBar(progress, duration, stale) {
   const secondsPassed = Math.floor(progress / 1000);
   const secondsTotal = Math.floor(duration / 1000);
   const progressText = document.getElementById("progress-text");
 
   if (progressText) {
-    progressText.textContent = `${secondsPassed} seconds of ${secondsTotal}`;
+    // Stale means Spotify couldn't be reached and this is the last known state
+    const note = stale ? " (reconnecting to Spotify)" : "";
+    progressText.textContent = `${secondsPassed} seconds of ${secondsTotal}${note}`;
   }
 }
 
 async function refreshTrackInfo() {
   try {
-    const res = await fetch("/now-playing/track-info");
-    const html = await res.text();
-    document.getElementById("track-info").innerHTML = html;
+    const { notModified, body: html } = await conditionalFetch(`${base}/track-info`);
+    if (!notModified) {
+      document.getElementById("track-info").innerHTML = html;
+    }
   } catch (err) {
     console.error("Error refreshing track info:", err);
   }
 }
 
-setInterval(updateNowPlaying, 3000); // Update every 3 seconds
\ No newline at end of file
+let pollTimer = null;
+
+function startPolling() {
+  if (pollTimer === null) {
+    pollTimer = setInterval(updateNowPlaying, 3000); // Update every 3 seconds
+  }
+}
+
+function startStream() {
+  if (!window.EventSource) {
+    startPolling();
+    return;
+  }
+
+  const source = new EventSource(`${base}/stream`);
+
+  source.addEventListener("track", (event) => {
+    document.getElementById("track-info").innerHTML = event.data;
+  });
+
+  source.addEventListener("progress", (event) => {
+    const data = JSON.parse(event.data);
+    currentTrackId = data.track_id;
+    updateProgressBar(data.progress_ms, data.duration_ms, data.stale);
+  });
+
+  source.addEventListener("status", (event) => {
+    const status = document.getElementById("playback-status");
+    if (status) {
+      status.innerHTML = event.data;
+    }
+  });
+
+  // Room streams only: the room was full when this stream joined, or has been closed or expired
+  source.addEventListener("full", () => {
+    source.close();
+    startPolling();
+  });
+
+  source.addEventListener("closed", () => {
+    source.close();
+    document.getElementById("track-info").innerHTML = "<p>This listening room has been closed.</p>";
+  });
+
+  source.onerror = () => {
+    // EventSource retries transient errors itself; it only closes when the stream is unavailable
+    if (source.readyState === EventSource.CLOSED) {
+      startPolling();
+    }
+  };
+}
+
+// Player commands and live state share one WebSocket when it's available.
+// Messages are diffs with one-letter keys, see state_stream() in app/core/streams.py.
+let socket = null;
+const state = { p: 0, d: 0, i: false, x: false, receivedAt: 0 };
+
+function renderState() {
+  // Progress is only sent on changes, advance it locally while playing
+  const elapsed = state.i ? Date.now() - state.receivedAt : 0;
+  updateProgressBar(Math.min(state.p + elapsed, state.d), state.d, state.x);
+}
+
+function applyState(diff) {
+  if ("h" in diff) {
+    document.getElementById("track-info").innerHTML = diff.h;
+  }
+  if ("t" in diff) {
+    currentTrackId = diff.t;
+  }
+  for (const key of ["d", "i", "x"]) {
+    if (key in diff) {
+      state[key] = diff[key];
+    }
+  }
+  if ("p" in diff) {
+    state.p = diff.p;
+    state.receivedAt = Date.now();
+  }
+  if ("s" in diff) {
+    const status = document.getElementById("playback-status");
+    if (status) {
+      status.innerHTML = diff.s;
+    }
+  }
+  renderState();
+}
+
+function startSocket() {
+  // Room viewers have no login and no player, they stay on the room's stream
+  if (!window.WebSocket || window.nowPlayingBase) {
+    startStream();
+    return;
+  }
+
+  const scheme = location.protocol === "https:" ? "wss" : "ws";
+  const ws = new WebSocket(`${scheme}://${location.host}/ws/player`);
+  let ticker = null;
+
+  ws.onopen = () => {
+    socket = ws;
+    ticker = setInterval(renderState, 1000);
+  };
+  ws.onmessage = (event) => applyState(JSON.parse(event.data));
+  ws.onclose = () => {
+    // Refused (no valid session) or dropped: the SSE stream takes over
+    socket = null;
+    clearInterval(ticker);
+    startStream();
+  };
+}
+
+// With the socket open, the player buttons send their command over it instead of posting
+document.addEventListener("htmx:beforeRequest", (event) => {
+  const command = event.detail.elt.dataset.command;
+  if (command && socket && socket.readyState === WebSocket.OPEN) {
+    event.preventDefault();
+    socket.send(command);
+  }
+});
+
+startSocket();
\ No newline at end of file
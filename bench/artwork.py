@@ -0,0 +1,135 @@
+"""Artwork checks against images served by the local fake Spotify.
+
+Points the recorded album images at the fake itself and checks /artwork/{album_id}: the
+smallest source at least as wide as the snapped size is fetched, thumbnails come back
+resized with a content type matching their bytes, concurrent misses for one thumbnail
+share a single upstream fetch, the disk cache evicts the least recently used entry once
+it is over its byte budget, and a matching If-None-Match gets a 304. Exits non-zero when
+a check fails.
+
+    python -m bench.artwork
+"""
+import argparse
+import asyncio
+import io
+import logging
+import sys
+from typing import Dict, Tuple
+
+import httpx
+
+from bench.faults import Checks
+from bench.fake_spotify import FakeSpotifyConfig
+from bench.run import start_app, start_fake_spotify
+
+
+def albums(fake) -> Dict[str, Dict[int, str]]:
+    """album id -> {width: image id} from the recorded payloads."""
+    found: Dict[str, Dict[int, str]] = {}
+    for payload in fake.payloads:
+        album = payload["item"]["album"]
+        found[album["id"]] = {image["width"]: image["url"].rsplit("/", 1)[-1] for image in album.get("images") or ()}
+    return found
+
+
+def source_width(widths, size: int) -> int:
+    fits = [width for width in widths if width >= size]
+    return min(fits) if fits else max(widths)
+
+
+def decode(data: bytes) -> Tuple[str, int]:
+    """(content type, width) read from the bytes themselves."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        return Image.MIME[image.format], image.width
+
+
+async def run_artwork(args, checks: Checks):
+    fake, fake_port, fake_server = start_fake_spotify(FakeSpotifyConfig(latency=args.latency))
+    fake.config.image_base_url = f"http://127.0.0.1:{fake_port}"
+    base_url, app_server = start_app(fake_port, SPOTIFY_RATE_LIMIT=1000, SPOTIFY_RATE_LIMIT_BURST=1000,
+                                     PREFETCH_LEAD_TIME=0)
+    from app.core.artwork import Image, get_artwork_service, snap_size
+    service = get_artwork_service()
+    images = albums(fake)
+    first, second, third = list(images)[:3]
+
+    def fetches(album_id: str, width: int) -> int:
+        return fake.calls[f"/image/{images[album_id][width]}"]
+
+    client = httpx.AsyncClient(base_url=base_url, timeout=30)
+    try:
+        await client.get("/callback?code=artwork")
+
+        # Fill the cache to its budget, touch the older entry, then overflow it with a smaller one
+        await client.get(f"/artwork/{first}?size=300")
+        await client.get(f"/artwork/{second}?size=300")
+        max_bytes, service.cache.max_bytes = service.cache.max_bytes, service.cache.total_bytes
+        await client.get(f"/artwork/{first}?size=300")
+        await client.get(f"/artwork/{third}?size=64")
+        checks.check("lru: stays within its byte budget", service.cache.total_bytes <= service.cache.max_bytes,
+                     f"{service.cache.total_bytes} of {service.cache.max_bytes} bytes")
+        checks.check("lru: one entry evicted", service.cache.evictions == 1, f"{service.cache.evictions} evictions")
+        before = fetches(first, 300), fetches(second, 300)
+        await client.get(f"/artwork/{first}?size=300")
+        checks.check("lru: recently used entry kept", fetches(first, 300) == before[0])
+        await client.get(f"/artwork/{second}?size=300")
+        checks.check("lru: least recently used entry evicted", fetches(second, 300) == before[1] + 1)
+        service.cache.max_bytes = max_bytes
+
+        # Size selection and resizing
+        for size in (50, 200, 1000):
+            widths = images[first]
+            expected = source_width(widths, snap_size(size))
+            before = {width: fetches(first, width) for width in widths}
+            response = await client.get(f"/artwork/{first}?size={size}")
+            fetched = [width for width in widths if fetches(first, width) > before[width]]
+            checks.check(f"size {size}: fetches the {expected}px source", fetched == [expected],
+                         f"fetched {fetched}")
+            media_type = response.headers["content-type"]
+            if Image is None:
+                checks.check(f"size {size}: original served as png", media_type == "image/png", media_type)
+                continue
+            actual_type, width = decode(response.content)
+            checks.check(f"size {size}: content type matches the bytes", media_type == actual_type,
+                         f"{media_type}, bytes are {actual_type}")
+            checks.check(f"size {size}: {snap_size(size)}px wide", width == min(snap_size(size), expected),
+                         f"{width}px")
+
+        # Concurrent misses for one thumbnail
+        before = fetches(second, source_width(images[second], 128)), service.misses
+        responses = await asyncio.gather(*(client.get(f"/artwork/{second}?size=128") for _ in range(args.concurrency)))
+        calls = fetches(second, source_width(images[second], 128)) - before[0]
+        checks.check("single-flight: one upstream fetch for concurrent misses",
+                     calls == 1 and service.misses - before[1] == 1, f"{calls} fetches")
+        checks.check("single-flight: every request served the same thumbnail",
+                     len({response.headers.get("etag") for response in responses}) == 1
+                     and all(response.status_code == 200 for response in responses))
+
+        # Revalidation
+        response = await client.get(f"/artwork/{first}?size=200")
+        revalidated = await client.get(f"/artwork/{first}?size=200", headers={"If-None-Match": response.headers["etag"]})
+        checks.check("etag: matching If-None-Match gives 304",
+                     revalidated.status_code == 304 and not revalidated.content, str(revalidated.status_code))
+        checks.check("etag: immutable Cache-Control", "immutable" in revalidated.headers.get("cache-control", ""),
+                     revalidated.headers.get("cache-control", ""))
+    finally:
+        await client.aclose()
+        app_server.should_exit = True
+        fake_server.should_exit = True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="simultaneous requests for one uncached thumbnail")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake upstream and image latency in seconds")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    checks = Checks()
+    asyncio.run(run_artwork(args, checks))
+    return 1 if checks.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
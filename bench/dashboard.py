@@ -0,0 +1,99 @@
+"""Wall-clock time of /now-playing/batch against the local fake Spotify.
+
+Logs in N users, makes them all dashboard members and times one batch request at a
+few concurrency limits: total time and time to the first streamed line. Batches are
+spaced like the dashboard page refreshes, under the app's default rate limits unless
+--rate-limit is given. Then slows the fake upstream down past DASHBOARD_DEADLINE to
+show the stale fallback.
+
+    python -m bench.dashboard --users 50 --latency 0.2
+    python -m bench.dashboard --rate-limit 1000   # upstream-bound, no rate limit budgeting
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from typing import Dict
+
+import httpx
+
+from bench.fake_spotify import FakeSpotifyConfig
+from bench.run import start_app, start_fake_spotify
+
+
+async def time_batch(client: httpx.AsyncClient) -> Dict[str, float]:
+    started = time.perf_counter()
+    first = None
+    statuses: Counter = Counter()
+    async with client.stream("GET", "/now-playing/batch") as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            if first is None:
+                first = time.perf_counter() - started
+            statuses[json.loads(line)["status"]] += 1
+    return {"total_ms": (time.perf_counter() - started) * 1000, "first_ms": (first or 0) * 1000, **statuses}
+
+
+async def run_dashboard(args) -> Dict[str, Dict[str, float]]:
+    fake, fake_port, fake_server = start_fake_spotify(FakeSpotifyConfig(latency=args.latency))
+    user_ids = [f"user{i}" for i in range(args.users)]
+    limits = {"SPOTIFY_RATE_LIMIT": args.rate_limit, "SPOTIFY_RATE_LIMIT_BURST": args.rate_limit} if args.rate_limit else {}
+    base_url, app_server = start_app(
+        fake_port,
+        # Every batch goes upstream
+        PLAYBACK_CACHE_TTL=0.001,
+        DASHBOARD_USERS=",".join(user_ids),
+        DASHBOARD_DEADLINE=args.deadline,
+        **limits,
+    )
+    from app.core.dashboard import get_dashboard
+
+    results = {}
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=60) for _ in user_ids]
+    try:
+        await asyncio.gather(*(client.get(f"/callback?code={user_id}") for client, user_id in zip(clients, user_ids)))
+        display = clients[0]
+        # Warm up connections to the fake upstream
+        await time_batch(display)
+
+        for concurrency in args.concurrency:
+            await asyncio.sleep(args.interval)
+            get_dashboard().concurrency = concurrency
+            results[f"concurrency_{concurrency}"] = await time_batch(display)
+
+        await asyncio.sleep(args.interval)
+        get_dashboard().concurrency = max(args.concurrency)
+        fake.config.latency = args.deadline * 2
+        results["upstream_slower_than_deadline"] = await time_batch(display)
+    finally:
+        for client in clients:
+            await client.aclose()
+        app_server.should_exit = True
+        fake_server.should_exit = True
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake upstream latency in seconds")
+    parser.add_argument("--deadline", type=float, default=2.0, help="DASHBOARD_DEADLINE for the app")
+    parser.add_argument("--rate-limit", type=float, help="SPOTIFY_RATE_LIMIT and burst for the app")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between batches, like the page")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    args = parser.parse_args(argv)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    results = asyncio.run(run_dashboard(args))
+    print(json.dumps({name: {key: round(value, 1) for key, value in run.items()} for name, run in results.items()},
+                     indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""A tiny in-process Redis stand-in speaking RESP, for running several workers locally.
+
+Supports the commands RedisSharedState uses: PING, AUTH, SELECT, GET, SET (NX/XX,
+PX/EX), DEL, PEXPIRE and FLUSHALL.
+"""
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.commands = 0
+        self.port: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and time.monotonic() >= entry[1]:
+            del self.values[key]
+            return None
+        return entry[0]
+
+    def execute(self, args: List[bytes]) -> bytes:
+        self.commands += 1
+        command = args[0].upper()
+        if command == b"PING":
+            return b"+PONG\r\n"
+        if command in (b"AUTH", b"SELECT"):
+            return b"+OK\r\n"
+        if command == b"FLUSHALL":
+            self.values.clear()
+            return b"+OK\r\n"
+        if command == b"GET":
+            return bulk(self._live(args[1]))
+        if command == b"DEL":
+            removed = sum(1 for key in args[1:] if self._live(key) is not None and self.values.pop(key))
+            return b":%d\r\n" % removed
+        if command == b"PEXPIRE":
+            value = self._live(args[1])
+            if value is None:
+                return b":0\r\n"
+            self.values[args[1]] = (value, time.monotonic() + int(args[2]) / 1000)
+            return b":1\r\n"
+        if command == b"SET":
+            return self._set(args[1], args[2], [arg.upper() for arg in args[3:]])
+        return b"-ERR unknown command '" + command + b"'\r\n"
+
+    def _set(self, key: bytes, value: bytes, options: List[bytes]) -> bytes:
+        expires_at = None
+        if b"PX" in options:
+            expires_at = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000
+        elif b"EX" in options:
+            expires_at = time.monotonic() + int(options[options.index(b"EX") + 1])
+        exists = self._live(key) is not None
+        if (b"NX" in options and exists) or (b"XX" in options and not exists):
+            return b"$-1\r\n"
+        self.values[key] = (value, expires_at)
+        return b"+OK\r\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readuntil(b"\r\n")
+                count = int(header[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await reader.readuntil(b"\r\n"))[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(self.execute(args))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Serve from a background thread. Returns the bound port."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, host, port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def bulk(value: Optional[bytes]) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
@@ -0,0 +1,263 @@
+"""A local stand-in for accounts.spotify.com and api.spotify.com.
+
+Serves recorded currently-playing payloads with configurable latency, 204 (nothing
+playing) and 429 (rate limited) behaviour, and counts every upstream call per user.
+With `image_base_url` set, album images point at /image/{id} on the fake itself, which
+serves a noise PNG as wide as the payload says.
+"""
+import asyncio
+import json
+import os
+import random
+import struct
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+PAYLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads")
+
+
+def load_payloads(directory: str = PAYLOAD_DIR) -> List[dict]:
+    names = sorted(name for name in os.listdir(directory) if name.startswith("currently_playing"))
+    payloads = []
+    for name in names:
+        with open(os.path.join(directory, name)) as f:
+            payloads.append(json.load(f))
+    return payloads
+
+
+@dataclass
+class FakeSpotifyConfig:
+    latency: float = 0.05            # seconds added to every Web API response
+    jitter: float = 0.0              # uniform extra latency, 0..jitter seconds
+    nothing_playing_ratio: float = 0.0
+    rate_limit_ratio: float = 0.0
+    retry_after: int = 1
+    track_seconds: float = 0.0       # shorten tracks so changes happen during a run (0 keeps recorded lengths)
+    hang: bool = False               # never answer Web API calls (fault injection)
+    error_ratio: float = 0.0         # answer Web API calls with 503 (fault injection)
+    image_base_url: str = ""         # serve album images from here instead of i.scdn.co
+
+
+@dataclass
+class UserState:
+    started_at: float = field(default_factory=time.monotonic)
+    offset: int = 0
+    is_playing: bool = True
+    paused_progress_ms: int = 0
+
+
+class FakeSpotify:
+    def __init__(self, config: FakeSpotifyConfig = None, payloads: List[dict] = None):
+        self.config = config or FakeSpotifyConfig()
+        self.payloads = payloads or load_payloads()
+        self.users: Dict[str, UserState] = {}
+        self.calls: Counter = Counter()
+        self.calls_by_user: Counter = Counter()
+        self.app = Starlette(routes=[
+            Route("/api/token", self.token, methods=["POST"]),
+            Route("/v1/me", self.me),
+            Route("/v1/me/player/currently-playing", self.currently_playing),
+            Route("/v1/me/player/queue", self.queue),
+            Route("/v1/me/player/play", self.play, methods=["PUT"]),
+            Route("/v1/me/player/pause", self.pause, methods=["PUT"]),
+            Route("/v1/me/player/next", self.next, methods=["POST"]),
+            Route("/v1/me/player/previous", self.previous, methods=["POST"]),
+            Route("/v1/albums/{album_id}", self.album),
+            Route("/image/{image_id}", self.image),
+        ])
+        # image id -> width, from the recorded album image urls
+        self.image_widths: Dict[str, int] = {
+            image["url"].rsplit("/", 1)[-1]: image["width"]
+            for payload in self.payloads for image in payload["item"]["album"].get("images") or ()
+        }
+        self._images: Dict[str, bytes] = {}
+
+    def reset_counts(self):
+        self.calls.clear()
+        self.calls_by_user.clear()
+
+    @property
+    def api_calls(self) -> int:
+        return sum(count for path, count in self.calls.items() if path.startswith("/v1/"))
+
+    @property
+    def image_calls(self) -> int:
+        return sum(count for path, count in self.calls.items() if path.startswith("/image/"))
+
+    def image_url(self, image_id: str) -> str:
+        return f"{self.config.image_base_url}/image/{image_id}"
+
+    def _album(self, album: dict) -> dict:
+        if not self.config.image_base_url:
+            return album
+        album = dict(album)
+        album["images"] = [
+            {**image, "url": self.image_url(image["url"].rsplit("/", 1)[-1])} for image in album.get("images") or ()
+        ]
+        return album
+
+    async def _web_api(self, request: Request) -> str:
+        """Common Web API handling: auth, counting and injected latency. Returns the user id."""
+        auth = request.headers.get("authorization", "")
+        user_id = auth.removeprefix("Bearer token-")
+        self.calls[request.url.path] += 1
+        self.calls_by_user[user_id] += 1
+        if self.config.hang:
+            await asyncio.Event().wait()
+        delay = self.config.latency + random.uniform(0, self.config.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        return user_id
+
+    def _fault(self):
+        if self.config.rate_limit_ratio and random.random() < self.config.rate_limit_ratio:
+            return Response(status_code=429, headers={"Retry-After": str(self.config.retry_after)})
+        if self.config.error_ratio and random.random() < self.config.error_ratio:
+            return Response(status_code=503)
+        return None
+
+    def _state(self, user_id: str) -> UserState:
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = UserState()
+        return state
+
+    def _position(self, state: UserState):
+        """Current (payload index, progress_ms, duration_ms) for a user."""
+        durations = [
+            int(self.config.track_seconds * 1000) or payload["item"]["duration_ms"] for payload in self.payloads
+        ]
+        if not state.is_playing:
+            elapsed = state.paused_progress_ms
+        else:
+            elapsed = int((time.monotonic() - state.started_at) * 1000)
+        index = state.offset
+        while elapsed >= durations[index % len(durations)]:
+            elapsed -= durations[index % len(durations)]
+            index += 1
+        return index % len(self.payloads), elapsed, durations[index % len(durations)]
+
+    def _item(self, index: int, duration_ms: int) -> dict:
+        item = dict(self.payloads[index]["item"])
+        item["duration_ms"] = duration_ms
+        item["album"] = self._album(item["album"])
+        return item
+
+    async def token(self, request: Request):
+        self.calls[request.url.path] += 1
+        form = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+        if form.get("grant_type") == "refresh_token":
+            user_id = form["refresh_token"].removeprefix("refresh-")
+        else:
+            user_id = form["code"]
+        return JSONResponse({
+            "access_token": f"token-{user_id}",
+            "token_type": "Bearer",
+            "refresh_token": f"refresh-{user_id}",
+            "expires_in": 3600,
+        })
+
+    async def me(self, request: Request):
+        user_id = await self._web_api(request)
+        return JSONResponse({"id": user_id, "display_name": user_id})
+
+    async def currently_playing(self, request: Request):
+        user_id = await self._web_api(request)
+        fault = self._fault()
+        if fault is not None:
+            return fault
+        if self.config.nothing_playing_ratio and random.random() < self.config.nothing_playing_ratio:
+            return Response(status_code=204)
+
+        state = self._state(user_id)
+        index, progress_ms, duration_ms = self._position(state)
+        payload = dict(self.payloads[index])
+        payload["item"] = self._item(index, duration_ms)
+        payload["progress_ms"] = progress_ms
+        payload["is_playing"] = state.is_playing
+        payload["timestamp"] = int(time.time() * 1000)
+        return JSONResponse(payload)
+
+    async def queue(self, request: Request):
+        user_id = await self._web_api(request)
+        fault = self._fault()
+        if fault is not None:
+            return fault
+        index, _, duration_ms = self._position(self._state(user_id))
+        upcoming = [self._item((index + i) % len(self.payloads), duration_ms) for i in range(1, 4)]
+        return JSONResponse({"currently_playing": self._item(index, duration_ms), "queue": upcoming})
+
+    async def play(self, request: Request):
+        user_id = await self._web_api(request)
+        state = self._state(user_id)
+        if not state.is_playing:
+            state.started_at = time.monotonic() - state.paused_progress_ms / 1000
+            state.is_playing = True
+        return self._fault() or Response(status_code=204)
+
+    async def pause(self, request: Request):
+        user_id = await self._web_api(request)
+        state = self._state(user_id)
+        if state.is_playing:
+            state.paused_progress_ms = int((time.monotonic() - state.started_at) * 1000)
+            state.is_playing = False
+        return self._fault() or Response(status_code=204)
+
+    async def next(self, request: Request):
+        return await self._skip(request, 1)
+
+    async def previous(self, request: Request):
+        return await self._skip(request, -1)
+
+    async def _skip(self, request: Request, step: int):
+        user_id = await self._web_api(request)
+        state = self._state(user_id)
+        index, _, _ = self._position(state)
+        state.offset = index + step
+        state.started_at = time.monotonic()
+        state.paused_progress_ms = 0
+        return self._fault() or Response(status_code=204)
+
+    async def album(self, request: Request):
+        await self._web_api(request)
+        album_id = request.path_params["album_id"]
+        for payload in self.payloads:
+            album = payload["item"]["album"]
+            if album["id"] == album_id:
+                return JSONResponse(self._album(album))
+        return JSONResponse({"error": {"status": 404, "message": "non existing id"}}, status_code=404)
+
+    async def image(self, request: Request):
+        self.calls[request.url.path] += 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+        data = self._image(request.path_params["image_id"])
+        if data is None:
+            return Response(status_code=404)
+        return Response(data, media_type="image/png")
+
+    def _image(self, image_id: str) -> Optional[bytes]:
+        """A square PNG of seeded noise, so thumbnails have realistic, stable sizes."""
+        width = self.image_widths.get(image_id)
+        if width is None:
+            return None
+        data = self._images.get(image_id)
+        if data is None:
+            noise = random.Random(image_id).randbytes(width * width * 3)
+            rows = b"".join(b"\0" + noise[y * width * 3:(y + 1) * width * 3] for y in range(width))
+
+            def chunk(kind: bytes, body: bytes) -> bytes:
+                return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+            data = self._images[image_id] = (b"\x89PNG\r\n\x1a\n"
+                                             + chunk(b"IHDR", struct.pack(">IIBBBBB", width, width, 8, 2, 0, 0, 0))
+                                             + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b""))
+        return data
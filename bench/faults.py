@@ -0,0 +1,195 @@
+"""Fault injection against the local fake Spotify: 5xx errors, 429s, hangs and overload.
+
+Runs the app in-process with tight upstream settings and checks that /now-playing/progress
+keeps answering from cached snapshots marked stale, that the currently-playing circuit
+opens, stops upstream traffic, and closes again after a successful probe, that a 429
+pauses every upstream request for its Retry-After, that player commands are let through
+the rate limiter ahead of background polls, that hung calls are cut off by the per-call
+timeout, and that requests beyond SPOTIFY_MAX_IN_FLIGHT are shed. Exits non-zero when a
+check fails.
+
+    python -m bench.faults
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from typing import List, Tuple
+
+import httpx
+
+from bench.fake_spotify import FakeSpotifyConfig
+from bench.run import start_app, start_fake_spotify
+
+PLAYBACK_ENDPOINT = "/v1/me/player/currently-playing"
+
+
+class Checks:
+    def __init__(self):
+        self.results: List[Tuple[str, bool, str]] = []
+
+    def check(self, name: str, ok: bool, detail: str = ""):
+        self.results.append((name, ok, detail))
+        print(f"{'ok  ' if ok else 'FAIL'} {name}{f'  ({detail})' if detail else ''}")
+
+    @property
+    def failed(self) -> bool:
+        return not all(ok for _, ok, _ in self.results)
+
+
+async def poll_all(clients: List[httpx.AsyncClient], batch: int = 0) -> List[Tuple[int, dict, float]]:
+    """Poll progress for every client at once, or `batch` at a time to stay under the in-flight bound."""
+    async def poll(client):
+        started = time.perf_counter()
+        response = await client.get("/now-playing/progress")
+        body = response.json() if response.status_code in (200, 503) else {}
+        return response.status_code, body, time.perf_counter() - started
+    batch = batch or len(clients)
+    results = []
+    for start in range(0, len(clients), batch):
+        results += await asyncio.gather(*(poll(client) for client in clients[start:start + batch]))
+    return results
+
+
+async def run_faults(args, checks: Checks):
+    fake, fake_port, fake_server = start_fake_spotify(FakeSpotifyConfig(latency=0.02))
+    base_url, app_server = start_app(
+        fake_port,
+        SPOTIFY_RATE_LIMIT=1000,
+        SPOTIFY_RATE_LIMIT_BURST=1000,
+        SPOTIFY_API_TIMEOUT=args.api_timeout,
+        SPOTIFY_MAX_IN_FLIGHT=args.max_in_flight,
+        SPOTIFY_BREAKER_THRESHOLD=args.threshold,
+        SPOTIFY_BREAKER_RESET=args.reset,
+        PLAYBACK_CACHE_TTL=0.1,
+        PREFETCH_LEAD_TIME=0,
+    )
+    from app.core.ratelimit import Priority, RateLimiter
+    from app.core.spotify import get_spotify_client
+    spotify = get_spotify_client()
+
+    def circuit_state() -> str:
+        return spotify.breakers.get(PLAYBACK_ENDPOINT).state
+
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=30) for _ in range(args.users)]
+    newcomer = httpx.AsyncClient(base_url=base_url, timeout=30)
+    try:
+        for i, client in enumerate(clients):
+            await client.get(f"/callback?code=user{i}")
+        # Logged in, but never fetched: there is no snapshot to fall back on
+        await newcomer.get("/callback?code=newcomer")
+
+        results = await poll_all(clients, args.max_in_flight)
+        checks.check("healthy: fresh snapshots",
+                     all(status == 200 and not body["stale"] for status, body, _ in results))
+
+        # Spotify answers 503 to everything
+        fake.config.error_ratio = 1.0
+        await asyncio.sleep(0.2)
+        for _ in range(args.threshold + 1):
+            results = await poll_all(clients[:1])
+        checks.check("5xx: circuit opens", circuit_state() == "open", circuit_state())
+        fake.reset_counts()
+        results = await poll_all(clients)
+        checks.check("5xx: stale snapshots served",
+                     all(status == 200 and body["stale"] for status, body, _ in results))
+        checks.check("5xx: open circuit stops upstream calls", fake.api_calls == 0, f"{fake.api_calls} calls")
+        status, body, _ = (await poll_all([newcomer]))[0]
+        checks.check("5xx: no snapshot gives 503", status == 503, str(status))
+
+        # Spotify recovers, the probe after the reset timeout closes the circuit
+        fake.config.error_ratio = 0.0
+        await asyncio.sleep(args.reset + 0.1)
+        await poll_all(clients[:1])
+        await asyncio.sleep(0.2)
+        results = await poll_all(clients, args.max_in_flight)
+        checks.check("recovery: circuit closes after probe", circuit_state() == "closed", circuit_state())
+        checks.check("recovery: fresh snapshots again",
+                     all(status == 200 and not body["stale"] for status, body, _ in results))
+
+        # Spotify rate limits once, the whole app waits out Retry-After
+        fake.config.rate_limit_ratio = 1.0
+        fake.config.retry_after = args.retry_after
+        await asyncio.sleep(0.2)
+        await poll_all(clients[:1])
+        paused_at = time.monotonic()
+        fake.config.rate_limit_ratio = 0.0
+        checks.check("429: rate limiter paused", spotify.rate_limiter.retry_after > 0,
+                     f"{spotify.rate_limiter.retry_after:.1f}s left")
+        fake.reset_counts()
+        results = await poll_all(clients, args.max_in_flight)
+        await clients[0].post("/player/pause")
+        await asyncio.sleep(0.2)
+        checks.check("429: stale snapshots served",
+                     all(status == 200 and body["stale"] for status, body, _ in results))
+        checks.check("429: pause covers every request", fake.api_calls == 0, f"{fake.api_calls} calls")
+        response = await newcomer.get("/now-playing/progress")
+        checks.check("429: no snapshot gives 503 with Retry-After",
+                     response.status_code == 503 and "retry-after" in response.headers,
+                     f"{response.status_code}, Retry-After {response.headers.get('retry-after')}")
+        await asyncio.sleep(max(0.0, paused_at + args.retry_after + 0.1 - time.monotonic()))
+        results = await poll_all(clients, args.max_in_flight)
+        checks.check("429: fresh snapshots after Retry-After",
+                     all(status == 200 and not body["stale"] for status, body, _ in results)
+                     and fake.api_calls > 0, f"{fake.api_calls} calls")
+
+        # The app's loop runs in the server thread, so queue on a limiter of the same kind here:
+        # with the bucket empty, a command queued behind background polls is let through first
+        limiter = RateLimiter(rate=20.0, burst=1)
+        limiter.tokens = 0.0
+        finished: List[str] = []
+
+        async def acquire(priority: Priority):
+            await limiter.acquire(priority)
+            finished.append(priority.name)
+        background = [asyncio.create_task(acquire(Priority.BACKGROUND)) for _ in range(4)]
+        await asyncio.sleep(0)
+        await asyncio.gather(acquire(Priority.COMMAND), *background)
+        checks.check("priority: command served before queued background polls", finished[0] == "COMMAND",
+                     " > ".join(finished))
+
+        # Spotify stops answering
+        fake.config.hang = True
+        await asyncio.sleep(0.2)
+        shed_before = spotify.shed
+        results = await poll_all(clients)
+        slowest = max(elapsed for _, _, elapsed in results)
+        checks.check("hang: every request answered stale",
+                     all(status == 200 and body["stale"] for status, body, _ in results))
+        checks.check("hang: bounded by the per-call timeout", slowest < args.api_timeout + 0.5, f"slowest {slowest:.2f}s")
+        checks.check("hang: excess requests shed", spotify.shed - shed_before >= args.users - args.max_in_flight,
+                     f"{spotify.shed - shed_before} shed")
+        for _ in range(args.threshold):
+            await poll_all(clients[:1])
+        results = await poll_all(clients)
+        slowest = max(elapsed for _, _, elapsed in results)
+        checks.check("hang: circuit opens", circuit_state() == "open", circuit_state())
+        checks.check("hang: open circuit answers immediately", slowest < 0.2, f"slowest {slowest * 1000:.0f}ms")
+    finally:
+        for client in clients + [newcomer]:
+            await client.aclose()
+        app_server.should_exit = True
+        fake_server.should_exit = True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--api-timeout", type=float, default=0.5)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--threshold", type=int, default=3)
+    parser.add_argument("--reset", type=float, default=2.0)
+    parser.add_argument("--retry-after", type=int, default=2, help="Retry-After seconds the fake's 429s carry")
+    args = parser.parse_args(argv)
+
+    # The app logs every failed upstream call, which is the point here
+    logging.getLogger("app").setLevel(logging.CRITICAL)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    checks = Checks()
+    asyncio.run(run_faults(args, checks))
+    return 1 if checks.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+"""Microbenchmark: parse_playback() versus keeping the raw json.loads() dict.
+
+Runs over every recorded payload in bench/payloads, including an ad and a podcast
+episode, which Spotify reports without a track item and parse_playback() drops.
+
+    python -m bench.parse_playback
+"""
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+from app.core import models
+from app.core.models import parse_playback
+from bench.fake_spotify import PAYLOAD_DIR
+
+
+def retained_bytes(factory) -> int:
+    tracemalloc.start()
+    value = factory()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def main() -> int:
+    bodies = {}
+    for name in sorted(os.listdir(PAYLOAD_DIR)):
+        with open(os.path.join(PAYLOAD_DIR, name)) as f:
+            bodies[name.removesuffix(".json")] = json.dumps(json.load(f)).encode()
+    print(f"parser: {models._loads.__module__}")
+    number = 20000
+    for name, body in bodies.items():
+        dict_us = min(timeit.repeat(lambda: json.loads(body), number=number, repeat=3)) / number * 1e6
+        snapshot_us = min(timeit.repeat(lambda: parse_playback(body), number=number, repeat=3)) / number * 1e6
+        dict_kb = retained_bytes(lambda: json.loads(body)) / 1024
+        snapshot_kb = retained_bytes(lambda: parse_playback(body)) / 1024
+        print(f"{name:<20} {len(body):>6} bytes  dict {dict_us:6.1f}us {dict_kb:6.2f}KB  "
+              f"snapshot {snapshot_us:6.1f}us {snapshot_kb:6.2f}KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""Render cost of the track_info / playback_status partials, before and after caching.
+
+    python -m bench.render
+"""
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from app.core.fragments import FragmentCache
+from app.core.models import parse_playback
+from app.core.templates import BASE_DIR
+from bench.fake_spotify import PAYLOAD_DIR
+
+TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
+
+
+def cold_compile_ms(bytecode_cache=None) -> float:
+    """Time for a fresh environment (i.e. a new worker) to load every template."""
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), bytecode_cache=bytecode_cache)
+    started = time.perf_counter()
+    for name in env.list_templates(extensions=["html"]):
+        env.get_template(name)
+    return (time.perf_counter() - started) * 1000
+
+
+def per_call_us(fn, number: int = 20000) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def main() -> int:
+    with open(os.path.join(PAYLOAD_DIR, "currently_playing_1.json"), "rb") as f:
+        track = parse_playback(f.read())
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = FileSystemBytecodeCache(directory)
+        cold_compile_ms(cache)  # populate
+        print(f"startup compile   no bytecode cache {cold_compile_ms():7.2f}ms   "
+              f"warm bytecode cache {cold_compile_ms(cache):7.2f}ms")
+
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    fragments = FragmentCache()
+    track_info = env.get_template("partials/track_info.html")
+    status = env.get_template("partials/playback_status.html")
+    print(f"track_info        render {per_call_us(lambda: env.get_template('partials/track_info.html').render(track=track)):6.2f}us   "
+          f"render (template held) {per_call_us(lambda: track_info.render(track=track)):6.2f}us   "
+          f"fragment cache {per_call_us(lambda: fragments.track_info(track)):6.2f}us")
+    print(f"playback_status   render {per_call_us(lambda: env.get_template('partials/playback_status.html').render(status='Playing')):6.2f}us   "
+          f"render (template held) {per_call_us(lambda: status.render(status='Playing')):6.2f}us   "
+          f"fragment cache {per_call_us(lambda: fragments.playback_status('Playing')):6.2f}us")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
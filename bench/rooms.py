@@ -0,0 +1,115 @@
+"""Fan-out benchmark for shared listening rooms.
+
+Logs in one owner against the local fake Spotify, opens a room and connects N viewers
+to /room/{token}/stream without logging them in. Reports how far apart the viewers
+receive each progress event (spread from the first arrival), upstream calls per minute
+for the whole room, and checks that the viewer after ROOM_MAX_VIEWERS is turned away.
+
+    python -m bench.rooms --viewers 2000 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+from bench.fake_spotify import FakeSpotifyConfig
+from bench.run import percentile, start_app, start_fake_spotify
+
+
+async def watch(client: httpx.AsyncClient, path: str, window: Dict[str, float], arrivals: Dict[str, List[float]],
+                connected: asyncio.Event, counter: List[int], total: int) -> int:
+    async with client.stream("GET", path) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return response.status_code
+        counter[0] += 1
+        if counter[0] == total:
+            connected.set()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: ") and event == "progress":
+                arrivals[line].append(time.perf_counter())
+            if time.monotonic() >= window["until"]:
+                break
+        return response.status_code
+
+
+async def run_rooms(args) -> Dict[str, float]:
+    fake, fake_port, fake_server = start_fake_spotify(
+        FakeSpotifyConfig(latency=args.latency, track_seconds=args.track_seconds))
+    base_url, app_server = start_app(fake_port, STREAM_TICK_INTERVAL=args.tick_interval, ROOM_MAX_VIEWERS=args.viewers)
+
+    owner = httpx.AsyncClient(base_url=base_url, timeout=30)
+    viewers = httpx.AsyncClient(base_url=base_url, timeout=60,
+                                limits=httpx.Limits(max_connections=None, max_keepalive_connections=0))
+    arrivals: Dict[str, List[float]] = defaultdict(list)
+    try:
+        await owner.get("/callback?code=owner")
+        response = await owner.post("/room")
+        room_path = response.headers["location"]
+
+        connected = asyncio.Event()
+        counter = [0]
+        window = {"until": float("inf")}
+        tasks = [asyncio.create_task(watch(viewers, f"{room_path}/stream", window, arrivals,
+                                           connected, counter, args.viewers))
+                 for _ in range(args.viewers)]
+        await asyncio.wait_for(connected.wait(), timeout=args.connect_timeout)
+        # Everyone is in, measure from here on
+        arrivals.clear()
+        fake.reset_counts()
+        started = time.monotonic()
+        window["until"] = started + args.duration
+
+        rejected = (await viewers.get(f"{room_path}/stream")).status_code
+        statuses = await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+    finally:
+        await owner.aclose()
+        await viewers.aclose()
+        app_server.should_exit = True
+        fake_server.should_exit = True
+
+    # Only events every viewer saw, the first and last may be cut off by the window
+    complete = [times for times in arrivals.values() if len(times) == args.viewers]
+    spreads = [(t - min(times)) * 1000 for times in complete for t in times]
+    return {
+        "viewers": args.viewers,
+        "viewer_errors": sum(1 for status in statuses if status != 200),
+        "over_limit_status": rejected,
+        "events_measured": len(complete),
+        "fanout_p50_ms": percentile(spreads, 50),
+        "fanout_p99_ms": percentile(spreads, 99),
+        "fanout_max_ms": max(spreads) if spreads else 0.0,
+        "upstream_calls_per_minute": fake.api_calls / (elapsed / 60),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--viewers", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=20.0, help="measurement window in seconds")
+    parser.add_argument("--connect-timeout", type=float, default=60.0)
+    parser.add_argument("--tick-interval", type=float, default=1.0, help="STREAM_TICK_INTERVAL for the app")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake upstream latency in seconds")
+    parser.add_argument("--track-seconds", type=float, default=20.0)
+    args = parser.parse_args(argv)
+
+    # One access log line per viewer connection would drown the results
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    results = asyncio.run(run_rooms(args))
+    print(json.dumps({key: round(value, 2) for key, value in results.items()}, indent=2))
+    return 0 if results["viewer_errors"] == 0 and results["over_limit_status"] == 503 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
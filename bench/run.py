@@ -0,0 +1,327 @@
+"""Load test the app against the local fake Spotify.
+
+Starts the fake upstream and the FastAPI app on loopback ports, logs in N simulated
+users and has each of them poll /now-playing/progress, refetch /now-playing/track-info
+on track changes and click /player/* buttons. Reports throughput, latency percentiles,
+upstream calls per user-minute and memory per session, and compares them with a stored
+baseline.
+
+    python -m bench.run --users 50 --duration 30
+    python -m bench.run --update-baseline
+    python -m bench.run --workers 4    # uvicorn workers sharing state via a fake Redis
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+import httpx
+import uvicorn
+
+from bench.fake_redis import FakeRedis
+from bench.fake_spotify import FakeSpotify, FakeSpotifyConfig
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+# metric -> True when higher is better
+METRIC_DIRECTIONS = {
+    "throughput_rps_per_user": True,
+    "progress_p95_ms": False,
+    "track_info_p95_ms": False,
+    "player_p95_ms": False,
+    "upstream_calls_per_user_minute": False,
+    "memory_per_session_kb": False,
+}
+# Latencies below this many ms are too noisy to compare
+LATENCY_FLOOR_MS = 5.0
+# Arguments that shape the load; runs are only compared with a baseline taken with the same ones
+LOAD_PARAMETERS = ("users", "workers", "duration", "poll_interval", "click_probability", "latency", "jitter",
+                   "nothing_playing_ratio", "rate_limit_ratio", "rate_limit", "track_seconds")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def start_fake_spotify(config: FakeSpotifyConfig) -> Tuple[FakeSpotify, int, uvicorn.Server]:
+    """The fake Spotify on a free loopback port: (fake, port, server)."""
+    fake = FakeSpotify(config)
+    port = free_port()
+    return fake, port, start_server(fake.app, port)
+
+
+def configure_app(fake_port: int, **overrides: Any) -> str:
+    """Point the app's environment at the fake Spotify on `fake_port`, with its data in a
+    fresh temp dir, which is returned. Keyword arguments are extra environment variables.
+    Must run before app.main is imported; start_workers() picks it up too."""
+    data_dir = tempfile.mkdtemp(prefix="now-playing-bench-")
+    os.environ.update({
+        "SPOTIFY_CLIENT_ID": "bench",
+        "SPOTIFY_CLIENT_SECRET": "bench",
+        "SPOTIFY_REDIRECT_URI": "http://127.0.0.1/callback",
+        "SPOTIFY_ACCOUNTS_URL": f"http://127.0.0.1:{fake_port}",
+        "SPOTIFY_API_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "ALBUM_INFO_CACHE_PATH": os.path.join(data_dir, "album_info.sqlite3"),
+        "ARTWORK_CACHE_DIR": os.path.join(data_dir, "artwork"),
+        "TEMPLATE_CACHE_DIR": os.path.join(data_dir, "templates"),
+        "HISTORY_DIR": os.path.join(data_dir, "history"),
+    })
+    os.environ.update({name: str(value) for name, value in overrides.items()})
+    return data_dir
+
+
+def start_app(fake_port: int, **overrides: Any) -> Tuple[str, uvicorn.Server]:
+    """configure_app(), then serve the app in-process: (base_url, server)."""
+    configure_app(fake_port, **overrides)
+    from app.main import app
+    port = free_port()
+    return f"http://127.0.0.1:{port}", start_server(app, port)
+
+
+def start_workers(port: int, workers: int, *uvicorn_args: str) -> subprocess.Popen:
+    """Run the app as `uvicorn --workers N` in a subprocess, configured from os.environ."""
+    process = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning", *uvicorn_args,
+    ])
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/login", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("uvicorn workers did not start")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class SimulatedUser:
+    def __init__(self, base_url: str, user_id: str, latencies: Dict[str, List[float]]):
+        self.user_id = user_id
+        self.latencies = latencies
+        self.client = httpx.AsyncClient(base_url=base_url, timeout=30)
+        self.etags: Dict[str, str] = {}
+        self.track_id = None
+        self.errors = 0
+
+    async def login(self):
+        # The callback answers with a redirect to /now-playing, only the session cookie matters
+        response = await self.client.get(f"/callback?code={self.user_id}")
+        if response.status_code >= 400:
+            response.raise_for_status()
+
+    async def request(self, name: str, method: str, path: str):
+        headers = {}
+        if path in self.etags:
+            headers["If-None-Match"] = self.etags[path]
+        started = time.perf_counter()
+        response = await self.client.request(method, path, headers=headers)
+        self.latencies[name].append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 400:
+            self.errors += 1
+        elif "etag" in response.headers:
+            self.etags[path] = response.headers["etag"]
+        return response
+
+    async def run(self, until: float, poll_interval: float, click_probability: float):
+        # Spread users over the first interval like real page loads
+        await asyncio.sleep(random.uniform(0, poll_interval))
+        while time.monotonic() < until:
+            response = await self.request("progress", "GET", "/now-playing/progress")
+            if response.status_code == 200:
+                track_id = response.json().get("track_id")
+                if track_id != self.track_id:
+                    self.track_id = track_id
+                    await self.request("track_info", "GET", "/now-playing/track-info")
+            if random.random() < click_probability:
+                command = random.choice(("play", "pause", "next", "previous"))
+                await self.request("player", "POST", f"/player/{command}")
+            await asyncio.sleep(poll_interval)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+async def measure_session_memory(users: List[SimulatedUser]) -> float:
+    """Server-side memory per logged-in user with one page load, in KB.
+
+    The simulated clients run in the same process, so only allocations with an app/
+    frame on their stack are counted, not the clients' own httpx and cookie state.
+    """
+    tracemalloc.start(25)
+    before = tracemalloc.take_snapshot()
+    for user in users:
+        await user.login()
+        await user.request("page", "GET", "/now-playing")
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    app_frames = [tracemalloc.Filter(True, os.path.join(APP_DIR, "*"), all_frames=True)]
+    grown = sum(stat.size_diff for stat in after.filter_traces(app_frames).compare_to(
+        before.filter_traces(app_frames), "filename"))
+    return grown / len(users) / 1024
+
+
+async def run_load(args) -> Dict[str, float]:
+    fake, fake_port, fake_server = start_fake_spotify(FakeSpotifyConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        nothing_playing_ratio=args.nothing_playing_ratio,
+        rate_limit_ratio=args.rate_limit_ratio,
+        track_seconds=args.track_seconds,
+    ))
+    limits = {"SPOTIFY_RATE_LIMIT": args.rate_limit, "SPOTIFY_RATE_LIMIT_BURST": int(args.rate_limit)}
+    fake_redis = app_server = app_process = None
+    if args.workers > 1:
+        fake_redis = FakeRedis()
+        configure_app(fake_port, SHARED_STATE_URL=f"redis://127.0.0.1:{fake_redis.start()}/0", **limits)
+        app_port = free_port()
+        app_process = start_workers(app_port, args.workers)
+        base_url = f"http://127.0.0.1:{app_port}"
+    else:
+        base_url, app_server = start_app(fake_port, **limits)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    users = [SimulatedUser(base_url, f"user{i}", latencies) for i in range(args.users)]
+    try:
+        if app_process is None:
+            memory_per_session_kb = await measure_session_memory(users)
+        else:
+            # The app runs in other processes, tracemalloc can't see it
+            memory_per_session_kb = None
+            for user in users:
+                await user.login()
+        latencies.clear()
+        fake.reset_counts()
+
+        started = time.monotonic()
+        until = started + args.duration
+        await asyncio.gather(*(user.run(until, args.poll_interval, args.click_probability) for user in users))
+        elapsed = time.monotonic() - started
+        prefetch_hit_rate = None
+        if app_process is None:
+            from app.core.prefetch import get_prefetcher
+            stats = get_prefetcher().stats()
+            changes = stats["hits"] + stats["misses"]
+            prefetch_hit_rate = stats["hits"] / changes if changes else None
+    finally:
+        for user in users:
+            await user.aclose()
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait()
+            fake_redis.stop()
+        else:
+            app_server.should_exit = True
+        fake_server.should_exit = True
+
+    total = sum(len(values) for values in latencies.values())
+    results = {
+        "throughput_rps": total / elapsed,
+        "throughput_rps_per_user": total / elapsed / args.users,
+        "upstream_calls_per_user_minute": fake.api_calls / args.users / (elapsed / 60),
+        "memory_per_session_kb": memory_per_session_kb,
+        "errors": sum(user.errors for user in users),
+        "prefetch_hit_rate": prefetch_hit_rate,
+    }
+    for name in ("progress", "track_info", "player"):
+        for pct in (50, 95, 99):
+            results[f"{name}_p{pct}_ms"] = percentile(latencies[name], pct)
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    regressions = []
+    for metric, higher_is_better in METRIC_DIRECTIONS.items():
+        if baseline.get(metric) is None or results.get(metric) is None:
+            continue
+        current, expected = results[metric], baseline[metric]
+        if metric.endswith("_ms"):
+            expected = max(expected, LATENCY_FLOOR_MS)
+        if higher_is_better and current < expected * (1 - tolerance):
+            regressions.append(f"{metric}: {current:.2f} < {expected:.2f} (-{tolerance:.0%})")
+        elif not higher_is_better and current > expected * (1 + tolerance):
+            regressions.append(f"{metric}: {current:.2f} > {expected:.2f} (+{tolerance:.0%})")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=1, help="run the app as N uvicorn workers")
+    parser.add_argument("--duration", type=float, default=30.0, help="load phase length in seconds")
+    parser.add_argument("--poll-interval", type=float, default=3.0, help="seconds between progress polls per user")
+    parser.add_argument("--click-probability", type=float, default=0.05, help="chance of a player click per poll")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake upstream latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--nothing-playing-ratio", type=float, default=0.0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="app-wide upstream requests per second")
+    parser.add_argument("--track-seconds", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    results = asyncio.run(run_load(args))
+    results = {key: round(value, 2) if value is not None else None for key, value in results.items()}
+    print(json.dumps(results, indent=2))
+
+    parameters = {name: getattr(args, name) for name in LOAD_PARAMETERS}
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"parameters": parameters, "metrics": {key: results[key] for key in METRIC_DIRECTIONS}},
+                      f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline first")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    mismatched = [f"--{name.replace('_', '-')} {value} (baseline {baseline['parameters'].get(name)})"
+                  for name, value in parameters.items() if baseline["parameters"].get(name) != value]
+    if mismatched:
+        print(f"Not comparing with {args.baseline}, it was taken with other load parameters: "
+              + ", ".join(mismatched))
+        return 2
+    regressions = compare(results, baseline["metrics"], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
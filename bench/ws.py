@@ -0,0 +1,161 @@
+"""/ws/player against the local fake Spotify: command round trips and idle connections.
+
+Runs the app as a single uvicorn process and compares a player command sent over the
+WebSocket with the same command as an HTTP POST: latency percentiles and bytes on the
+wire per command. Then opens N idle WebSocket connections spread over a few users and
+reports the app's resident memory per connection and how many messages an idle
+connection receives while its track plays.
+
+    python -m bench.ws --connections 10000 --idle 30
+    python -m bench.ws --uvicorn-args="--ws-per-message-deflate true"
+"""
+import argparse
+import asyncio
+import json
+import logging
+import shlex
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+import websockets
+
+from bench.fake_spotify import FakeSpotifyConfig
+from bench.run import configure_app, free_port, percentile, start_fake_spotify, start_workers
+
+# WebSocket frame headers for short messages: 2 bytes, plus a 4 byte mask from the client.
+# Browsers offer permessage-deflate like the websockets client here, so it is used when the server agrees.
+WS_SERVER_FRAME = 2
+WS_CLIENT_FRAME = 6
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def header_bytes(headers: httpx.Headers) -> int:
+    return sum(len(name) + len(value) + 4 for name, value in headers.raw)
+
+
+async def login(base_url: str, user_id: str) -> str:
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        await client.get(f"/callback?code={user_id}")
+        return "; ".join(f"{name}={value}" for name, value in client.cookies.items())
+
+
+async def time_commands(base_url: str, ws_url: str, cookie: str, rounds: int) -> Dict[str, float]:
+    commands = ["pause", "play"] * (rounds // 2)
+    ws_latencies: List[float] = []
+    ws_bytes = 0
+    async with websockets.connect(ws_url, additional_headers={"Cookie": cookie}) as ws:
+        await ws.recv()  # initial state
+        for command in commands:
+            started = time.perf_counter()
+            await ws.send(command)
+            while True:
+                message = await ws.recv()
+                # State diffs from the poller can arrive in between, the reply carries the status
+                if '"s":' in message:
+                    break
+            ws_latencies.append((time.perf_counter() - started) * 1000)
+            ws_bytes += WS_CLIENT_FRAME + len(command) + WS_SERVER_FRAME + len(message)
+
+    http_latencies: List[float] = []
+    http_bytes = 0
+    async with httpx.AsyncClient(base_url=base_url, headers={"Cookie": cookie}) as client:
+        for command in commands:
+            started = time.perf_counter()
+            response = await client.post(f"/player/{command}")
+            http_latencies.append((time.perf_counter() - started) * 1000)
+            request_line = len(f"POST /player/{command} HTTP/1.1\r\n")
+            http_bytes += (request_line + header_bytes(response.request.headers)
+                           + len("HTTP/1.1 200 OK\r\n") + header_bytes(response.headers) + len(response.content))
+    return {
+        "ws_p50_ms": percentile(ws_latencies, 50),
+        "ws_p99_ms": percentile(ws_latencies, 99),
+        "ws_bytes_per_command": ws_bytes / len(commands),
+        "http_p50_ms": percentile(http_latencies, 50),
+        "http_p99_ms": percentile(http_latencies, 99),
+        "http_bytes_per_command": http_bytes / len(commands),
+    }
+
+
+async def hold_idle(ws_url: str, cookies: List[str], connections: int, idle: float, pid: int) -> Dict[str, float]:
+    before_kb = rss_kb(pid)
+    sockets = []
+    received: List[int] = []
+
+    async def listen(ws, index: int):
+        async for _ in ws:
+            received[index] += 1
+
+    try:
+        for start in range(0, connections, 500):
+            batch = await asyncio.gather(*(
+                websockets.connect(ws_url, additional_headers={"Cookie": cookies[i % len(cookies)]},
+                                   open_timeout=60, ping_interval=None)
+                for i in range(start, min(start + 500, connections))))
+            sockets += batch
+        received += [0] * len(sockets)
+        listeners = [asyncio.create_task(listen(ws, i)) for i, ws in enumerate(sockets)]
+        # Let the initial state arrive, then count what idle connections are sent
+        await asyncio.sleep(2)
+        held_kb = rss_kb(pid)
+        initial = sum(received)
+        await asyncio.sleep(idle)
+        idle_messages = sum(received) - initial
+        for listener in listeners:
+            listener.cancel()
+    finally:
+        await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+    return {
+        "connections": len(sockets),
+        "rss_before_mb": before_kb / 1024,
+        "rss_held_mb": held_kb / 1024,
+        "kb_per_connection": (held_kb - before_kb) / max(1, len(sockets)),
+        "messages_per_connection_minute": idle_messages / max(1, len(sockets)) / idle * 60,
+    }
+
+
+async def run_ws(args) -> Dict[str, Dict[str, float]]:
+    fake, fake_port, fake_server = start_fake_spotify(FakeSpotifyConfig(latency=args.latency))
+    configure_app(fake_port, SPOTIFY_RATE_LIMIT=1000, SPOTIFY_RATE_LIMIT_BURST=1000, PREFETCH_LEAD_TIME=0)
+    app_port = free_port()
+    process = start_workers(app_port, 1, *shlex.split(args.uvicorn_args))
+    base_url = f"http://127.0.0.1:{app_port}"
+    ws_url = f"ws://127.0.0.1:{app_port}/ws/player"
+    try:
+        cookies = await asyncio.gather(*(login(base_url, f"user{i}") for i in range(args.users)))
+        results = {"commands": await time_commands(base_url, ws_url, cookies[0], args.rounds)}
+        results["idle"] = await hold_idle(ws_url, cookies, args.connections, args.idle, process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        fake_server.should_exit = True
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=50, help="the idle connections are spread over this many users")
+    parser.add_argument("--idle", type=float, default=30, help="seconds to hold the idle connections")
+    parser.add_argument("--rounds", type=int, default=200, help="player commands to time per transport")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake upstream latency in seconds")
+    parser.add_argument("--uvicorn-args", default="--ws-per-message-deflate false")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    results = asyncio.run(run_ws(args))
+    print(json.dumps({name: {key: round(value, 2) for key, value in run.items()} for name, run in results.items()},
+                     indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())